@@ -5,6 +5,11 @@ import yaml
 import os
 import urllib.parse
 
+# import checkpoints of results for incremental lookup
+from lookup_proc import LookupCheckpoint
+# import parsing and deduplication of input names
+from lookup_proc import deduplicate_names, report_saved_lookups
+
 """
 
 This block:
@@ -24,24 +29,14 @@ OUTPUT
 Format: CSV
 Mandatory: yes
 
-"""
-
-# open configuration files
-with open('config.yaml', 'r') as file:
-    config = yaml.safe_load(file)
-
-# paths from the config file
-input_dir = config['input_dir']
-output_dir = config['output_dir']
+Input names are parsed into canonical names and authorship ('Alytes cisternasii Boscá, 1879' -> 'Alytes cisternasii') before lookup,
+so duplicates, case variants and names with different authorship are fetched once (DOPA expects binomials without authorship).
 
-# input file from the config
-input_species_csv = os.path.join(input_dir, config['input_species'])
-output_iucn_csv = os.path.join(output_dir, config['iucn_csv'])
+Lookup is incremental (see 'lookup_incremental' in config.yaml): IUCN records of every species are appended to the checkpoint next to the output file
+as soon as they are fetched, so the interrupted lookup continues from where it stopped, and reruns fetch only new or edited species
+(species without IUCN data are fetched again in every run). Records older than 'lookup_cache_ttl_days' are fetched again.
 
-# Debug: Print paths
-print(f"Path to the input CSV with scientific names: {input_species_csv}")
-print(f"Path to the output CSV with IUCN data: {output_iucn_csv}")
-print('-' * 40)
+"""
 
 
 # 1st function to fetch IUCN IDs by scientific names
@@ -124,13 +119,33 @@ def fetch_IUCN_data_by_id(iucn_id):
         return None
 
 
+# to fetch IUCN records of one species (None if the species is not found)
+def fetch_species_records(species_name):
+    # Step 1: fetch the IUCN ID using the species name
+    iucn_id = fetch_id_from_name_IUCN(species_name)
+    if iucn_id:
+        # Step 2: fetch full IUCN data using the IUCN ID
+        iucn_data = fetch_IUCN_data_by_id(iucn_id)
+        if iucn_data:
+            print('-'*40)
+            return iucn_data['records']
+        else:
+            print(f"No detailed data found for {species_name}.")
+            print('-'*40)
+    else:
+        print(f"No IUCN ID found for {species_name}.")
+        print('-'*40)
+    return None
+
+
 # main function to fetch IUCN data using species names from the CSV
-def dopa_fetch_iucn(input_species_csv):
+def dopa_fetch_iucn(input_species_csv, checkpoint=None):
     """
     Fetches IUCN species data from the DOPA REST service for species listed in an input CSV file.
 
     Parameters:
     - input_species_csv: A path to the input CSV file with the scientific names of species.
+    - checkpoint: LookupCheckpoint with IUCN records of species fetched in previous runs (only other species are fetched), None to fetch all species.
 
     Returns:
     - df_list: A list of dataframes, each containing data for one species.
@@ -141,59 +156,99 @@ def dopa_fetch_iucn(input_species_csv):
     try:
         species_df = pd.read_csv(input_species_csv)
         first_column = species_df.iloc[:, 0]
-        species_list = first_column.tolist()
+        input_names = first_column.tolist()
     except (FileNotFoundError, KeyError) as e:
         print(f"Error reading species from CSV: {e}")
         return []
 
-    for species_name in species_list:
-        # Step 1: fetch the IUCN ID using the species name
-        iucn_id = fetch_id_from_name_IUCN(species_name)
-        if iucn_id:
-            # Step 2: fetch full IUCN data using the IUCN ID
-            iucn_data = fetch_IUCN_data_by_id(iucn_id)
-            if iucn_data:
+    # every canonical name is fetched once (requests to fetch IUCN ID and IUCN data), output is grouped by IUCN ID anyway
+    species_list, _ = deduplicate_names(input_names)
+    report_saved_lookups(len(input_names), len(species_list), requests_per_name=2)
+    print('-'*40)
+
+    if checkpoint is None:
+        for species_name in species_list:
+            records = fetch_species_records(species_name)
+            if records:
                 # convert JSON to dataframe
-                df = pd.DataFrame(iucn_data['records'])
-                df_list.append(df)
-                print('-'*40)
-            else:
-                print(f"No detailed data found for {species_name}.")
-                print('-'*40)
-        else:
-            print(f"No IUCN ID found for {species_name}.")
-            print('-'*40)
-    
+                df_list.append(pd.DataFrame(records))
+        return df_list
+
+    pending_species = checkpoint.pending(species_list)
+    print(f"{len(species_list) - len(pending_species)} species fetched in previous runs, {len(pending_species)} species to fetch.")
+    print('-'*40)
+    for species_name in pending_species:
+        records = fetch_species_records(species_name)
+        if records:
+            checkpoint.add(species_name, records) # written to disk immediately
+    # records of previous runs merged with new ones, records of species which are no longer in the input are dropped
+    for species_name in species_list:
+        records = checkpoint.get(species_name)
+        if records:
+            df_list.append(pd.DataFrame(records))
+    checkpoint.compact(species_list)
     return df_list
 
 
-# fetch the data and list of species, get a list of dataframes
-df_list = dopa_fetch_iucn(input_species_csv)
+# define a function to concatenate non-null, unique values with '|'
+def concatenate_unique_values(column):
+    return '|'.join(column.dropna().astype(str).unique()) # remove null values, convert to string, choose only unique values and concatenate with '|' separator
 
-# combine all dataframes into one
-combined_df = pd.concat(df_list, ignore_index=True, sort=False)
 
-# group the dataframe by 'id_no'
-grouped_df = combined_df.groupby('id_no')
+# to concatenate records of all species into one row for each IUCN ID
+def concatenate_iucn_data(df_list):
+    # combine all dataframes into one
+    combined_df = pd.concat(df_list, ignore_index=True, sort=False)
 
-# concatenate values for the rest of the columns
-concat_columns = combined_df.drop(columns = ['id_no']).columns.tolist() # create a list of all columns, excluding ID
+    # group the dataframe by 'id_no'
+    grouped_df = combined_df.groupby('id_no')
 
-# select only the columns that need to be concatenated
-df_columns_to_concat = grouped_df[concat_columns]
+    # concatenate values for the rest of the columns
+    concat_columns = combined_df.drop(columns = ['id_no']).columns.tolist() # create a list of all columns, excluding ID
 
-# define a function to concatenate non-null, unique values with '|'
-def concatenate_unique_values(column):
-    return '|'.join(column.dropna().astype(str).unique()) # remove null values, convert to string, choose only unique values and concatenate with '|' separator
-# apply the concatenation function to each column in the group
-concatenated_df = df_columns_to_concat.agg(concatenate_unique_values)
+    # select only the columns that need to be concatenated
+    df_columns_to_concat = grouped_df[concat_columns]
+
+    # apply the concatenation function to each column in the group
+    concatenated_df = df_columns_to_concat.agg(concatenate_unique_values)
+
+    # reset the index so that 'id_no' becomes a regular column again
+    return concatenated_df.reset_index()
+
+
+if __name__ == '__main__':
+    # open configuration files
+    with open('config.yaml', 'r') as file:
+        config = yaml.safe_load(file)
+
+    # paths from the config file
+    input_dir = config['input_dir']
+    output_dir = config['output_dir']
+
+    # input file from the config
+    input_species_csv = os.path.join(input_dir, config['input_species'])
+    output_iucn_csv = os.path.join(output_dir, config['iucn_csv'])
+
+    # Debug: Print paths
+    print(f"Path to the input CSV with scientific names: {input_species_csv}")
+    print(f"Path to the output CSV with IUCN data: {output_iucn_csv}")
+    print('-' * 40)
+
+    # checkpoint of IUCN records next to the output file (records expire as cached responses of GBIF API)
+    checkpoint = None
+    if config.get('lookup_incremental', True):
+        checkpoint = LookupCheckpoint(os.path.splitext(output_iucn_csv)[0] + '_checkpoint.jsonl', source='dopa_43', ttl_days=config.get('lookup_cache_ttl_days', 30))
+
+    # fetch the data and list of species, get a list of dataframes
+    df_list = dopa_fetch_iucn(input_species_csv, checkpoint=checkpoint)
+    if not df_list:
+        raise SystemExit(f"No IUCN data has been fetched for the species in {input_species_csv}")
 
-# reset the index so that 'id_no' becomes a regular column again
-df_final = concatenated_df.reset_index()
+    df_final = concatenate_iucn_data(df_list)
 
-# save the final dataframe to a new CSV file
-df_final.to_csv(output_iucn_csv, index=False, sep='|')
-print (f"Data from IUCN has been fetched and concatenated for the species in {input_species_csv}")
+    # save the final dataframe to a new CSV file
+    df_final.to_csv(output_iucn_csv, index=False, sep='|')
+    print (f"Data from IUCN has been fetched and concatenated for the species in {input_species_csv}")
 
 # TODO - to implement other scopes of IUCN assessment, continental and regional ones(not only global ones): https://www.iucnredlist.org/regions/european-red-list, https://www.iucnredlist.org/regions/mediterranean-red-lis
 
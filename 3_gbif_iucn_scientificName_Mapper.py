@@ -19,6 +19,8 @@ class GBIF_IUCN_ScientificName_Mapper:
         iucn_index = list(iucn_dict.keys())[0]
         # Renaming the columns to make them consistent for joining later.
         self.gbif_df = pd.read_csv(gbif_csv_path, sep=',').set_index(gbif_index)
+        # one row for every scientific name, so that the merge doesn't repeat IUCN records
+        self.gbif_df = self.gbif_df[~self.gbif_df.index.duplicated(keep='first')]
         self.iucn_df = pd.read_csv(iucn_csv_path, sep='|').set_index(iucn_index)
 
         # filtering out the columns we don't care about
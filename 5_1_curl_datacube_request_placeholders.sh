@@ -19,7 +19,7 @@
 # All inputs are mandatory
 
 ## OUTPUT (filename and path are specified by user in config_gbif.json file)
-# - list of all occurrence records for specified filters on taxons, years, countries and data issues, CSV (mandatory)
+# - list of all occurrence records for specified filters on taxons, years, countries and data issues, CSV within ZIP archive as downloaded (mandatory)
 # - metadata for the CSV output with DOI (which is scheduled to be erased), JSON (mandatory)
 # - (under development) licence metadata of all data sources comprising the first output (CSV mandatory). In the end, should be ingested into the JSON output (replace value for 'license' key).
 
@@ -214,29 +214,8 @@ if [[ "$download_code" != "null" ]]; then
     # move the .zip file to the output directory
     mv "$filename" "${output_dir_gbif}/${filename}"
 
-    # unzip the file
-    echo "Unzipping ${filename}..."
-    if unzip "${output_dir_gbif}/${filename}" -d "${output_dir_gbif}/temp_unzip"; then
-        echo "Unzipping completed."
-
-        # find the .csv file
-        csv_file=$(find "${output_dir_gbif}/temp_unzip" -type f -name "*.csv")
-
-        # extract the base name of the CSV file (without directory and extension)
-        base_csv_name=$(basename "$csv_file")
-
-        # rename csv file, adding the taxon key
-        mv "$csv_file" "${output_dir_gbif}/key_${taxonKey}_${base_csv_name}"
-
-        # remove the temporary directory
-        rm -r "${output_dir_gbif}/temp_unzip"
-
-        # delete the zip file after successful extraction
-        rm "${output_dir_gbif}/${filename}"
-        echo "Deleted the zip file."
-    else
-        echo "Unzipping failed. Zip file will not be deleted."
-    fi
+    # the zip file is not extracted - gridding block streams the datacube straight from the archive (one read of the compressed download, no extra disk usage)
+    echo "Zip file saved to ${output_dir_gbif}/${filename}"
 
     # to save metadata (anonymized?)
     curl -Ss "https://api.gbif.org/v1/occurrence/download/${download_code}" -o "${output_dir_gbif}/${filename%.zip}.json" #-S means show errors, but -s means silent mode
@@ -270,8 +249,8 @@ rm "prepared_request.json"
 # - * schannel: disabled automatic use of client certificate
 # * schannel: failed to decrypt data, need more data
 
-# use yq to update the filename of gbif datacube in the YAML file
-yq eval ".gbif_datacube_csv = \"${filename%.zip}.csv\"" -i config.yaml
+# use yq to update the filename of gbif datacube (zip archive) in the YAML file
+yq eval ".gbif_datacube_csv = \"${filename}\"" -i config.yaml
 
 # use yq to write the taxon key to the YAML file
 yq eval ".gbif_taxon_key = \"${taxonKey}\"" -i config.yaml
@@ -7,31 +7,35 @@ Format: GeoTIFF
 Mandatory: yes
 
 - GBIF occurrence datacube with unique records pre-extracted through GBIF occurrence data cube: https://techdocs.gbif.org/en/data-use/data-cubes.
-Format: CSV (dataset) and JSON (metadata)
+Format: ZIP archive as downloaded (SQL_TSV_ZIP) or extracted CSV (dataset) and JSON (metadata)
 Mandatory: yes
 
 OUTPUT
-- Regridded GBIF occurrence datacube inheriting the specifications of the input raster dataset, which has one band with the calculated occurrence count.
-Format: GeoTIFF
+- Regridded GBIF occurrence datacube inheriting the specifications of the input raster dataset, which has one band with the calculated occurrence count
+(or one band for each group of records, for example, each speciesKey, if 'gridding_group_by' is defined in config.yaml,
+or one band for each year or multi-year period of records - temporal datacube (time x y x x) - if 'gridding_temporal_window' is defined in config.yaml).
+Format: GeoTIFF (Cloud-Optimized GeoTIFF, tiled and compressed, with overviews by default)
 Mandatory: yes
 
 ISSUES
 - GBIF backbone taxonomy does not define Reptilia as a separate class (class with id=358 dedicated to Reptilia database). For the purposes of the case study, two Reptilia classes (Testudines, taxon key 11418114) and (Squamata, taxon key, 11592253) have been used.
 - For largest datasets (Aves class) the following issue faced (17739293 records): 
 "numpy.core._exceptions._ArrayMemoryError: Unable to allocate 812. MiB for an array with shape (6, 17739293) and data type object".
-It is solved by chunking and filtering out records outside of the bounding box.
+It is solved by chunking, filtering out records outside of the bounding box and adding counts of each chunk straight into the output array (processed records are not kept in memory).
 
 """
 
-import pandas as pd
 import numpy as np
-from osgeo import gdal, ogr, osr, gdalconst
-from pyproj import Transformer
+from osgeo import gdal
 import os
-import re
 import yaml
 import warnings
-import math
+from collections import deque
+
+# import the DatacubeReader class to read GBIF datacube in chunks straight from the ZIP archive (or from the Parquet cache)
+from datacube_proc import DatacubeReader, convert_datacube_to_parquet, resolve_column
+# import the MultiDatacubeReader class to merge several downloads of GBIF datacube without duplicates
+from datacube_proc import MultiDatacubeReader, find_datacubes
 
 # REDUNDANT - replaced with configuration file
 """
@@ -60,16 +64,114 @@ gbif_datacube_csv = config.get('gbif_datacube_csv')
 # load current taxon key(s) 
 taxon_key = config.get('gbif_taxon_key')
 
-# path to input raster dataset
-raster_path = os.path.join(input_dir, input_ds)
-raster_path = os.path.normpath(raster_path)
-
-# path to input GBIF datacube
-csv_path = os.path.join(output_dir_gbif, gbif_datacube_csv)
-csv_path = os.path.normpath(csv_path)
+# number of worker processes to grid chunks of the datacube in parallel (1 - serial mode) and number of rows in each chunk
+gridding_workers = int(config.get('gridding_workers', 1) or 1)
+gridding_chunk_size = int(config.get('gridding_chunk_size', 2000000))
+
+# column to group records by, so every group is written to a separate band of the output raster (for example, speciesKey, classKey, iucnRedListCategory, basisOfRecord)
+group_by = config.get('gridding_group_by') or None
+
+# length of time periods in years to bin occurrences by 'yearMonth' column into a temporal datacube (one band for each year or multi-year window)
+temporal_window = config.get('gridding_temporal_window') or None
+if temporal_window and group_by:
+    raise ValueError("Temporal gridding ('gridding_temporal_window') cannot be combined with 'gridding_group_by'. Please define only one of them in config.yaml.")
+temporal_window = int(temporal_window) if temporal_window else None
+
+# to keep only occupied pixels in memory instead of raster-shaped arrays of counts (for very large or fine-resolution rasters)
+gridding_sparse = config.get('gridding_sparse', False)
+
+# to cache coordinates transformed into the CRS of the input raster (memory-mapped files keyed by the datacube and the CRS), so next runs skip reprojection
+reprojection_cache_enabled = config.get('reprojection_cache', False)
+reprojection_cache_dir = config.get('reprojection_cache_dir', os.path.join(output_dir, 'reprojection_cache'))
+
+# factors to aggregate counts into coarser levels by exact summation of blocks of pixels (for example, [10, 100] for 1 km and 10 km from 100 m raster)
+pyramid_factors = [int(factor) for factor in (config.get('pyramid_factors') or [])]
+# to write coarser levels as separate aligned GeoTIFFs ('files') or as overviews of the output GeoTIFF ('overviews')
+pyramid_output = config.get('pyramid_output', 'files')
+if pyramid_output not in ('files', 'overviews'):
+    raise ValueError(f"Unknown 'pyramid_output': {pyramid_output}. Please define 'files' or 'overviews' in config.yaml.")
+
+# metrics of distinct values in every pixel written as additional bands in the same pass: 'richness' (distinct speciesKey),
+# 'threatened' (distinct speciesKey with iucnRedListCategory in threatened categories) and 'effort' (distinct yearMonth sampled)
+gridding_metrics = config.get('gridding_metrics') or []
+unknown_metrics = set(gridding_metrics) - {'richness', 'threatened', 'effort'}
+if unknown_metrics:
+    raise ValueError(f"Unknown 'gridding_metrics': {', '.join(sorted(unknown_metrics))}. Please define richness, threatened or effort in config.yaml.")
+threatened_categories = config.get('threatened_categories', ['CR', 'EN', 'VU'])
+
+# to count only occurrences in pixels whose land-cover class (of the first input raster) is a suitable habitat of the species (IUCN habitat codes from 2_dopa_get_species.py)
+habitat_filter = config.get('habitat_filter', False)
+# crosswalk table between land-cover classes and IUCN habitat codes (in input_dir)
+habitat_crosswalk = config.get('habitat_crosswalk', 'habitat_crosswalk.csv')
+# to read the band with land-cover classes into memory at once (otherwise, window by window)
+habitat_in_memory = config.get('habitat_in_memory', True)
+
+# to export spatially thinned occurrences (one record for each species in each pixel of the first input raster and, optionally, each period) in the same pass
+thinning = config.get('thinning', False)
+# period to thin occurrences by ('year' or 'yearMonth'), null - one record for each species and pixel over all periods
+thinning_period = config.get('thinning_period') or None
+if thinning_period not in (None, 'year', 'yearMonth'):
+    raise ValueError(f"Unknown 'thinning_period': {thinning_period}. Please define 'year', 'yearMonth' or null in config.yaml.")
+# format of thinned occurrences (csv or parquet)
+thinning_format = config.get('thinning_format', 'csv')
+
+# to smooth counts into the occurrence density surface (companion GeoTIFF) with Gaussian or exponential distance-decay kernel, convolved through FFT tile by tile
+density = config.get('density', False)
+density_kernel_type = config.get('density_kernel', 'gaussian')
+# bandwidth and radius of the kernel in units of the input raster CRS (for example, metres), radius is 3 (Gaussian) or 4 (exponential) bandwidths by default
+density_bandwidth = config.get('density_bandwidth', 1000)
+density_radius = config.get('density_radius') or None
+# to correct density near nodata pixels and edges of the raster (divided by the share of the kernel within valid pixels)
+density_edge_correction = config.get('density_edge_correction', False)
+
+# to aggregate occurrences and distinct species by classes of the (first) input raster dataset into a table (zonal statistics), in the same pass
+zonal_stats = config.get('zonal_stats', False)
+# format of the table with zonal statistics (csv or parquet) and whether the band with classes is read into memory at once (otherwise, window by window)
+zonal_stats_format = config.get('zonal_stats_format', 'csv')
+zonal_stats_in_memory = config.get('zonal_stats_in_memory', True)
+# vector layers with zones (protected areas, municipalities etc. in input_dir) to aggregate occurrences and distinct species by polygons
+zone_layers = config.get('zone_layers') or []
+
+# to export processed records (with transformed coordinates and pixel indices) to CSV - disabled by default to keep memory and disk usage low
+export_processed_records = config.get('export_processed_records', False)
+
+# list of input raster datasets - one or several target grids (for example, land-cover series or rasters at several resolutions), all of them are gridded in one pass over the datacube
+input_rasters = input_ds if isinstance(input_ds, list) else [input_ds]
+
+# paths to input raster datasets
+raster_paths = [os.path.normpath(os.path.join(input_dir, raster)) for raster in input_rasters]
+raster_path = raster_paths[0] # the first one (its pixel indices are exported with processed records)
+
+# to merge all downloads of GBIF datacube in output_dir_gbif (class and species downloads, Testudines and Squamata etc.) into one grid, instead of the datacube in gbif_datacube_csv
+datacube_merge = config.get('gbif_datacube_merge', False)
+
+# path to input GBIF datacube (or paths to all downloads if merged)
+if datacube_merge:
+    csv_paths = [os.path.normpath(path) for path in find_datacubes(output_dir_gbif, config.get('gbif_datacube_pattern', '*.zip'))]
+    if not csv_paths:
+        raise FileNotFoundError(f"No GBIF datacubes matching '{config.get('gbif_datacube_pattern', '*.zip')}' found in {output_dir_gbif}.")
+    # base name of the merged datacube for output files
+    gbif_datacube_base = config.get('gbif_datacube_merged_name', 'merged_datacube')
+else:
+    csv_paths = [os.path.normpath(os.path.join(output_dir_gbif, gbif_datacube_csv))]
+    # base name of the datacube (it might be either the downloaded ZIP archive or the extracted CSV file)
+    gbif_datacube_base = os.path.splitext(gbif_datacube_csv)[0]
+
+# to convert the datacube into the typed and partitioned Parquet cache once and read only the required columns from it in the next runs
+datacube_parquet = config.get('datacube_parquet', False)
+if datacube_parquet:
+    for path_num, datacube_path in enumerate(csv_paths):
+        parquet_path = os.path.splitext(datacube_path)[0] + '.parquet'
+        if not os.path.exists(parquet_path):
+            print(f"Converting GBIF datacube into the Parquet cache {parquet_path} (one-time conversion)...")
+            convert_datacube_to_parquet(datacube_path, parquet_path, partition_cols=config.get('datacube_parquet_partition', ['classKey']), chunksize=gridding_chunk_size)
+        else:
+            print(f"Reading GBIF datacube from the Parquet cache {parquet_path}.")
+        csv_paths[path_num] = parquet_path
+csv_path = csv_paths[0] if len(csv_paths) == 1 else csv_paths
 
 # path to transformed datacube
-output_csv_path = os.path.join(output_dir, gbif_datacube_csv)
+output_csv_path = os.path.join(output_dir, gbif_datacube_base + '.csv')
 output_csv_path = os.path.normpath(output_csv_path) 
 
 # create output directory if doesn't exist
@@ -77,9 +179,24 @@ if not os.path.exists(output_dir):
     os.makedirs(output_dir)
 
 # for exporting GBIF datacube to a new GeoTIFF file - output filename is the same as input dataset
-gbif_datacube_tif = gbif_datacube_csv.replace('.csv', '.tif') # replace the extension
+gbif_datacube_tif = gbif_datacube_base + '.tif' # replace the extension
 output_raster_path = os.path.join(output_dir, gbif_datacube_tif)
 
+# for several input rasters the name of each input raster is added to the output filename
+def get_output_raster_path(raster_path):
+    if len(raster_paths) == 1:
+        return output_raster_path
+    raster_base = os.path.splitext(os.path.basename(raster_path))[0]
+    return os.path.join(output_dir, f"{gbif_datacube_base}_{raster_base}.tif")
+
+# function to define values to group records of the chunk by (None - all records are counted together)
+def chunk_group_values(chunk):
+    if temporal_window:
+        return temporal_periods(chunk[resolve_column(chunk.columns, 'yearMonth')].values, temporal_window)
+    if group_by:
+        return chunk[resolve_column(chunk.columns, group_by)].values
+    return None
+
 # for exporting GBIF datacube to a new band of input dataset - name from the base_name and extension
 """
 # extract the base name (without extension) and the file extension
@@ -91,13 +208,19 @@ output_raster = output_raster_pattern.format(input_raster_base=input_raster_base
 """
 
 # debug: print the paths
-print(f"Input raster: {raster_path}")
-print(f"Input GBIF datacube: {csv_path}")
-print(f"Output raster: {output_raster_path}")
+for path in raster_paths:
+    print(f"Input raster: {path}")
+    print(f"Output raster: {get_output_raster_path(path)}")
+for datacube_path in csv_paths:
+    print(f"Input GBIF datacube: {datacube_path}")
 print(f"Current GBIF taxon key(s):{taxon_key}")
+if group_by:
+    print(f"Occurrences are grouped by '{group_by}' into separate bands.")
+if temporal_window:
+    print(f"Occurrences are binned into time periods of {temporal_window} year(s) as separate bands.")
 print("-" * 40)
 
-# TODO - to loop over a list of classes and create a separate geotiff for each of them
+# to loop over a list of classes (or species) - instead of separate GeoTIFFs, all of them are written as separate bands of one GeoTIFF (see 'gridding_group_by' in config.yaml)
 
 """
 issue with classKey=212:
@@ -113,103 +236,325 @@ output_filename = input_filename[:year_pos] + 'gbif_' + input_filename[year_pos:
 new_raster_path = os.path.join(output_dir, output_filename)  # output raster
 """
 
-# function to calculate pixel indices
-def calculate_pixel_indices(x_cart, y_cart):
-    # calculate pixel indices
-    pixel_col = int((x_cart - raster_geo[0]) / raster_geo[1])  # column index
-    pixel_row = int((y_cart - raster_geo[3]) / raster_geo[5])  # row index
-    return pixel_row, pixel_col
-
-# function to check if point is within raster extent
-def point_within_raster_extent(x_cart, y_cart):
-    return (minx <= x_cart <= maxx) and (miny <= y_cart <= maxy)
-
 ## RASTER AND COORDINATES PREPARATION
 
 # import the RasterTransform class from the reprojection module
 from raster_proc import RasterTransform  # this imports RasterTransform class
+# import the CountRasterWriter class to write tiled and compressed output
+from raster_writer import CountRasterWriter, level_template
+# import the RasterGrid class to calculate extent mask and pixel indices for the whole chunk at once
+from gridding_proc import RasterGrid, CountAccumulator, GroupedCountAccumulator, parallel_count_chunks, fork_available
+from gridding_proc import temporal_periods, describe_period
+from gridding_proc import ReprojectionCache, GriddingTarget, targets_by_crs, count_chunk, transform_coordinates
+from gridding_proc import DistinctCountAccumulator
+# import classes to aggregate occurrences by zones (classes of the input raster dataset)
+from zonal_proc import RasterZoneLookup, ZonalAccumulator, rasterize_zones
+# import the HabitatSuitability class to filter occurrences by suitable habitats of species
+from habitat_proc import HabitatSuitability
+# import classes to thin occurrences and to write them chunk by chunk
+from thinning_proc import SpatialThinner, RecordWriter
+# import methods to smooth counts into the density surface
+from density_proc import DensitySurface, density_kernel
 
-# check the cartesian/projected CRS
-print("Checking the coordinate reference system of input raster dataset...")
-is_cart, epsg_code = RasterTransform(raster_path).check_cart_crs()
+csv_crs = 'EPSG:4326' # default, because GBIF occurrence datacube always has this EPSG
 
-# check the resolution
-print("Checking the spatial resolution of input raster dataset...")
-xres, yres = RasterTransform(raster_path).check_res()
+# function to create streaming accumulator of pixel counts (each chunk is added straight into the raster-shaped array), one array for each group if grouped
+# for very large or fine-resolution rasters only occupied pixels are kept (sparse backend), dense tiles are built only when writing the output
+def create_accumulator(shape):
+    if temporal_window:
+        return GroupedCountAccumulator(shape, 'period', describe=describe_period(temporal_window), sparse=gridding_sparse)
+    if group_by:
+        return GroupedCountAccumulator(shape, group_by, sparse=gridding_sparse)
+    return CountAccumulator(shape, sparse=gridding_sparse)
+
+# descriptions of bands with distinct counts
+metric_descriptions = {
+    'richness': 'species richness',
+    'threatened': f"threatened species richness ({', '.join(threatened_categories)})",
+    'effort': 'distinct year-months sampled',
+}
+
+# function to define values to count distinct in every pixel for the chunk (None if no metrics are requested)
+def chunk_distinct_values(chunk):
+    if not gridding_metrics:
+        return None
+    distinct_values = {}
+    if 'richness' in gridding_metrics or 'threatened' in gridding_metrics:
+        species = chunk[resolve_column(chunk.columns, 'speciesKey')]
+    if 'richness' in gridding_metrics:
+        distinct_values['richness'] = species.values
+    if 'threatened' in gridding_metrics:
+        # species keys of records in other categories are masked, so they are not counted
+        categories = chunk[resolve_column(chunk.columns, 'iucnRedListCategory')].astype(str)
+        distinct_values['threatened'] = species.where(categories.isin(threatened_categories)).values
+    if 'effort' in gridding_metrics:
+        distinct_values['effort'] = chunk[resolve_column(chunk.columns, 'yearMonth')].values
+    return distinct_values
+
+# function to add partial counts and distinct pairs of the chunk to accumulators of every target
+def add_target_partials(partials, chunk_false_counts, distinct_partials):
+    for target, partial, chunk_false_count, distinct_partial in zip(targets, partials, chunk_false_counts, distinct_partials):
+        target.accumulator.add_partial(partial)
+        target.false_count += chunk_false_count
+        for metric, (pixels, values) in distinct_partial.items():
+            target.distinct_accumulators[metric].add_pairs(pixels, values)
+
+# prepare every input raster dataset as a target grid
+targets = []
+for target_raster_path in raster_paths:
+    # check the cartesian/projected CRS
+    print(f"Checking the coordinate reference system of input raster dataset {target_raster_path}...")
+    is_cart, epsg_code = RasterTransform(target_raster_path).check_cart_crs()
+
+    # check the resolution
+    print("Checking the spatial resolution of input raster dataset...")
+    xres, yres = RasterTransform(target_raster_path).check_res()
+
+    # define EPSG codes for WGS84 and the raster dataset (in case of Catalonia - UTM zone 31N, EPSG:25831)
+    raster_crs = epsg_code
+
+    # open raster to get its extent
+    raster_ds = gdal.Open(target_raster_path)
+
+    # define the grid of the input raster dataset to bin occurrences into its pixels
+    raster_grid = RasterGrid.from_dataset(raster_ds)
+
+    # calculate raster extent
+    minx, miny, maxx, maxy = raster_grid.extent
+
+    # print raster extent for debugging
+    print("The spatial extent of the input raster dataset:", (minx, miny, maxx, maxy))
+
+    # transform coordinates if the EPSG code is not 4326 (doesn't match to CRS of GBIF datacube) - EPSG code is returned as a string, so it is compared as a string
+    if str(epsg_code) != '4326':
+        print(f"The input raster dataset has EPSG code:{epsg_code}, which is different from the projection of GBIF occurrence datacube.")
+    else:
+        # fast path: lat/lon are binned directly against the geotransform, without any pyproj call
+        print("The input raster dataset has EPSG:4326. No need to transform coordinates of GBIF occurrences.")
+    print("-" * 40)
+
+    target = GriddingTarget(os.path.basename(target_raster_path), raster_grid, raster_crs, create_accumulator(raster_grid.shape), get_output_raster_path(target_raster_path), raster_ds)
+    for metric in gridding_metrics:
+        target.distinct_accumulators[metric] = DistinctCountAccumulator(raster_grid.shape, metric_descriptions[metric])
+    targets.append(target)
+
+# grids and CRS of all targets (sent to workers in parallel mode)
+target_specs = [target.spec for target in targets]
+primary_target = targets[0]
+# CRS code of the first target (its transformed coordinates are exported with processed records)
+primary_crs_code = next(crs_code for crs_code, target_nums in targets_by_crs(target_specs).items() if 0 in target_nums)
+if len(targets) > 1:
+    print(f"{len(targets)} input raster datasets are gridded in one pass, coordinates are transformed once for each of {len(targets_by_crs(target_specs))} distinct CRS.")
+
+# reprojection cache for each distinct CRS, it is only needed if coordinates are transformed
+reprojection_caches = {}
+if reprojection_cache_enabled:
+    for crs_code, target_nums in targets_by_crs(target_specs).items():
+        if crs_code == '4326':
+            continue
+        reprojection_cache = ReprojectionCache(reprojection_cache_dir, csv_path, targets[target_nums[0]].raster_crs)
+        if reprojection_cache.complete:
+            print(f"Transformed coordinates (EPSG:{crs_code}) of {reprojection_cache.total_rows} records are read from the reprojection cache, no reprojection needed.")
+        else:
+            print(f"Transformed coordinates (EPSG:{crs_code}) will be written to the reprojection cache in {reprojection_cache_dir}.")
+        reprojection_caches[crs_code] = reprojection_cache
+# caches to read coordinates from and caches to be built in this run
+cached_crs = {crs_code: cache for crs_code, cache in reprojection_caches.items() if cache.complete}
+building_crs = {crs_code: cache for crs_code, cache in reprojection_caches.items() if not cache.complete}
+
+# zonal statistics by classes of the first input raster dataset (for example, land-cover classes of ict_2022.tif)
+zonal_aggregations = []
+if zonal_stats:
+    zonal_output_path = os.path.join(output_dir, f"{gbif_datacube_base}_zonal_{os.path.splitext(primary_target.name)[0]}.{zonal_stats_format}")
+    zonal_aggregations.append((primary_target.grid, primary_crs_code, [RasterZoneLookup(primary_target.raster_ds, in_memory=zonal_stats_in_memory)], ZonalAccumulator('class'), zonal_output_path, None))
+    print(f"Occurrences and distinct species will be aggregated by classes of {primary_target.name} into {zonal_output_path}.")
+
+# zonal statistics by polygons - zones are rasterized onto the grid of the first input raster dataset once (instead of point-in-polygon test for every record)
+for zone_layer in zone_layers:
+    zones_path = os.path.normpath(os.path.join(input_dir, zone_layer['path']))
+    print(f"Rasterizing zones from {zones_path} onto the grid of {primary_target.name}...")
+    zones_ds, zone_names = rasterize_zones(zones_path, primary_target.raster_ds, name_field=zone_layer.get('name_field'), layer_name=zone_layer.get('layer'), all_touched=zone_layer.get('all_touched', False))
+    zonal_output_path = os.path.join(output_dir, f"{gbif_datacube_base}_zones_{os.path.splitext(os.path.basename(zones_path))[0]}.{zonal_stats_format}")
+    # overlapping zones are rasterized into separate bands, every band is looked up
+    zone_lookups = [RasterZoneLookup(zones_ds, band_num) for band_num in range(1, zones_ds.RasterCount + 1)]
+    zonal_aggregations.append((primary_target.grid, primary_crs_code, zone_lookups, ZonalAccumulator('zone_id'), zonal_output_path, zone_names))
+    print(f"{len(zone_names)} zone(s) rasterized into {zones_ds.RasterCount} band(s) of non-overlapping zones, occurrences and distinct species will be aggregated into {zonal_output_path}.")
+
+# function to add occurrences of the chunk to zonal statistics (zone of every occurrence is looked up for the whole chunk at once)
+# occurrences in overlapping zones are added to each of them (one band for each group of non-overlapping zones)
+def add_zonal_stats(xy, species):
+    for grid, crs_code, zone_lookups, zonal_accumulator, _, _ in zonal_aggregations:
+        inside, pixel_rows, pixel_cols = grid.bin_points(*xy[crs_code])
+        for zone_lookup in zone_lookups:
+            zones = zone_lookup.lookup(pixel_rows, pixel_cols)
+            valid = zone_lookup.valid(zones) # occurrences in nodata pixels are excluded
+            zonal_accumulator.add(zones[valid], species[inside][valid] if species is not None else None)
+
+# function to define species keys of the chunk for zonal statistics (None if they are not needed)
+def chunk_species(chunk):
+    if not zonal_aggregations:
+        return None
+    return chunk[resolve_column(chunk.columns, 'speciesKey')].values
+
+# function to read transformed coordinates of the chunk from the reprojection caches
+def cached_coordinates(offset, n_rows):
+    return {crs_code: cache.read(offset, n_rows) for crs_code, cache in cached_crs.items()}
+
+# lookup matrix of suitable habitats (species x land-cover class) built once, classes are looked up in the first input raster dataset
+habitat_suitability = None
+if habitat_filter:
+    iucn_csv_path = os.path.join(output_dir, config.get('iucn_csv'))
+    gbif_key_csv_path = os.path.join(output_dir, config.get('gbif_key_csv'))
+    habitat_crosswalk_path = os.path.join(input_dir, habitat_crosswalk)
+    habitat_suitability = HabitatSuitability.from_files(iucn_csv_path, gbif_key_csv_path, habitat_crosswalk_path)
+    habitat_lookup = RasterZoneLookup(primary_target.raster_ds, in_memory=habitat_in_memory)
+    print(f"Occurrences are counted only in suitable habitats: {len(habitat_suitability.species_index)} species with IUCN habitat codes, {len(habitat_suitability.class_index)} land-cover classes in {habitat_crosswalk_path}.")
+    print("-" * 40)
+# number of occurrences excluded as not in suitable habitats
+habitat_excluded = 0
+
+# function to read transformed coordinates of the chunk and (in habitat mode) to keep only occurrences in suitable habitats
+# in habitat mode coordinates are transformed in the main process, so the reprojection caches are appended here (before records are filtered)
+def prepare_chunk(chunk, offset):
+    global habitat_excluded
+    xy = cached_coordinates(offset, len(chunk))
+    if habitat_suitability is None:
+        return chunk, xy
+    for crs_code in [primary_crs_code] + list(building_crs):
+        if crs_code not in xy:
+            xy[crs_code] = transform_coordinates(chunk['lat'].values, chunk['lon'].values, targets[targets_by_crs(target_specs)[crs_code][0]].raster_crs)
+    for crs_code, reprojection_cache in building_crs.items():
+        reprojection_cache.append(*xy[crs_code])
+    inside, pixel_rows, pixel_cols = primary_target.grid.bin_points(*xy[primary_crs_code])
+    suitable = np.zeros(len(chunk), dtype=bool)
+    species = chunk[resolve_column(chunk.columns, 'speciesKey')].values
+    suitable[inside] = habitat_suitability.suitable(species[inside], habitat_lookup.lookup(pixel_rows, pixel_cols))
+    habitat_excluded += int(np.count_nonzero(~suitable))
+    return chunk[suitable], {crs_code: (x_cart[suitable], y_cart[suitable]) for crs_code, (x_cart, y_cart) in xy.items()}
+
+# spatial thinning of occurrences by pixels of the first input raster dataset
+if thinning:
+    thinning_output_path = os.path.join(output_dir, f"{gbif_datacube_base}_thinned.{thinning_format}")
+    spatial_thinner = SpatialThinner()
+    thinned_writer = RecordWriter(thinning_output_path)
+    print(f"Spatially thinned occurrences (one per species, pixel{' and ' + thinning_period if thinning_period else ''}) will be exported to {thinning_output_path}.")
+
+# function to keep only the first record of every species in every pixel (and period) and to append them to the output
+def add_thinned_records(chunk, xy):
+    chunk = chunk.copy()
+    chunk['x_cart'], chunk['y_cart'] = xy[primary_crs_code]
+    inside, pixel_rows, pixel_cols = primary_target.grid.bin_points(chunk['x_cart'].values, chunk['y_cart'].values)
+    chunk = chunk[inside]
+    chunk['pixel_row'] = pixel_rows
+    chunk['pixel_col'] = pixel_cols
+    periods = None
+    if thinning_period:
+        periods = chunk[resolve_column(chunk.columns, 'yearMonth')].astype(str)
+        periods = periods.str[:4].values if thinning_period == 'year' else periods.values
+    keep = spatial_thinner.thin(chunk[resolve_column(chunk.columns, 'speciesKey')].values, primary_target.grid.flat_indices(pixel_rows, pixel_cols), periods)
+    thinned_writer.write(chunk[keep])
+
+# reprojection caches appended with coordinates returned by count_chunk (in habitat mode they are appended in prepare_chunk)
+worker_building_crs = building_crs if habitat_suitability is None else {}
+
+# previous version to define dataframe without chunks
+"""
+# read CSV file with the correct delimiter for SQL TSV ZIP
+df = pd.read_csv(csv_path, delimiter='\t')
+print(f"Processing the following dataset: \n{df.head()}")
+"""
 
-# define EPSG codes for WGS84 and UTM zone 31N (EPSG:25831)
-csv_crs = 'EPSG:4326' # default, because GBIF occurrence datacube always has this EPSG
-raster_crs = epsg_code
-
-# function to transform coordinates (in case of Catalonia from EPSG:4326 to EPSG:25831)
-def transform_coordinates(lat_array, lon_array):
-    transformer = Transformer.from_crs(csv_crs, raster_crs, always_xy=True)
-    x, y = transformer.transform(lon_array, lat_array)
-    return x, y
-
-# open raster to get its extent
-raster_ds = gdal.Open(raster_path)
-raster_geo = raster_ds.GetGeoTransform()
-raster_band = raster_ds.GetRasterBand(1)
-nodata_value = raster_band.GetNoDataValue()  # extract nodata value
-    
-# calculate raster extent
-minx, miny, maxx, maxy = (
-    raster_geo[0],  # minx
-    raster_geo[3] + raster_geo[5] * raster_ds.RasterYSize,  # miny
-    raster_geo[0] + raster_geo[1] * raster_ds.RasterXSize,  # maxx
-    raster_geo[3]  # maxy
-)
-    
-# print raster extent for debugging
-print("The spatial extent of the input raster dataset:", (minx, miny, maxx, maxy))
-
-# transform coordinates if the EPSG code is not 4326 (doesn't match to CRS of GBIF datacube)
-if epsg_code != 4326:
-    print(f"The input raster dataset has EPSG code:{epsg_code}, which is different from the projection of GBIF occurrence datacube.")
-    
-    # previous version to define dataframe without chunks
-    """
-    # read CSV file with the correct delimiter for SQL TSV ZIP
-    df = pd.read_csv(csv_path, delimiter='\t')
-    print(f"Processing the following dataset: \n{df.head()}")
-    """
-
-    # debug
-    """
-    # count total records
-    df = pd.read_csv(csv_path, delimiter='\t')
-    total_records_1 = len(df)
-    print (f"Total records: {total_records_1}")
-    """
-
-    # to create empty dataframe to store the processed results
-    processed_df = pd.DataFrame()
-    # to create empty dataframe to store pixel counts
-    pixel_counts_df = pd.DataFrame()
-
-    # to read dataframe in chunks
-    # chunk the dataframe
-    n = 2000000 # chunk row size
-    df_chunks = pd.read_csv(csv_path, delimiter='\t', chunksize=n)
-
-    # find out the total number of rows in the CSV file
-    total_rows = sum(1 for _ in open(csv_path)) - 1  # subtract 1 for header
-    total_chunks = math.ceil(total_rows / n) # round up to the largest whole number
-
-    # initialise a counter of 'False' values in 'bbox' column
-    false_count = 0 
-
-    # initialize total number of records in dataframe
-    total_records = 0
-
-    ## process each chunk
-    # initialise chunk number
-    chunk_num = 1
+# debug
+"""
+# count total records
+df = pd.read_csv(csv_path, delimiter='\t')
+total_records_1 = len(df)
+print (f"Total records: {total_records_1}")
+"""
+
+# processed records are written only on demand, chunk by chunk (not kept in memory)
+if export_processed_records:
+    print(f"Processed records will be exported to {output_csv_path}.")
+    if os.path.exists(output_csv_path):
+        os.remove(output_csv_path) # to avoid appending to the output of previous run
+
+# to read dataframe in chunks
+# chunk the dataframe
+n = gridding_chunk_size # chunk row size
+# only coordinates are parsed unless processed records should be exported
+usecols = None
+# all columns are read if processed or thinned records are exported
+if not export_processed_records and not thinning:
+    usecols = ['lat', 'lon'] + ([group_by] if group_by else [])
+    if temporal_window or 'effort' in gridding_metrics:
+        usecols.append('yearMonth')
+    if zonal_aggregations or habitat_filter or 'richness' in gridding_metrics or 'threatened' in gridding_metrics:
+        usecols.append('speciesKey')
+    if 'threatened' in gridding_metrics:
+        usecols.append('iucnRedListCategory')
+    usecols = list(dict.fromkeys(usecols)) # without duplicates (for example, speciesKey used for grouping)
+# stream the datacube straight from the downloaded ZIP archive (or extracted CSV) - progress is reported from bytes consumed, so no need to count rows beforehand
+if datacube_merge:
+    # downloads are read concurrently, records repeated in several downloads are dropped by hashes of GROUP BY columns
+    df_chunks = MultiDatacubeReader(
+        csv_paths, chunksize=n, usecols=usecols,
+        deduplicate=config.get('gbif_datacube_deduplicate', True),
+        read_workers=config.get('datacube_read_workers', 4),
+    )
+else:
+    df_chunks = DatacubeReader(csv_path, chunksize=n, usecols=usecols)
+
+# initialize total number of records in dataframe
+total_records = 0
+
+# check if chunks can be processed in parallel
+use_parallel = gridding_workers > 1
+if use_parallel and export_processed_records:
+    warnings.warn("Processed records cannot be exported in parallel mode. Chunks will be processed one by one.")
+    use_parallel = False
+if use_parallel and not fork_available():
+    warnings.warn("Parallel gridding requires forking of processes, which is not available on this platform. Chunks will be processed one by one.")
+    use_parallel = False
+
+## process each chunk
+# initialise chunk number
+chunk_num = 1
+if use_parallel:
+    print(f"Processing chunks in parallel with {gridding_workers} worker processes...")
+    # only coordinates (and group-by column) are sent to workers, each of them returns partial counts of pixels of every target for its chunk
+    # submitted chunks are kept in the main process in the same order (only if records are needed after binning, for zonal statistics or thinning)
+    keep_chunks = bool(zonal_aggregations or thinning)
+    pending_chunks = deque()
+    def lat_lon_chunks():
+        global total_records
+        for chunk in df_chunks:
+            # records are counted before they are filtered by habitats
+            chunk_offset = total_records
+            total_records += len(chunk)
+            chunk, xy = prepare_chunk(chunk, chunk_offset)
+            pending_chunks.append(chunk if keep_chunks else None)
+            # transformed coordinates from the reprojection caches are sent as well (they are not transformed again)
+            yield chunk['lat'].values, chunk['lon'].values, chunk_group_values(chunk), xy, chunk_distinct_values(chunk)
+
+    for partials, chunk_false_counts, _, xy, distinct_partials in parallel_count_chunks(lat_lon_chunks(), target_specs, gridding_workers, return_xy=bool(worker_building_crs or keep_chunks)):
+        # print progress
+        print(f"Processed chunk {chunk_num} ({df_chunks.progress:.1%} of the datacube read)...")
+        # reduce partial counts into the overall counts of rows in each pixel (integer sums, so the output is identical to the serial mode)
+        add_target_partials(partials, chunk_false_counts, distinct_partials)
+        # chunks are returned in order, so transformed coordinates are appended to the cache in the same order as records
+        for crs_code, reprojection_cache in worker_building_crs.items():
+            reprojection_cache.append(*xy[crs_code])
+        chunk = pending_chunks.popleft()
+        if zonal_aggregations:
+            add_zonal_stats(xy, chunk_species(chunk))
+        if thinning:
+            add_thinned_records(chunk, xy)
+        chunk_num += 1
+else:
     for chunk in df_chunks:
         # print progress
-        print(f"Processing chunk {chunk_num} out of {total_chunks}...")
-    
+        print(f"Processing chunk {chunk_num} ({df_chunks.progress:.1%} of the datacube read)...")
+
         """
         print(chunk.head())  # debug: printing chunk
         """
@@ -219,66 +564,92 @@ if epsg_code != 4326:
         # update the total number of records (increment)
         total_records += chunk_records
 
-        # apply the function to each row in the dataframe to get transformed coordinates
-        print("Proceeding with coordinate transformation...")
-        chunk['x_cart'], chunk['y_cart'] = transform_coordinates(chunk['lat'].values, chunk['lon'].values)
-        print("Coordinates have been converted")
+        # read transformed coordinates from the reprojection caches and keep only occurrences in suitable habitats (in habitat mode)
+        chunk, cached_xy = prepare_chunk(chunk, total_records - chunk_records)
+
+        # transform coordinates once for each distinct CRS (or read them from the reprojection cache), check the extent
+        # and calculate pixel indices of every target for the whole chunk at once
+        print("Proceeding with coordinate transformation and binning...")
+        partials, chunk_false_counts, _, xy, distinct_partials = count_chunk(
+            chunk['lat'].values, chunk['lon'].values, target_specs, chunk_group_values(chunk),
+            cached_xy, return_xy=True, distinct_values=chunk_distinct_values(chunk)
+        )
         """print(f"Converted coordinates saved to {output_csv_path}.")"""
 
-        """
-        # debug:
-        print(df[['x_cart', 'y_cart']].head())
-        """
-    
-        # initialize the 'bbox' boolean column with False
-        chunk['bbox'] = False
-    
-        # iterate through each row and update the 'bbox' column
-        for index, row in chunk.iterrows():
-            chunk.at[index, 'bbox'] = point_within_raster_extent(row['x_cart'], row['y_cart'])
-            if chunk.at[index, 'bbox'] == False:
-                false_count += 1
-                warnings.warn("Occurrence record(s) found outside of the bounding box of input raster dataset!")
-
-        # filter rows where bbox is True
-        bbox_true_df = chunk[chunk['bbox']]
-
-        # initialize 'pixel_row' and 'pixel_col' columns
-        bbox_true_df.loc[:, 'pixel_row'] = None # use .loc to set values to avoid the SettingWithCopyWarning (unpredictable behaviour)
-        bbox_true_df.loc[:, 'pixel_col'] = None
-
-        # assign pixel indices based on transformed coordinates for rows where bbox is True
-        for index, row in bbox_true_df.iterrows(): # or ['bbox' = 'True']
-            pixel_row, pixel_col = calculate_pixel_indices(row['x_cart'], row['y_cart'])
-            bbox_true_df.at[index, 'pixel_row'] = pixel_row
-            bbox_true_df.at[index, 'pixel_col'] = pixel_col
-
-        # update the chunk with the pixel row and column values
-        chunk.update(bbox_true_df)
-
-        # append the processed chunk to the results DataFrame
-        processed_df = pd.concat([processed_df, chunk], ignore_index=True)
-
-        # calculate pixel counts for the current chunk 
-        pixel_counts_chunk = bbox_true_df.groupby(['pixel_row', 'pixel_col']).size()
-        # update the overall counts of rows in each pixel
-        pixel_counts_df = pd.concat([pixel_counts_df, pixel_counts_chunk], axis=0, sort=False)
+        # add pixel counts of the current chunk to the overall counts of rows in each pixel (of each group) of every target
+        # (records outside of the bounding box are counted, warning is raised once for all of them after processing)
+        add_target_partials(partials, chunk_false_counts, distinct_partials)
+
+        # append transformed coordinates to the reprojection caches being built
+        for crs_code, reprojection_cache in worker_building_crs.items():
+            reprojection_cache.append(*xy[crs_code])
+
+        # add occurrences of the chunk to zonal statistics
+        if zonal_aggregations:
+            add_zonal_stats(xy, chunk_species(chunk))
+
+        # append spatially thinned occurrences of the chunk
+        if thinning:
+            add_thinned_records(chunk, xy)
+
+        # append the processed chunk to the output CSV file (only if requested in the configuration file)
+        if export_processed_records:
+            # transformed coordinates and pixel indices of the first input raster
+            chunk['x_cart'], chunk['y_cart'] = xy[primary_crs_code]
+            inside, pixel_rows, pixel_cols = primary_target.grid.bin_points(chunk['x_cart'].values, chunk['y_cart'].values)
+            chunk['bbox'] = inside
+
+            # filter rows where bbox is True
+            bbox_true_df = chunk[chunk['bbox']].copy()
+
+            # assign pixel indices based on transformed coordinates for rows where bbox is True
+            bbox_true_df['pixel_row'] = pixel_rows
+            bbox_true_df['pixel_col'] = pixel_cols
+            bbox_true_df.to_csv(output_csv_path, mode='a', header=(chunk_num == 1), index=False)
 
         # increment chunk number
         chunk_num += 1
 
-    # calculate the share of records outside of the bounding box (for Catalonia bbox it is okay - we are fetching the datacube from Spain)
-    false_share = false_count/total_records
-    print(f"The share of records outside of the bounding box is {false_share:.2%}.")
+# mark the reprojection caches as complete once all records have been transformed
+for reprojection_cache in building_crs.values():
+    reprojection_cache.finish(total_records)
+for reprojection_cache in cached_crs.values():
+    if total_records != reprojection_cache.total_rows:
+        warnings.warn("Number of records in the datacube differs from the reprojection cache. Please delete the cache and run again.")
+
+# report records repeated in several downloads
+if datacube_merge:
+    print(f"{len(csv_paths)} GBIF datacube(s) merged, {df_chunks.duplicates} duplicated record(s) dropped.")
+
+# close the output with thinned occurrences
+if thinning:
+    thinned_writer.close()
+    print(f"{spatial_thinner.total} spatially thinned occurrence record(s) of {total_records} have been exported to {thinning_output_path}.")
+
+# report occurrences excluded by habitats (records outside of the first input raster are excluded as well)
+if habitat_suitability is not None:
+    print(f"{habitat_excluded} of {total_records} occurrence record(s) are not in suitable habitats and have been excluded.")
+
+# calculate the share of records outside of the bounding box (for Catalonia bbox it is okay - we are fetching the datacube from Spain)
+for target in targets:
+    false_share = target.false_count/total_records
+    if target.false_count > 0:
+        warnings.warn(f"{target.false_count} occurrence record(s) found outside of the bounding box of input raster dataset {target.name}!")
+    print(f"The share of records outside of the bounding box of {target.name} is {false_share:.2%}.")
+print("-"*40)
+
+# write tables of zonal statistics
+for _, _, _, zonal_accumulator, zonal_output_path, zone_names in zonal_aggregations:
+    zonal_table = zonal_accumulator.write(zonal_output_path, zone_names)
+    # occurrences in overlapping zones are counted in each of them
+    print(f"Zonal statistics of {zonal_accumulator.total} occurrence record(s) by zone in {len(zonal_table)} zone(s) have been written to {zonal_output_path}.")
     print("-"*40)
 
-    # debug: check the reprojected coordinates
-    """
-    print(df[['x_cart', 'y_cart', 'bbox']].head())
-    """
+# debug: check the reprojected coordinates
+"""
+print(df[['x_cart', 'y_cart', 'bbox']].head())
+"""
 
-else:
-    print("The input raster dataset has EPSG:4326. No need to transform coordinates of GBIF occurrences.")
 
 # debug: print headers
 """
@@ -302,56 +673,49 @@ print(f"Indexed data saved to {output_csv_path}.")
 pixel_counts = df[df['bbox']].groupby(['pixel_row', 'pixel_col']).size()
 """
 
-# create output GeoTIFF dataset for writing with a single band (for pixel counts)
-driver = gdal.GetDriverByName('GTiff')
-output_raster = driver.Create(output_raster_path, raster_ds.RasterXSize, raster_ds.RasterYSize, 1, gdal.GDT_Int16)  # create new raster with 1 band
-
-# check if the output raster was created successfully
-if output_raster_path is None:
-    raise Exception(f"Failed to create output raster file: {output_raster_path}")
-
-# set the projection to the CRS of the input raster dataset
-srs = osr.SpatialReference()
-srs.ImportFromEPSG(int(epsg_code)) # explicitly cast epsg code to integer, otherwise might cause issue
-output_raster.SetProjection(srs.ExportToWkt())
-
-# set the GeoTransform to match the original raster
-output_raster.SetGeoTransform(raster_geo)
-
-# get the array with counts (only one band needed now)
-counts_array = np.zeros((raster_ds.RasterYSize, raster_ds.RasterXSize), dtype=np.int32)
-
-# debug: to print for understanding the type of output dataframe (should be tuple)
-"""
-print(type(pixel_counts_df))
-print(pixel_counts_df.head())
-"""
-
-# populate counts_array with pixel counts
-for (row, col), count in pixel_counts_df.itertuples():
-    # ensure row and col are integers
-    row = int(row)
-    col = int(col)
-    # assign count to counts_array
-    counts_array[row, col] = count
-
-
-# to exclude occurrences beyond input raster: apply nodata values mask from original raster band to count array
-nodata_value = raster_band.GetNoDataValue()  # getnodata value from the original raster
-original_band_data = raster_band.ReadAsArray()  # read original band data to get nodata mask
-counts_array[original_band_data == nodata_value] = nodata_value  # apply nodata mask
-
-# write counts_array to the first and only band of the output raster
-output_band = output_raster.GetRasterBand(1)
-output_band.WriteArray(counts_array)
-output_band.SetNoDataValue(nodata_value)  # set the same nodata values
-
-print(f"Output raster dataset has been written to {output_raster_path}.")
-
-# save and close the output raster
-output_band.FlushCache()
-output_raster.FlushCache()
-output_raster = None  # close dataset
+for target in targets:
+    # bands with counts (one band, or one band for each group) followed by bands of distinct counts, already accumulated over all chunks
+    output_bands = target.bands
+    print(f"Number of bands in the output raster dataset for {target.name}: {len(output_bands)}")
+
+    # write bands to tiled and compressed GeoTIFF (COG with overviews by default): nodata mask is read from the original raster band window by window,
+    # and the output data type is selected from the maximum count (no truncation of high counts to Int16)
+    raster_writer = CountRasterWriter(
+        target.raster_ds,
+        compress=config.get('output_compress', 'DEFLATE'),
+        cog=config.get('output_cog', True),
+        block_size=config.get('output_block_size', 512),
+        overview_resampling=config.get('output_overview_resampling', 'AVERAGE'),
+    )
+    # coarser levels of counts are derived from the base counts by block summation (no additional pass over the datacube), distinct counts are deduplicated within blocks
+    levels = target.levels(pyramid_factors) if pyramid_factors else []
+    raster_writer.write(target.output_raster_path, output_bands, levels=levels if pyramid_output == 'overviews' else None)
+
+    print(f"Output raster dataset has been written to {target.output_raster_path}.")
+
+    if pyramid_output == 'files':
+        for factor, level_bands in levels:
+            # each level is written as its own GeoTIFF aligned with the input raster dataset
+            level_path = os.path.splitext(target.output_raster_path)[0] + f"_x{factor}.tif"
+            level_writer = CountRasterWriter(
+                level_template(target.raster_ds, factor, config.get('output_block_size', 512)),
+                compress=config.get('output_compress', 'DEFLATE'),
+                cog=config.get('output_cog', True),
+                block_size=config.get('output_block_size', 512),
+                overview_resampling=config.get('output_overview_resampling', 'AVERAGE'),
+            )
+            level_writer.write(level_path, level_bands)
+            print(f"Counts aggregated by factor {factor} have been written to {level_path}.")
+
+    if density:
+        # kernel is defined in pixels of the input raster dataset, tiles are convolved with the halo of kernel radius
+        pixel_size = abs(target.grid.geo_transform[1])
+        kernel = density_kernel(density_kernel_type, density_bandwidth / pixel_size, density_radius / pixel_size if density_radius else None)
+        mask_band = target.raster_ds.GetRasterBand(1)
+        density_bands = [(f"{description} density", DensitySurface(counts, kernel, mask_band, density_edge_correction)) for description, counts in target.accumulator.bands]
+        density_path = os.path.splitext(target.output_raster_path)[0] + '_density.tif'
+        raster_writer.write(density_path, density_bands, dtype=(gdal.GDT_Float32, np.float32))
+        print(f"Occurrence density ({density_kernel_type} kernel of {kernel.shape[0]}x{kernel.shape[1]} pixels) has been written to {density_path}.")
 
 # Alternative block - to write the GBIF datacube into a new band while keeping the input data in band 1
 """
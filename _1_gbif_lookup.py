@@ -3,6 +3,18 @@ import pandas as pd
 import requests
 import time
 import yaml
+import argparse
+
+# import the rate limiter and concurrent mapping of names to requests
+from lookup_proc import TokenBucket, map_concurrently
+# import the persistent cache of responses
+from lookup_proc import ResponseCache, cache_key
+# import checkpoints of results for incremental lookup
+from lookup_proc import LookupCheckpoint
+# import parsing and deduplication of input names
+from lookup_proc import deduplicate_names, fan_out, report_saved_lookups
+# import the offline matcher against GBIF Backbone Taxonomy
+from backbone_proc import BackboneIndex
 
 """
 This block access GBIF Species Lookup tool through Species API: https://www.gbif.org/tools/species-lookup
@@ -16,9 +28,29 @@ Format: CSV
 Mandatory: yes
 
 OUTPUT
-- Table with fixed scientific names and GBIF keys pointing out sub(species).
+- Table with fixed scientific names and GBIF keys pointing out sub(species), one row for every distinct canonical name.
 Format: CSV
 Mandatory: yes
+- Table of input names as written by user with their canonical names and GBIF keys (next to the output table, with suffix '_input_names').
+Format: CSV
+Mandatory: no
+
+USAGE
+- From the command line (paths, number of concurrent requests and rate limit are read from config.yaml unless defined):
+python _1_gbif_lookup.py --input input/species_list.csv --output output/mapped_species_GBIF.csv --workers 8 --rate 10
+- As a library (names are resolved concurrently, results are in the same order as input names):
+from _1_gbif_lookup import lookup_species
+results = lookup_species(['Lutra lutra', 'Canis lupus'], workers=8, rate=10)
+- Responses are cached on disk (see 'lookup_cache' in config.yaml), so reruns of the same list don't send requests again.
+In offline mode (--offline) only cached responses are used and names which are not cached are reported as failed requests.
+- Without network, names can be matched against the local index of GBIF Backbone Taxonomy instead of GBIF API (the same output fields):
+python backbone_proc.py input/backbone/Taxon.tsv output/backbone_index
+python _1_gbif_lookup.py --backbone output/backbone_index
+- Input names are parsed into canonical names and authorship ('Alytes cisternasii Boscá, 1879' -> 'Alytes cisternasii') before lookup,
+so duplicates, case variants and names with different authorship are looked up once. The output table has one row for every canonical name
+(3_gbif_iucn_scientificName_Mapper.py and habitat_proc.py merge on 'canonicalName'), results of every input name are written to the separate table ('inputName' column).
+- Lookup is incremental (see 'lookup_incremental' in config.yaml): results are appended to the checkpoint next to the output file as soon as names are resolved,
+so the interrupted lookup continues from where it stopped, and reruns look up only new or edited names and names resolved more than 'lookup_cache_ttl_days' ago (--full to look up all names again).
 
 ISSUES AND LIMITATIONS
 - Subspecies which may be listed by user instead of species are not always assigned with correct GBIF IDs (sometimes with species IDs)
@@ -35,41 +67,66 @@ https://techdocs.gbif.org/en/openapi/v1/species#/Searching%20names/matchNames (G
 
 """
 
+# base URL of GBIF API (might be replaced with the local stub server for testing, see configure_lookup)
+GBIF_API_URL = "https://api.gbif.org/v1"
 
-# open configuration files
-with open('config.yaml', 'r') as file:
-    config = yaml.safe_load(file)
+# rate limiter shared by all threads sending requests to GBIF API (requests per second), instead of the fixed pause after every species
+rate_limiter = TokenBucket(rate=10)
 
-# paths from the config file
-input_dir = config['input_dir']
-output_dir = config['output_dir']
+# persistent cache of responses of GBIF API (None - no cache) and offline mode (only cached responses are used)
+response_cache = None
+offline = False
 
-# input file from the config file
-input_filename = config['input_species']
-input_path = os.path.join(input_dir, input_filename)
-input_path = os.path.normpath(input_path)
-print (input_path)
+# offline matcher against GBIF Backbone Taxonomy used instead of GBIF API (None - names are matched through GBIF API)
+backbone = None
 
-# output file with fixed scientific names of the species and enriched with GBIF ID keys
-output_filename = config['gbif_key_csv']
-output_path = os.path.join(output_dir, output_filename)
-output_path = os.path.normpath(output_path)
-print (output_path)
+# to set the rate limit, the base URL of GBIF API, the cache of responses, offline mode and the offline matcher
+def configure_lookup(rate=None, api_url=None, cache=None, offline_mode=None, backbone_index=None):
+    global rate_limiter, GBIF_API_URL, response_cache, offline, backbone
+    if rate is not None:
+        rate_limiter = TokenBucket(rate=rate)
+    if api_url is not None:
+        GBIF_API_URL = api_url.rstrip('/')
+    if cache is not None:
+        response_cache = cache
+    if offline_mode is not None:
+        offline = offline_mode
+    if backbone_index is not None:
+        backbone = backbone_index
+
+# to send GET request to GBIF API within the rate limit (requests are repeated if GBIF responds with 'Too Many Requests')
+# responses are read from the cache first and stored in it after successful requests
+def gbif_get(endpoint, params, retries=3):
+    key = cache_key(endpoint, params)
+    if response_cache is not None:
+        data = response_cache.get(key)
+        if data is not None:
+            return data
+    if offline:
+        raise requests.exceptions.ConnectionError(f"Offline mode: no cached response for {endpoint} with {params}")
+    for attempt in range(retries + 1):
+        rate_limiter.acquire()
+        response = requests.get(f"{GBIF_API_URL}/{endpoint}", params=params, timeout=60)
+        if response.status_code == 429 and attempt < retries:
+            time.sleep(float(response.headers.get('Retry-After', 2 ** attempt)))
+            continue
+        response.raise_for_status()
+        data = response.json()
+        if response_cache is not None:
+            response_cache.set(key, data)
+        return data
 
 
 # to fix scientific names of species
 def fix_species_name(species_name):
     # GBIF Species Look-up tool endpoint
-    url = "https://api.gbif.org/v1/species/match"
     params = {
         'name': species_name, # define species to be looked up from the variable
         'strict': 'false', # if true it fuzzy matches only the given name, but never a taxon in the upper classification.
         }
     
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        return response.json()
+        return gbif_get('species/match', params)
     except requests.exceptions.RequestException as e:
         print(f"Request failed for {species_name}: {e}")
         return None
@@ -77,7 +134,6 @@ def fix_species_name(species_name):
 # to fetch taxon IDs for fixed scientific names
 def fetch_gbif_id(scientific_name):
     # use the scientific name to fetch GBIF ID
-    url = "https://api.gbif.org/v1/species/search"
     params = {
         'datasetKey': 'd7dddbf4-2cf0-4f39-9b2a-bb099caae36c', # unique id of GBIF Backbone dataset (otherwise, keys from other datasets will be fetched)
         # TODO - try to implement 'datasetkey' = IUCN
@@ -88,9 +144,7 @@ def fetch_gbif_id(scientific_name):
     }
     
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
+        data = gbif_get('species/search', params)
         
         results = data.get("results", [])
         if results:
@@ -130,8 +184,68 @@ def process_species_data(data):
 
 # TODO - to bring the fixed name of species, not subspecies as DOPA REST service doesn't support them!
 
-# Overarching function if input file is csv
-def lookup_species_from_csv(file_path, output_path):
+# to take output fields and GBIF keys from the match of the offline matcher (the matched taxon is the key, its species is the species key)
+def backbone_species_info(data):
+    species_info = process_species_data(data)
+    species_info['gbifKey'] = data.get('usageKey')
+    species_info['gbifSpeciesKey'] = data.get('speciesKey')
+    return species_info
+
+# to fix the scientific name of one (sub)species and fetch its GBIF keys (empty dictionary if the name is not matched)
+def resolve_species(species_name):
+    if backbone is not None:
+        return backbone_species_info(backbone.match(species_name))
+    print(f"Fetching data for (sub)species: {species_name}")
+    data = fix_species_name(species_name)
+    species_info = process_species_data(data)
+    if species_info:
+        scientific_name = species_info.get('scientificName', '')
+        gbif_ids = fetch_gbif_id(scientific_name) # call the function to fetch GBIF Species ID for the fixed scientific name
+        gbif_key, gbif_species_key = gbif_ids if gbif_ids else (None, None)
+        # species_info["inputName"] = species_name  # add the original species name to the output
+        species_info['gbifKey'] = gbif_key
+        species_info['gbifSpeciesKey'] = gbif_species_key
+    return species_info
+
+# to resolve the list of names concurrently - output is in the same order as input names
+def lookup_species(species_names, workers=8, rate=None, checkpoint=None):
+    """
+    Fixes scientific names and fetches GBIF keys for the list of (sub)species.
+
+    Args:
+        species_names (list): Scientific names of (sub)species.
+        workers (int): Maximum number of concurrent requests.
+        rate (float): Maximum number of requests per second to GBIF API (the current rate limit by default).
+        checkpoint (LookupCheckpoint): Checkpoint to append results to as soon as names are resolved (failed requests are not appended).
+
+    Returns:
+        list: Dictionaries with fields of process_species_data and GBIF keys (empty dictionaries for names which are not matched), in the order of input names.
+    """
+    if backbone is not None:
+        # all names are matched offline at once, without requests
+        results = [backbone_species_info(data) for data in backbone.match_many(species_names)]
+        if checkpoint is not None:
+            for species_name, species_info in zip(species_names, results):
+                checkpoint.add(species_name, species_info)
+        return results
+    if rate is not None:
+        configure_lookup(rate=rate)
+    if checkpoint is None:
+        return map_concurrently(resolve_species, species_names, workers=workers)
+
+    def resolve_and_save(species_name):
+        species_info = resolve_species(species_name)
+        if species_info:
+            checkpoint.add(species_name, species_info)
+        return species_info
+    return map_concurrently(resolve_and_save, species_names, workers=workers)
+
+# to define the path to results of every input name next to the output file
+def input_names_csv_path(output_path):
+    return os.path.splitext(output_path)[0] + '_input_names.csv'
+
+# Overarching function if input file is csv (with checkpoint, only names which are not in the checkpoint are looked up)
+def lookup_species_from_csv(file_path, output_path, workers=8, rate=None, checkpoint=None):
     try:
         # try reading the CSV with UTF-8 encoding
         df = pd.read_csv(file_path, encoding='utf-8')
@@ -148,27 +262,36 @@ def lookup_species_from_csv(file_path, output_path):
     first_column = df.iloc[:, 0]
     species_names = first_column.tolist()  # TODO - add as a parameter for function
     
-    results = []  # list to store results
-    
-    for species_name in species_names:
-        print(f"Fetching data for (sub)species: {species_name}")
-        data = fix_species_name(species_name)
-        species_info = process_species_data(data)
-        if species_info:
-            scientific_name = species_info.get('scientificName', '')
-            gbif_key, gbif_species_key = fetch_gbif_id(scientific_name) # call the function to fetch GBIF Species ID for the fixed scientific name
-            # species_info["inputName"] = species_name  # add the original species name to the output
-            species_info['gbifKey'] = gbif_key
-            species_info['gbifSpeciesKey'] = gbif_species_key
-            results.append(species_info)
+    # every canonical name is looked up once (requests to match the name and to fetch GBIF keys)
+    canonical_names, name_nums = deduplicate_names(species_names)
+    report_saved_lookups(len(species_names), len(canonical_names), requests_per_name=2 if backbone is None else 0)
 
-        time.sleep(1)
-    
-    # save results to CSV
-    results_df = pd.DataFrame(results)
+    # names are resolved concurrently within the rate limit (order of input names is kept)
+    if checkpoint is None:
+        canonical_results = lookup_species(canonical_names, workers=workers, rate=rate)
+    else:
+        pending_names = checkpoint.pending(canonical_names)
+        print(f"{len(canonical_names) - len(pending_names)} name(s) resolved in previous runs, {len(pending_names)} name(s) to look up.")
+        lookup_species(pending_names, workers=workers, rate=rate, checkpoint=checkpoint)
+        # results of previous runs merged with new ones, results of names which are no longer in the input are dropped
+        canonical_results = [checkpoint.get(canonical_name, {}) for canonical_name in canonical_names]
+        checkpoint.compact(canonical_names)
+
+    # one row for every canonical name (merged with IUCN data by canonicalName later), unmatched names are skipped
+    results_df = pd.DataFrame([species_info for species_info in canonical_results if species_info])
     results_df.to_csv(output_path, index=False)
     print(f"Final results saved to {output_path}")
 
+    # results are copied to every input name in the separate table, unmatched names are skipped
+    input_names_df = pd.DataFrame([
+        {'inputName': species_name, 'lookupName': canonical_names[name_num], 'canonicalName': species_info.get('canonicalName', ''),
+         'gbifKey': species_info.get('gbifKey'), 'gbifSpeciesKey': species_info.get('gbifSpeciesKey')}
+        for species_name, name_num, species_info in zip(species_names, name_nums, fan_out(canonical_results, name_nums, default={})) if species_info
+    ])
+    input_names_path = input_names_csv_path(output_path)
+    input_names_df.to_csv(input_names_path, index=False)
+    print(f"Results of {len(input_names_df)} input name(s) saved to {input_names_path}")
+
 # REDUNDANT - Overarching function if input file is xlsx, but only csv is left
 """
 def lookup_species_from_xlsx(file_path, output_path):
@@ -216,11 +339,66 @@ def map_gbif_id(input_path):
         print(f"Unsupported file type: {file_extension}. Please provide a .csv or .xlsx file.")
 """
 
-## Run overarching function for lookup
-# define the file extension
-_, file_extension = os.path.splitext(input_path) # split the filename to find the extension
-if file_extension.lower() == '.csv':
-    lookup_species_from_csv(input_path, output_path)
-else:
-    print(f"Unsupported file type: {file_extension}. Please provide a .csv file with scientific names of the species.")
+## Run overarching function for lookup (only if the script is run, not imported, for example by 4_ancillary_ss.py)
+if __name__ == '__main__':
+    # open configuration files
+    with open('config.yaml', 'r') as file:
+        config = yaml.safe_load(file)
+
+    # paths from the config file
+    input_dir = config['input_dir']
+    output_dir = config['output_dir']
+
+    # input file from the config file
+    input_filename = config['input_species']
+    input_path = os.path.join(input_dir, input_filename)
+    input_path = os.path.normpath(input_path)
+
+    # output file with fixed scientific names of the species and enriched with GBIF ID keys
+    output_filename = config['gbif_key_csv']
+    output_path = os.path.join(output_dir, output_filename)
+    output_path = os.path.normpath(output_path)
+
+    # arguments of the command line override the configuration file
+    parser = argparse.ArgumentParser(description="Fix scientific names of species and fetch their GBIF keys through GBIF Species API.")
+    parser.add_argument('--input', default=input_path, help="CSV file with scientific names in the first column.")
+    parser.add_argument('--output', default=output_path, help="Output CSV file with fixed names and GBIF keys.")
+    parser.add_argument('--workers', type=int, default=config.get('lookup_workers', 8), help="Maximum number of concurrent requests.")
+    parser.add_argument('--rate', type=float, default=config.get('lookup_rate', 10), help="Maximum number of requests per second.")
+    parser.add_argument('--api-url', default=GBIF_API_URL, help="Base URL of GBIF API (for example, local stub server for testing).")
+    parser.add_argument('--cache', default=config.get('lookup_cache'), help="SQLite database with cached responses of GBIF API.")
+    parser.add_argument('--no-cache', action='store_true', help="Don't read or write cached responses.")
+    parser.add_argument('--offline', action='store_true', default=config.get('lookup_offline', False), help="Use only cached responses, without any requests.")
+    parser.add_argument('--backbone', default=config.get('gbif_backbone_index'), help="Directory with the index of GBIF Backbone Taxonomy (built by backbone_proc.py) to match names offline instead of GBIF API.")
+    parser.add_argument('--full', action='store_true', help="Ignore results of previous runs and look up all names again.")
+    args = parser.parse_args()
+
+    input_path = os.path.normpath(args.input)
+    output_path = os.path.normpath(args.output)
+    print (input_path)
+    print (output_path)
+    configure_lookup(rate=args.rate, api_url=args.api_url, offline_mode=args.offline)
+    if args.cache and not args.no_cache:
+        configure_lookup(cache=ResponseCache(args.cache, ttl_days=config.get('lookup_cache_ttl_days', 30), max_entries=config.get('lookup_cache_max_entries', 100000)))
+    if args.backbone:
+        configure_lookup(backbone_index=BackboneIndex(args.backbone, min_similarity=config.get('gbif_backbone_min_similarity', 0.85)))
+
+    # checkpoint of results next to the output file (results of another source of lookup are not reused, results expire as cached responses)
+    checkpoint = None
+    if config.get('lookup_incremental', True):
+        checkpoint_path = os.path.splitext(output_path)[0] + '_checkpoint.jsonl'
+        if args.full and os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        checkpoint = LookupCheckpoint(
+            checkpoint_path, source=os.path.abspath(args.backbone) if args.backbone else GBIF_API_URL, ttl_days=config.get('lookup_cache_ttl_days', 30)
+        )
+
+    # define the file extension
+    _, file_extension = os.path.splitext(input_path) # split the filename to find the extension
+    if file_extension.lower() == '.csv':
+        lookup_species_from_csv(input_path, output_path, workers=args.workers, checkpoint=checkpoint)
+        if response_cache is not None:
+            print(f"{response_cache.hits} response(s) read from the cache {args.cache}, {response_cache.misses} requested.")
+    else:
+        print(f"Unsupported file type: {file_extension}. Please provide a .csv file with scientific names of the species.")
 
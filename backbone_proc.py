@@ -0,0 +1,301 @@
+# backbone_proc.py
+# includes methods to match scientific names against the local copy of GBIF Backbone Taxonomy (Taxon.tsv from https://hosted-datasets.gbif.org/datasets/backbone/current/)
+# without any requests to GBIF API: exact matches through the sorted index of name hashes, fuzzy matches through the trigram index,
+# and synonyms resolved to accepted names. The index is built once and stored on disk
+# should be imported as a class and functions or run from the command line to build the index
+
+import os
+import csv
+import difflib
+import argparse
+import numpy as np
+import pandas as pd
+
+# import parsing of scientific names into canonical names and authorship
+from lookup_proc import parse_scientific_name, RANK_MARKERS
+
+# columns of Taxon.tsv used for matching
+BACKBONE_COLUMNS = [
+    'taxonID', 'parentNameUsageID', 'acceptedNameUsageID', 'scientificName', 'canonicalName', 'taxonRank', 'taxonomicStatus', 'class',
+]
+
+# ranks of GBIF Backbone below species (the species key of these taxa is the key of their parent species)
+INFRASPECIFIC_RANKS = {'subspecies', 'variety', 'subvariety', 'form', 'subform', 'infraspecific_name', 'infrasubspecific_name'}
+
+# order of preference of taxonomic statuses, if the same name is used by several taxa (accepted names go first)
+STATUS_PRIORITY = {'accepted': 0, 'doubtful': 1, 'homotypic synonym': 2, 'heterotypic synonym': 3, 'synonym': 4, 'proparte synonym': 5, 'misapplied': 6}
+
+# width of names for trigrams (longer names are truncated, only for fuzzy matching)
+TRIGRAM_WIDTH = 64
+
+
+def normalise_name(name):
+    """
+    Normalises the name for exact matching (whitespace collapsed, lower case).
+    """
+    if pd.isna(name):
+        return ''
+    return ' '.join(str(name).split()).lower()
+
+
+def canonical_names(name):
+    """
+    Strips authorship from the scientific name (before it is normalised, as authors are told from epithets by case),
+    for example 'Lutra lutra (Linnaeus, 1758)' -> 'lutra lutra'.
+
+    Returns:
+        tuple: Normalised canonical name and the same name without rank markers ('poa annua var. supina' -> 'poa annua supina').
+    """
+    canonical = normalise_name(parse_scientific_name(name)[0]) if isinstance(name, str) else ''
+    without_markers = ' '.join(word for word in canonical.split() if word not in RANK_MARKERS.values())
+    return canonical, without_markers
+
+
+def hash_names(names):
+    """
+    Hashes normalised names into 64-bit integers (stable between runs, unlike built-in hash).
+    """
+    return pd.util.hash_array(np.asarray(names, dtype=object))
+
+
+def name_trigrams(names):
+    """
+    Computes trigrams of normalised names (padded with spaces) hashed into 32-bit integers, for all names at once.
+
+    Args:
+        names (list): Normalised names.
+
+    Returns:
+        tuple: Trigram keys (np.ndarray of uint32) and numbers of names they belong to (np.ndarray of int64).
+    """
+    padded = np.array([' ' + name + ' ' for name in names], dtype=f'<U{TRIGRAM_WIDTH}')
+    codes = padded.view(np.uint32).reshape(len(names), TRIGRAM_WIDTH).astype(np.uint64)
+    lengths = np.minimum(np.char.str_len(padded), TRIGRAM_WIDTH)
+    trigrams = (codes[:, :-2] << np.uint64(42)) | (codes[:, 1:-1] << np.uint64(21)) | codes[:, 2:]
+    valid = np.arange(TRIGRAM_WIDTH - 2) < (lengths - 2)[:, None]
+    # to mix bits of characters before the trigram is truncated to 32 bits (collisions only add candidates of fuzzy matching)
+    keys = ((trigrams[valid] * np.uint64(0x9E3779B97F4A7C15)) >> np.uint64(32)).astype(np.uint32)
+    return keys, np.nonzero(valid)[0]
+
+
+def build_backbone_index(taxon_path, index_dir, chunksize=1000000):
+    """
+    Builds the index of GBIF Backbone Taxonomy and stores it in the directory (taxa as Parquet table and sorted arrays of the index as .npy files).
+    Taxon.tsv is read chunk by chunk, only columns needed for matching are kept.
+
+    Args:
+        taxon_path (str): Path to Taxon.tsv of GBIF Backbone Taxonomy (Darwin Core Archive).
+        index_dir (str): Path to the output directory with the index.
+        chunksize (int): Number of taxa in each chunk.
+    """
+    print("-" * 40)
+    print(f"Building the index of GBIF Backbone Taxonomy from {taxon_path}...")
+    chunks = []
+    for chunk in pd.read_csv(
+        taxon_path, sep='\t', usecols=BACKBONE_COLUMNS, quoting=csv.QUOTE_NONE, on_bad_lines='skip', chunksize=chunksize,
+        dtype={'taxonID': 'int64', 'parentNameUsageID': 'Int64', 'acceptedNameUsageID': 'Int64', 'taxonRank': 'category', 'taxonomicStatus': 'category', 'class': 'category'},
+    ):
+        chunks.append(chunk[chunk['canonicalName'].notna()])
+        print(f"{sum(len(chunk) for chunk in chunks)} taxa read...")
+    taxa = pd.concat(chunks, ignore_index=True).sort_values('taxonID', ignore_index=True)
+    taxa['taxonRank'] = taxa['taxonRank'].astype(str).str.lower()
+    taxa['taxonomicStatus'] = taxa['taxonomicStatus'].astype(str).str.lower()
+    taxon_ids = taxa['taxonID'].to_numpy()
+
+    # keys of classes (Taxon.tsv has only names of classes)
+    classes = taxa[(taxa['taxonRank'] == 'class') & (taxa['taxonomicStatus'] == 'accepted')]
+    taxa['classKey'] = taxa['class'].astype(object).map(dict(zip(classes['canonicalName'], classes['taxonID']))).astype('Int64')
+
+    # species keys: synonyms are resolved to accepted taxa, infraspecific taxa to their parent species
+    usage_ids = taxa['acceptedNameUsageID'].fillna(taxa['taxonID']).to_numpy(dtype=np.int64)
+    usage_rows = np.clip(np.searchsorted(taxon_ids, usage_ids), 0, len(taxa) - 1)
+    # accepted taxa might be missing (without canonical name or on skipped lines), then synonyms have no species key
+    usage_found = taxon_ids[usage_rows] == usage_ids
+    usage_ranks = np.where(usage_found, taxa['taxonRank'].to_numpy()[usage_rows], '')
+    usage_parents = taxa['parentNameUsageID'].to_numpy(dtype=np.float64, na_value=np.nan)[usage_rows]
+    species_keys = np.where(usage_ranks == 'species', usage_ids, np.where(np.isin(usage_ranks, list(INFRASPECIFIC_RANKS)), usage_parents, np.nan))
+    taxa['speciesKey'] = pd.array(species_keys, dtype='Float64').astype('Int64')
+
+    os.makedirs(index_dir, exist_ok=True)
+    taxa.to_parquet(os.path.join(index_dir, 'taxa.parquet'), index=False)  # pip install pyarrow
+
+    # exact index: sorted hashes of names and rows of taxa (preferred taxa of the same name go first)
+    priority = taxa['taxonomicStatus'].map(STATUS_PRIORITY).fillna(len(STATUS_PRIORITY)).to_numpy()
+    for field in ['scientificName', 'canonicalName']:
+        keys = hash_names([normalise_name(name) for name in taxa[field]])
+        order = np.lexsort((priority, keys))
+        np.save(os.path.join(index_dir, f'{field}_keys.npy'), keys[order])
+        np.save(os.path.join(index_dir, f'{field}_rows.npy'), order.astype(np.int32))
+
+    # fuzzy index over distinct canonical names (the preferred taxon of each name), trigrams are stored as compressed sparse rows
+    canonical_keys = np.load(os.path.join(index_dir, 'canonicalName_keys.npy'))
+    canonical_rows = np.load(os.path.join(index_dir, 'canonicalName_rows.npy'))
+    first = np.ones(len(canonical_keys), dtype=bool)
+    first[1:] = canonical_keys[1:] != canonical_keys[:-1]
+    fuzzy_rows = canonical_rows[first]
+    fuzzy_names = [normalise_name(name) for name in taxa['canonicalName'].to_numpy()[fuzzy_rows]]
+    postings = []
+    lengths = np.zeros(len(fuzzy_names), dtype=np.int16)
+    for start in range(0, len(fuzzy_names), chunksize):
+        keys, name_nums = name_trigrams(fuzzy_names[start:start + chunksize])
+        lengths[start:start + chunksize] = np.bincount(name_nums, minlength=len(fuzzy_names[start:start + chunksize]))
+        # trigram key and number of name packed into one integer, so that pairs are sorted in place
+        postings.append((keys.astype(np.uint64) << np.uint64(32)) | (name_nums + start).astype(np.uint64))
+    postings = np.unique(np.concatenate(postings))
+    trigram_keys, trigram_offsets = np.unique((postings >> np.uint64(32)).astype(np.uint32), return_index=True)
+    np.save(os.path.join(index_dir, 'fuzzy_rows.npy'), fuzzy_rows)
+    np.save(os.path.join(index_dir, 'fuzzy_lengths.npy'), lengths)
+    np.save(os.path.join(index_dir, 'trigram_keys.npy'), trigram_keys)
+    np.save(os.path.join(index_dir, 'trigram_offsets.npy'), np.append(trigram_offsets, len(postings)).astype(np.int64))
+    np.save(os.path.join(index_dir, 'trigram_postings.npy'), (postings & np.uint64(0xFFFFFFFF)).astype(np.int32))
+    print(f"Index of {len(taxa)} taxa ({len(fuzzy_rows)} distinct canonical names) saved to {index_dir}")
+
+
+class BackboneIndex:
+    """
+    Offline matcher of scientific names against GBIF Backbone Taxonomy. Returns the same fields as GBIF Species API (species/match):
+    exact matches of scientific or canonical names, fuzzy matches of canonical names (misspellings) and matches of genus (higher rank).
+    Arrays of the index are memory-mapped, so only the table of taxa is loaded into memory.
+    """
+
+    def __init__(self, index_dir, min_similarity=0.85, max_candidates=20, max_postings=200000):
+        """
+        Opens the index built by build_backbone_index.
+
+        Args:
+            index_dir (str): Path to the directory with the index.
+            min_similarity (float): Minimum similarity of names (0-1) for fuzzy matches.
+            max_candidates (int): Number of candidates (sharing the most trigrams with the name) compared by similarity.
+            max_postings (int): Trigrams of more names than this number are skipped when searching for candidates (unless all trigrams are so common).
+        """
+        self.taxa = pd.read_parquet(os.path.join(index_dir, 'taxa.parquet'))
+        self.index = {
+            name: np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r')
+            for name in ['scientificName_keys', 'scientificName_rows', 'canonicalName_keys', 'canonicalName_rows',
+                         'fuzzy_rows', 'fuzzy_lengths', 'trigram_keys', 'trigram_offsets', 'trigram_postings']
+        }
+        self.min_similarity = min_similarity
+        self.max_candidates = max_candidates
+        self.max_postings = max_postings
+        self.canonical_names = self.taxa['canonicalName'].to_numpy()
+
+    def _exact(self, field, names):
+        # first (preferred) rows of taxa with the same names and numbers of such taxa (-1 if the name is missing)
+        keys = self.index[f'{field}_keys']
+        hashes = hash_names(names)
+        left = np.searchsorted(keys, hashes, side='left')
+        right = np.searchsorted(keys, hashes, side='right')
+        found = right > left
+        rows = np.full(len(names), -1, dtype=np.int64)
+        rows[found] = self.index[f'{field}_rows'][left[found]]
+        return rows, right - left
+
+    def _fuzzy(self, name):
+        # the most similar canonical name sharing trigrams with the name (row of taxa and similarity)
+        keys, _ = name_trigrams([name])
+        trigram_keys = self.index['trigram_keys']
+        query_keys = np.unique(keys)
+        positions = np.minimum(np.searchsorted(trigram_keys, query_keys), len(trigram_keys) - 1)
+        positions = positions[trigram_keys[positions] == query_keys]
+        starts = self.index['trigram_offsets'][positions]
+        ends = self.index['trigram_offsets'][positions + 1]
+        rare = (ends - starts) <= self.max_postings
+        if rare.any():
+            starts, ends = starts[rare], ends[rare]
+        if not len(starts):
+            return -1, 0.0
+        candidates, shared = np.unique(np.concatenate([self.index['trigram_postings'][start:end] for start, end in zip(starts, ends)]), return_counts=True)
+        # Dice coefficient of trigrams to select candidates, similarity of strings to select the match
+        dice = 2 * shared / (len(keys) + self.index['fuzzy_lengths'][candidates])
+        best = candidates[np.argsort(-dice, kind='stable')[:self.max_candidates]]
+        rows = self.index['fuzzy_rows'][best]
+        similarities = [difflib.SequenceMatcher(None, name, normalise_name(self.canonical_names[row])).ratio() for row in rows]
+        best_num = int(np.argmax(similarities))
+        return int(rows[best_num]), similarities[best_num]
+
+    def _results(self, rows, match_types, confidences, notes):
+        # fields of the response of GBIF Species API for matched taxa (taken from the table of taxa at once)
+        taxa = self.taxa.iloc[np.asarray(rows, dtype=np.int64)]
+        taxa = taxa.astype(object).where(taxa.notna(), None)
+        results = []
+        for taxon, match_type, confidence, note in zip(taxa.to_dict('records'), match_types, confidences, notes):
+            results.append({
+                'usageKey': int(taxon['taxonID']),
+                'acceptedUsageKey': None if taxon['acceptedNameUsageID'] is None else int(taxon['acceptedNameUsageID']),
+                'scientificName': taxon['scientificName'],
+                'canonicalName': taxon['canonicalName'],
+                'rank': str(taxon['taxonRank']).upper(),
+                'status': str(taxon['taxonomicStatus']).upper().replace(' ', '_'),
+                'confidence': confidence,
+                'note': note,
+                'matchType': match_type,
+                'class': taxon['class'],
+                'classKey': None if taxon['classKey'] is None else int(taxon['classKey']),
+                'speciesKey': None if taxon['speciesKey'] is None else int(taxon['speciesKey']),
+            })
+        return results
+
+    def match_many(self, names):
+        """
+        Matches the list of names. Exact matches are found for all names at once, fuzzy and higher rank matches only for the rest of names.
+
+        Args:
+            names (list): Scientific names (with or without authorship).
+
+        Returns:
+            list: Dictionaries with fields of GBIF Species API (matchType 'NONE' for names which are not matched), in the order of names.
+        """
+        canonical, without_markers = zip(*[canonical_names(name) for name in names]) if len(names) else ((), ())
+        names = [normalise_name(name) for name in names]
+        scientific_rows, _ = self._exact('scientificName', names)
+        canonical_rows, canonical_counts = self._exact('canonicalName', canonical)
+        # canonical names of infraspecific taxa might be written without rank markers
+        plain_rows, plain_counts = self._exact('canonicalName', without_markers)
+        missing = canonical_rows < 0
+        canonical_rows[missing] = plain_rows[missing]
+        canonical_counts[missing] = plain_counts[missing]
+        note = 'Matched offline against GBIF Backbone Taxonomy'
+        matches = {}  # number of name: (row of taxa, match type, confidence, note)
+        for name_num in range(len(names)):
+            if scientific_rows[name_num] >= 0:
+                matches[name_num] = (scientific_rows[name_num], 'EXACT', 100, note)
+            elif canonical_rows[name_num] >= 0:
+                if canonical_counts[name_num] > 1:
+                    matches[name_num] = (canonical_rows[name_num], 'EXACT', 90, note + '; several taxa with the same name')
+                else:
+                    matches[name_num] = (canonical_rows[name_num], 'EXACT', 98, note)
+            elif canonical[name_num]:
+                row, similarity = self._fuzzy(canonical[name_num])
+                if row >= 0 and similarity >= self.min_similarity:
+                    matches[name_num] = (row, 'FUZZY', int(round(similarity * 100)), note)
+                elif ' ' in canonical[name_num]:
+                    # the genus if the (sub)species is not found
+                    genus_rows, _ = self._exact('canonicalName', [canonical[name_num].split()[0]])
+                    if genus_rows[0] >= 0:
+                        matches[name_num] = (genus_rows[0], 'HIGHERRANK', 90, note)
+        results = [{'confidence': 100, 'note': 'No match in GBIF Backbone Taxonomy', 'matchType': 'NONE'} for _ in names]
+        if matches:
+            for name_num, result in zip(matches, self._results(*zip(*matches.values()))):
+                results[name_num] = result
+        return results
+
+    def match(self, name):
+        """
+        Matches one name (see match_many).
+        """
+        return self.match_many([name])[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build the offline index of GBIF Backbone Taxonomy for matching scientific names without GBIF API.")
+    parser.add_argument('taxon', help="Path to Taxon.tsv of GBIF Backbone Taxonomy (from backbone.zip).")
+    parser.add_argument('index', help="Path to the output directory with the index.")
+    parser.add_argument('--chunksize', type=int, default=1000000, help="Number of taxa in each chunk.")
+    args = parser.parse_args()
+
+    build_backbone_index(args.taxon, args.index, chunksize=args.chunksize)
+
+# Example usage
+# python backbone_proc.py input/backbone/Taxon.tsv output/backbone_index
+# backbone = BackboneIndex('output/backbone_index')
+# data = backbone.match('Lutra lutra (Linnaeus, 1758)')
@@ -0,0 +1,439 @@
+# datacube_proc.py
+# includes methods to read GBIF occurrence datacube (SQL_TSV_ZIP download, extracted CSV or columnar Parquet cache) in chunks, in a single pass over the file,
+# and to merge several overlapping downloads into one stream of records without duplicates
+# should be imported as classes
+# can be also run from the command line to convert the datacube into the Parquet cache:
+# python datacube_proc.py output/gbif_datacube/key_(212)_0037994-240906103802322.zip output/gbif_datacube/key_(212)_0037994-240906103802322.parquet --partition classKey
+
+import io
+import os
+import glob
+import queue
+import zipfile
+import shutil
+import argparse
+import threading
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+
+# data types of datacube columns (from SQL queries to GBIF occurrence datacube), other columns are stored as dictionary-encoded strings
+DATACUBE_DTYPES = {
+    'lat': 'float64',
+    'lon': 'float64',
+    'elevation': 'float32',
+    'depth': 'float32',
+    'familykey': 'Int64',
+    'classkey': 'Int64',
+    'genuskey': 'Int64',
+    'specieskey': 'Int64',
+}
+
+# columns of GROUP BY clause in SQL queries to GBIF occurrence datacube (5_1_query_datacube_*.json) - every record is unique by these columns within one download
+DATACUBE_KEY_COLUMNS = [
+    'yearMonth', 'lat', 'lon', 'familyKey', 'family', 'classKey', 'class', 'genusKey', 'genus',
+    'speciesKey', 'species', 'iucnRedListCategory', 'basisOfRecord', 'elevation', 'depth',
+]
+
+
+def resolve_column(columns, name):
+    """
+    Finds the column of the datacube by its name regardless of the case (GBIF might export 'speciesKey' as 'specieskey').
+
+    Args:
+        columns (list): Columns of the datacube.
+        name (str): Name of the column to find.
+
+    Returns:
+        str: Name of the column as written in the datacube.
+    """
+    for column in columns:
+        if column.lower() == name.lower():
+            return column
+    raise KeyError(f"Column '{name}' is not found in the datacube. Available columns: {', '.join(columns)}")
+
+
+def is_parquet(path):
+    """
+    Checks if the path points out to the Parquet cache of the datacube (a directory with partitioned dataset or a single file).
+    """
+    return os.path.isdir(path) or path.lower().endswith('.parquet')
+
+
+def _typed_chunk(chunk):
+    """
+    Casts columns of the datacube chunk to compact data types: floats for coordinates, integers for keys and categories (dictionary encoding) for strings.
+    """
+    string_columns = {column.lower() for column in DATACUBE_KEY_COLUMNS if column.lower() not in DATACUBE_DTYPES}
+    for column in chunk.columns:
+        dtype = DATACUBE_DTYPES.get(column.lower())
+        if dtype is not None:
+            chunk[column] = chunk[column].astype(dtype)
+        elif column.lower() in string_columns:
+            # strings even if the column is empty in the chunk (read as floats), so that all chunks have the same schema
+            chunk[column] = chunk[column].astype('string').astype('category')
+        elif chunk[column].dtype == object or pd.api.types.is_string_dtype(chunk[column]):
+            chunk[column] = chunk[column].astype('category')
+    return chunk
+
+
+def _parquet_schema(table):
+    """
+    Defines the schema of the Parquet cache from the first chunk: dictionary-encoded strings get the fixed 32-bit index type,
+    so that all chunks are written with the same schema, whatever the number of categories in each chunk
+    (otherwise the index type is int8 in one file and int16 in another, and the dataset can't be read).
+    """
+    import pyarrow as pa  # pip install pyarrow
+    fields = []
+    for field in table.schema:
+        if pa.types.is_dictionary(field.type):
+            field = field.with_type(pa.dictionary(pa.int32(), pa.string()))
+        elif pa.types.is_null(field.type):
+            field = field.with_type(pa.string())  # empty in the first chunk
+        fields.append(field)
+    return pa.schema(fields, metadata=table.schema.metadata)
+
+
+def convert_datacube_to_parquet(datacube_path, parquet_path, partition_cols=('classKey',), chunksize=2000000):
+    """
+    Converts GBIF occurrence datacube into the typed and partitioned Parquet dataset (one-time conversion), so that next runs read only the columns they need.
+    Every chunk is written into one file per partition, so partitioning by high-cardinality columns (speciesKey) creates many small files.
+
+    Args:
+        datacube_path (str): Path to the ZIP archive or CSV file with GBIF occurrence datacube.
+        parquet_path (str): Path to the output directory with Parquet dataset.
+        partition_cols (tuple): Columns to partition the dataset by, for example 'classKey' or 'speciesKey'.
+        chunksize (int): Number of records in each chunk.
+
+    Returns:
+        int: Number of converted records.
+    """
+    import pyarrow as pa  # pip install pyarrow
+    import pyarrow.parquet as pq
+
+    # the limit of pyarrow (1024 partitions per written chunk by default) is raised to the number of partitions in the chunk
+    default_max_partitions = 1024
+
+    # the dataset is written to the temporary directory first, so interrupted conversion never looks like a complete cache
+    temp_path = parquet_path.rstrip('/\\') + '.tmp'
+    if os.path.exists(temp_path):
+        shutil.rmtree(temp_path)
+
+    reader = DatacubeReader(datacube_path, chunksize=chunksize)
+    total_records = 0
+    schema = None
+    for chunk_num, chunk in enumerate(reader):
+        chunk = _typed_chunk(chunk)
+        partitions = [resolve_column(chunk.columns, column) for column in (partition_cols or [])]
+        if schema is None:
+            schema = _parquet_schema(pa.Table.from_pandas(chunk, preserve_index=False))
+        table = pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+        max_partitions = default_max_partitions
+        if partitions:
+            max_partitions = max(default_max_partitions, len(chunk[partitions].drop_duplicates()))
+        # every chunk is written to its own files within partitions
+        pq.write_to_dataset(
+            table, temp_path, partition_cols=partitions or None, basename_template=f"part-{chunk_num}-{{i}}.parquet",
+            max_partitions=max_partitions, max_open_files=max_partitions,
+        )
+        total_records += len(chunk)
+        print(f"Converted chunk {chunk_num + 1} ({reader.progress:.1%} of the datacube read)...")
+
+    os.replace(temp_path, parquet_path)
+    print(f"{total_records} records of the datacube have been converted to {parquet_path}.")
+    return total_records
+
+
+class _CountingStream(io.RawIOBase):
+    """
+    Binary stream which counts bytes consumed from the underlying file (to report progress without counting lines beforehand).
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.bytes_read = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        data = self.raw.read(len(buffer))
+        n = len(data)
+        buffer[:n] = data
+        self.bytes_read += n
+        return n
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class DatacubeReader:
+    """
+    Reads GBIF occurrence datacube in chunks straight from the downloaded ZIP archive (SQL_TSV_ZIP format), from the extracted CSV file
+    or from the Parquet cache (only the columns defined in usecols are read from it).
+    """
+
+    def __init__(self, path, chunksize=2000000, usecols=None, optional_cols=None):
+        """
+        Initializes the reader.
+
+        Args:
+            path (str): Path to the ZIP archive, CSV file or Parquet cache with GBIF occurrence datacube.
+            chunksize (int): Number of records in each chunk.
+            usecols (list): Columns to read (all columns by default).
+            optional_cols (list): Columns to read in addition to usecols only if they are present in the datacube.
+        """
+        self.path = path
+        self.chunksize = chunksize
+        self.usecols = usecols
+        self.optional_cols = optional_cols or []
+        self.total_bytes = None
+        self.total_rows = None
+        self._stream = None
+        self._rows_read = 0
+
+    def _open(self):
+        """
+        Opens the datacube as a binary stream and defines its total (uncompressed) size from the file or the header of ZIP archive.
+        """
+        if zipfile.is_zipfile(self.path):
+            archive = zipfile.ZipFile(self.path)
+            members = [info for info in archive.infolist() if info.filename.lower().endswith('.csv')]
+            if not members:
+                archive.close()
+                raise FileNotFoundError(f"No CSV file found in the ZIP archive {self.path}.")
+            member = max(members, key=lambda info: info.file_size)  # the datacube itself is the largest file
+            self.total_bytes = member.file_size
+            return archive.open(member)
+        self.total_bytes = os.path.getsize(self.path)
+        return open(self.path, 'rb')
+
+    @property
+    def progress(self):
+        """
+        Returns the share of the datacube read so far (from 0 to 1).
+        """
+        if is_parquet(self.path):
+            # for Parquet cache the progress is counted by rows (the number of rows is stored in metadata)
+            return min(self._rows_read / self.total_rows, 1.0) if self.total_rows else 0.0
+        if self._stream is None or not self.total_bytes:
+            return 0.0
+        return min(self._stream.bytes_read / self.total_bytes, 1.0)
+
+    def _iter_parquet(self):
+        """
+        Reads chunks from the Parquet cache, only the required columns are read from disk.
+        """
+        import pyarrow.dataset as ds  # pip install pyarrow
+        dataset = ds.dataset(self.path, format='parquet', partitioning='hive')
+        columns = None
+        if self.usecols is not None:
+            columns = [resolve_column(dataset.schema.names, column) for column in self.usecols]
+            columns += [name for name in dataset.schema.names if name.lower() in {column.lower() for column in self.optional_cols} and name not in columns]
+        self.total_rows = dataset.count_rows()
+        self._rows_read = 0
+        for batch in dataset.to_batches(columns=columns, batch_size=self.chunksize):
+            if batch.num_rows == 0:
+                continue
+            self._rows_read += batch.num_rows
+            yield batch.to_pandas()
+
+    def __iter__(self):
+        if is_parquet(self.path):
+            yield from self._iter_parquet()
+            return
+        self._stream = _CountingStream(self._open())
+        try:
+            # columns are selected regardless of the case of their names
+            usecols = None
+            if self.usecols is not None:
+                names = {column.lower() for column in list(self.usecols) + self.optional_cols}
+                usecols = lambda column: column.lower() in names
+            with io.BufferedReader(self._stream) as buffer:
+                for chunk in pd.read_csv(buffer, delimiter='\t', chunksize=self.chunksize, usecols=usecols):
+                    yield chunk
+        finally:
+            self._stream.close()
+
+class HashedKeySet:
+    """
+    Set of 64-bit hashes of record keys, kept as sorted arrays (8 bytes per key), to check which records have been seen before.
+    """
+
+    def __init__(self):
+        self.keys = np.empty(0, dtype=np.uint64)
+        self._buffer = []
+        self._buffered = 0
+
+    def __len__(self):
+        return len(self.keys) + self._buffered
+
+    def contains(self, keys):
+        """
+        Checks which keys have been added before (binary search in sorted arrays).
+        """
+        found = np.zeros(len(keys), dtype=bool)
+        for sorted_keys in [self.keys] + self._buffer:
+            if len(sorted_keys):
+                positions = np.minimum(np.searchsorted(sorted_keys, keys), len(sorted_keys) - 1)
+                found |= sorted_keys[positions] == keys
+        return found
+
+    def add_new(self, keys):
+        """
+        Adds keys and returns the mask of new ones (the first occurrence of the key which has not been added before).
+        """
+        _, first = np.unique(keys, return_index=True)
+        new = np.zeros(len(keys), dtype=bool)
+        new[first] = True
+        new[new] = ~self.contains(keys[new])
+        if new.any():
+            self._buffer.append(np.sort(keys[new]))
+            self._buffered += int(new.sum())
+            # buffered arrays are merged once they are as large as merged keys
+            if self._buffered >= max(len(self.keys), 1000000):
+                self.keys = np.union1d(self.keys, np.concatenate(self._buffer))
+                self._buffer = []
+                self._buffered = 0
+        return new
+
+
+def hash_records(df):
+    """
+    Hashes records by their values into 64-bit integers. Numbers are hashed as floats (with precision of data types of the Parquet cache)
+    and other values as strings, so the same record gets the same hash regardless of the source it was read from (ZIP archive, CSV or Parquet cache).
+    Columns are hashed in alphabetical order (partition columns of Parquet cache are read as the last ones), string columns of datacube queries always as strings.
+    """
+    string_columns = {column.lower() for column in DATACUBE_KEY_COLUMNS if column.lower() not in DATACUBE_DTYPES}
+    normalised = {}
+    for column in sorted(df.columns, key=str.lower):
+        dtype = DATACUBE_DTYPES.get(column.lower())
+        if column.lower() in string_columns:
+            # strings with missing values as empty strings (empty columns are read from CSV as floats)
+            normalised[column.lower()] = df[column].astype(object).where(df[column].notna(), '').astype(str)
+        elif dtype is not None or pd.api.types.is_numeric_dtype(df[column]):
+            values = pd.to_numeric(df[column].astype(str) if isinstance(df[column].dtype, pd.CategoricalDtype) else df[column], errors='coerce')
+            normalised[column.lower()] = values.astype('float32' if dtype == 'float32' else 'float64').astype('float64')
+        else:
+            normalised[column.lower()] = df[column].astype(str)
+    return pd.util.hash_pandas_object(pd.DataFrame(normalised), index=False).values
+
+
+def find_datacubes(directory, pattern='*.zip'):
+    """
+    Finds downloads of GBIF occurrence datacube in the directory (sorted by name, so that they are merged in the same order in every run).
+    Downloads of licence metadata (key_..._licence.zip from 5_1_curl_datacube_request_placeholders.sh) are skipped.
+    """
+    paths = glob.glob(os.path.join(directory, pattern))
+    return sorted(path for path in paths if not path.endswith('.tmp') and '_licence' not in os.path.basename(path))
+
+
+class MultiDatacubeReader:
+    """
+    Reads several downloads of GBIF occurrence datacube (for example, class and species downloads, Testudines and Squamata) as one stream of chunks.
+    Files are read concurrently by threads (chunks are parsed ahead into bounded queues), but chunks are yielded file by file in the same order in every run.
+    Records repeated in several downloads are dropped by hashes of GROUP BY columns of the datacube (the first record is kept).
+    """
+
+    def __init__(self, paths, chunksize=2000000, usecols=None, deduplicate=True, key_columns=DATACUBE_KEY_COLUMNS, read_workers=4, read_ahead=2):
+        """
+        Initializes the reader.
+
+        Args:
+            paths (list): Paths to ZIP archives, CSV files or Parquet caches with GBIF occurrence datacubes.
+            chunksize (int): Number of records in each chunk.
+            usecols (list): Columns to read (all columns by default).
+            deduplicate (bool): To drop records repeated in several datacubes.
+            key_columns (list): Columns which identify the record (only those present in the datacube are used).
+            read_workers (int): Number of files read at the same time.
+            read_ahead (int): Number of chunks parsed ahead for each file.
+        """
+        self.paths = list(paths)
+        self.usecols = usecols
+        self.deduplicate = deduplicate
+        self.key_columns = key_columns
+        self.read_workers = max(int(read_workers), 1)
+        self.read_ahead = max(int(read_ahead), 1)
+        self.readers = [DatacubeReader(path, chunksize=chunksize, usecols=usecols, optional_cols=key_columns if deduplicate and usecols is not None else None) for path in self.paths]
+        self.seen = HashedKeySet()
+        self.duplicates = 0
+
+    @property
+    def progress(self):
+        """
+        Returns the share of all datacubes read so far (each file counts equally).
+        """
+        return sum(reader.progress for reader in self.readers) / len(self.readers) if self.readers else 0.0
+
+    def _fill(self, reader, chunk_queue, stop):
+        """
+        Reads chunks of one file into its queue (run by threads).
+        """
+        try:
+            for chunk in reader:
+                while not stop.is_set():
+                    try:
+                        chunk_queue.put(chunk, timeout=0.5)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+            chunk_queue.put(None)
+        except Exception as error:
+            chunk_queue.put(error)
+
+    def __iter__(self):
+        stop = threading.Event()
+        queues = [queue.Queue(maxsize=self.read_ahead) for _ in self.readers]
+        with ThreadPoolExecutor(max_workers=self.read_workers) as executor:
+            for reader, chunk_queue in zip(self.readers, queues):
+                executor.submit(self._fill, reader, chunk_queue, stop)
+            try:
+                for path, chunk_queue in zip(self.paths, queues):
+                    print(f"Reading GBIF datacube {path}...")
+                    while True:
+                        chunk = chunk_queue.get()
+                        if chunk is None:
+                            break
+                        if isinstance(chunk, Exception):
+                            raise chunk
+                        yield self._select(chunk)
+            finally:
+                stop.set()
+                # to release threads waiting for free space in queues
+                for chunk_queue in queues:
+                    while not chunk_queue.empty():
+                        chunk_queue.get_nowait()
+
+    def _select(self, chunk):
+        """
+        Drops records already read from previous chunks or files, and columns read only to identify records.
+        """
+        if self.deduplicate:
+            key_columns = [column for column in chunk.columns if column.lower() in {key.lower() for key in self.key_columns}]
+            new = self.seen.add_new(hash_records(chunk[key_columns]))
+            self.duplicates += int(np.count_nonzero(~new))
+            chunk = chunk[new]
+        if self.usecols is not None:
+            chunk = chunk[[resolve_column(chunk.columns, column) for column in self.usecols]]
+        return chunk
+
+# Example usage
+# reader = DatacubeReader('output/gbif_datacube/key_(212)_0037994-240906103802322.zip', chunksize=2000000, usecols=['lat', 'lon'])
+# for chunk in reader:
+#     print(f"{reader.progress:.1%} of the datacube read")
+# several overlapping downloads without duplicates
+# reader = MultiDatacubeReader(find_datacubes('output/gbif_datacube'), usecols=['lat', 'lon'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert GBIF occurrence datacube (ZIP archive or CSV file) into the typed and partitioned Parquet dataset.")
+    parser.add_argument('datacube', help="Path to the ZIP archive or CSV file with GBIF occurrence datacube.")
+    parser.add_argument('parquet', help="Path to the output directory with Parquet dataset.")
+    parser.add_argument('--partition', nargs='*', default=['classKey'], help="Columns to partition the dataset by (classKey by default, for example speciesKey).")
+    parser.add_argument('--chunksize', type=int, default=2000000, help="Number of records in each chunk.")
+    args = parser.parse_args()
+
+    convert_datacube_to_parquet(args.datacube, args.parquet, partition_cols=args.partition, chunksize=args.chunksize)
@@ -0,0 +1,107 @@
+# density_proc.py
+# includes methods to smooth counts of occurrences into the density surface with Gaussian or distance-decay kernel,
+# convolved through FFT tile by tile with halo overlap (so that only one tile and its halo are kept in memory)
+# should be imported as classes and functions
+
+import numpy as np
+import math
+
+
+def density_kernel(kernel='gaussian', bandwidth=1.0, radius=None):
+    """
+    Creates the normalised kernel (its sum is 1, so the total number of occurrences is preserved).
+
+    Args:
+        kernel (str): Kernel type - 'gaussian' (bandwidth is sigma) or 'exponential' distance-decay (bandwidth is the decay distance).
+        bandwidth (float): Bandwidth in pixels.
+        radius (float): Radius of the kernel in pixels (3 bandwidths for Gaussian and 4 bandwidths for exponential kernel by default).
+
+    Returns:
+        np.ndarray: Square kernel of odd size.
+    """
+    if bandwidth <= 0:
+        raise ValueError(f"Bandwidth of the kernel must be positive, got {bandwidth}.")
+    if radius is None:
+        radius = 3 * bandwidth if kernel == 'gaussian' else 4 * bandwidth
+    half_size = max(int(math.ceil(radius)), 1)
+    offsets = np.arange(-half_size, half_size + 1, dtype=np.float64)
+    distance = np.hypot(*np.meshgrid(offsets, offsets))
+    if kernel == 'gaussian':
+        weights = np.exp(-0.5 * (distance / bandwidth) ** 2)
+    elif kernel == 'exponential':
+        weights = np.exp(-distance / bandwidth)
+    else:
+        raise ValueError(f"Unknown kernel: {kernel}. Please define 'gaussian' or 'exponential'.")
+    weights[distance > radius] = 0  # circular kernel
+    return weights / weights.sum()
+
+
+def fft_convolve(window, kernel):
+    """
+    Convolves the window with the kernel through FFT (zero padding, the output has the same shape as the window).
+    """
+    half_y, half_x = kernel.shape[0] // 2, kernel.shape[1] // 2
+    shape = (window.shape[0] + kernel.shape[0] - 1, window.shape[1] + kernel.shape[1] - 1)
+    spectrum = np.fft.rfft2(window, shape) * np.fft.rfft2(kernel, shape)
+    full = np.fft.irfft2(spectrum, shape)
+    return full[half_y:half_y + window.shape[0], half_x:half_x + window.shape[1]]
+
+
+class DensitySurface:
+    """
+    Density surface of counts, computed on demand window by window: every window is read with the halo of kernel radius,
+    convolved through FFT and cropped, so that the result is the same as convolution of the whole raster.
+    Pixels with nodata in the input raster dataset are excluded from smoothing (their counts are dropped).
+    """
+
+    def __init__(self, counts, kernel, mask_band=None, edge_correction=False):
+        """
+        Initializes the surface.
+
+        Args:
+            counts (np.ndarray or SparseCounts): Counts of occurrences.
+            kernel (np.ndarray): Normalised kernel (see density_kernel).
+            mask_band (gdal.Band): Band of the input raster dataset with nodata values (None - no mask).
+            edge_correction (bool): To divide density by the share of the kernel within valid pixels (no underestimation near nodata and raster edges).
+        """
+        self.counts = counts
+        self.shape = tuple(counts.shape)
+        self.kernel = kernel
+        self.halo = kernel.shape[0] // 2
+        self.mask_band = mask_band
+        self.nodata_value = mask_band.GetNoDataValue() if mask_band is not None else None
+        self.edge_correction = edge_correction
+
+    def _read_counts(self, xoff, yoff, xsize, ysize):
+        if hasattr(self.counts, 'read_window'):
+            return self.counts.read_window(xoff, yoff, xsize, ysize)
+        return self.counts[yoff:yoff + ysize, xoff:xoff + xsize]
+
+    def read_window(self, xoff, yoff, xsize, ysize):
+        """
+        Computes density in the window.
+        """
+        # window with halo, clipped by the raster dataset
+        halo_xoff = max(xoff - self.halo, 0)
+        halo_yoff = max(yoff - self.halo, 0)
+        halo_xsize = min(xoff + xsize + self.halo, self.shape[1]) - halo_xoff
+        halo_ysize = min(yoff + ysize + self.halo, self.shape[0]) - halo_yoff
+        counts = np.asarray(self._read_counts(halo_xoff, halo_yoff, halo_xsize, halo_ysize), dtype=np.float64)
+        valid = None
+        if self.nodata_value is not None:
+            valid = self.mask_band.ReadAsArray(halo_xoff, halo_yoff, halo_xsize, halo_ysize) != self.nodata_value
+            counts = np.where(valid, counts, 0)
+        density = fft_convolve(counts, self.kernel)
+        if self.edge_correction:
+            weights = fft_convolve(valid.astype(np.float64) if valid is not None else np.ones_like(counts), self.kernel)
+            density = np.divide(density, weights, out=np.zeros_like(density), where=weights > 1e-9)
+        # FFT leaves tiny negative values instead of zeros
+        np.clip(density, 0, None, out=density)
+        crop_y = yoff - halo_yoff
+        crop_x = xoff - halo_xoff
+        return density[crop_y:crop_y + ysize, crop_x:crop_x + xsize]
+
+# Example usage
+# kernel = density_kernel('gaussian', bandwidth=1000 / pixel_size)
+# density = DensitySurface(counts_array, kernel, mask_band=raster_ds.GetRasterBand(1))
+# CountRasterWriter(raster_ds).write(output_density_path, [('occurrence density', density)], dtype=(gdal.GDT_Float32, np.float32))
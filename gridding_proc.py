@@ -0,0 +1,805 @@
+# gridding_proc.py
+# includes array-based methods to bin occurrence coordinates into pixels of the input raster dataset (whole chunks of GBIF datacube are processed at once, without iterating over rows)
+# should be imported as classes and functions
+
+import numpy as np
+import pandas as pd
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import hashlib
+import json
+import os
+from pyproj import Transformer
+
+# transformers are cached per pair of CRS, so they are not rebuilt for every chunk (and once per worker in parallel mode)
+_transformers = {}
+
+
+def _crs_code(crs):
+    """
+    Normalises the CRS definition to compare it ('4326', 4326 and 'EPSG:4326' are the same).
+    """
+    crs = str(crs).strip().upper()
+    return crs[5:] if crs.startswith('EPSG:') else crs
+
+
+def transform_coordinates(lat_array, lon_array, raster_crs, csv_crs='EPSG:4326'):
+    """
+    Transforms coordinates of occurrences from the CRS of GBIF datacube into the CRS of the raster dataset.
+
+    Args:
+        lat_array (np.ndarray): Latitudes of occurrences.
+        lon_array (np.ndarray): Longitudes of occurrences.
+        raster_crs: CRS of the raster dataset (EPSG code or any definition supported by pyproj).
+        csv_crs: CRS of GBIF datacube (always EPSG:4326).
+
+    Returns:
+        tuple[np.ndarray, np.ndarray]: X and Y coordinates in the CRS of the raster dataset.
+    """
+    if _crs_code(raster_crs) == _crs_code(csv_crs):
+        # geographic raster in the CRS of GBIF datacube: longitude is X and latitude is Y, no reprojection needed
+        return np.asarray(lon_array, dtype=np.float64), np.asarray(lat_array, dtype=np.float64)
+
+    key = (str(csv_crs), str(raster_crs))
+    if key not in _transformers:
+        raster_crs = f"EPSG:{raster_crs}" if str(raster_crs).isdigit() else raster_crs
+        _transformers[key] = Transformer.from_crs(csv_crs, raster_crs, always_xy=True)
+    x, y = _transformers[key].transform(lon_array, lat_array)
+    return np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+
+
+class RasterGrid:
+    """
+    Georeferencing of the input raster dataset which is used to bin occurrence records into its pixels.
+    """
+
+    def __init__(self, geo_transform, x_size, y_size):
+        """
+        Initializes the grid with the geotransform and the size of the raster dataset.
+
+        Args:
+            geo_transform (tuple): GDAL geotransform (top-left x, x resolution, 0, top-left y, 0, y resolution).
+            x_size (int): Number of columns of the raster dataset.
+            y_size (int): Number of rows of the raster dataset.
+        """
+        self.geo_transform = tuple(geo_transform)
+        self.x_size = int(x_size)
+        self.y_size = int(y_size)
+
+    @classmethod
+    def from_dataset(cls, raster_ds):
+        """
+        Creates the grid from the opened GDAL raster dataset.
+        """
+        return cls(raster_ds.GetGeoTransform(), raster_ds.RasterXSize, raster_ds.RasterYSize)
+
+    @property
+    def shape(self):
+        return self.y_size, self.x_size
+
+    @property
+    def extent(self):
+        """
+        Returns the spatial extent of the raster dataset as (minx, miny, maxx, maxy).
+        """
+        geo = self.geo_transform
+        return (
+            geo[0],  # minx
+            geo[3] + geo[5] * self.y_size,  # miny
+            geo[0] + geo[1] * self.x_size,  # maxx
+            geo[3]  # maxy
+        )
+
+    def within_extent(self, x_cart, y_cart):
+        """
+        Checks which points are within the extent of the raster dataset (borders included).
+
+        Args:
+            x_cart (np.ndarray): X coordinates in the CRS of the raster dataset.
+            y_cart (np.ndarray): Y coordinates in the CRS of the raster dataset.
+
+        Returns:
+            np.ndarray: Boolean mask, True for points within the extent (False for points outside and missing coordinates).
+        """
+        minx, miny, maxx, maxy = self.extent
+        x_cart = np.asarray(x_cart, dtype=np.float64)
+        y_cart = np.asarray(y_cart, dtype=np.float64)
+        return (x_cart >= minx) & (x_cart <= maxx) & (y_cart >= miny) & (y_cart <= maxy)
+
+    def pixel_indices(self, x_cart, y_cart):
+        """
+        Calculates pixel indices of points which are within the extent of the raster dataset.
+
+        Args:
+            x_cart (np.ndarray): X coordinates in the CRS of the raster dataset.
+            y_cart (np.ndarray): Y coordinates in the CRS of the raster dataset.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: Row and column indices (int64) of pixels.
+        """
+        geo = self.geo_transform
+        # truncation is the same as flooring here, because points are never left or above the top-left corner
+        pixel_col = np.trunc((np.asarray(x_cart, dtype=np.float64) - geo[0]) / geo[1]).astype(np.int64)  # column index
+        pixel_row = np.trunc((np.asarray(y_cart, dtype=np.float64) - geo[3]) / geo[5]).astype(np.int64)  # row index
+        # points lying exactly on the right or bottom border belong to the last column or row
+        np.clip(pixel_col, 0, self.x_size - 1, out=pixel_col)
+        np.clip(pixel_row, 0, self.y_size - 1, out=pixel_row)
+        return pixel_row, pixel_col
+
+    def bin_points(self, x_cart, y_cart):
+        """
+        Bins points into pixels of the raster dataset.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray, np.ndarray]: Boolean mask of points within the extent, row and column indices of these points.
+        """
+        inside = self.within_extent(x_cart, y_cart)
+        pixel_row, pixel_col = self.pixel_indices(np.asarray(x_cart)[inside], np.asarray(y_cart)[inside])
+        return inside, pixel_row, pixel_col
+
+    def flat_indices(self, pixel_row, pixel_col):
+        """
+        Converts row and column indices into flat (row-major) indices of pixels.
+        """
+        return np.asarray(pixel_row, dtype=np.int64) * self.x_size + np.asarray(pixel_col, dtype=np.int64)
+
+
+def count_pixels(flat_idx, group_values=None):
+    """
+    Aggregates flat pixel indices of one chunk into sparse counts (optionally, separately for every group of records).
+
+    Args:
+        flat_idx (np.ndarray): Flat pixel indices of records (might be repeated).
+        group_values (np.ndarray): Values of the group-by column for the same records (None to count all records together).
+
+    Returns:
+        dict: Partial counts {group value: (unique flat pixel indices, counts)}, the only key is None if records are not grouped.
+    """
+    flat_idx = np.asarray(flat_idx, dtype=np.int64)
+    if group_values is None:
+        pixels, counts = np.unique(flat_idx, return_counts=True)
+        return {None: (pixels, counts)}
+
+    # codes of groups (missing values form their own group) combined with pixel indices into one integer key
+    codes, groups = pd.factorize(np.asarray(group_values), use_na_sentinel=False)
+    n_pixels = int(flat_idx.max()) + 1 if flat_idx.size else 1
+    keys, counts = np.unique(codes.astype(np.int64) * n_pixels + flat_idx, return_counts=True)
+    key_codes = keys // n_pixels
+    partial = {}
+    for code in np.unique(key_codes):
+        selected = key_codes == code
+        group = groups[code]
+        group = 'missing' if pd.isna(group) else (group.item() if hasattr(group, 'item') else group)
+        if isinstance(group, float) and group.is_integer():
+            group = int(group)  # keys are read as floats if some of them are missing
+        partial[group] = (keys[selected] % n_pixels, counts[selected])
+    return partial
+
+
+def distinct_pairs(flat_idx, values):
+    """
+    Deduplicates (pixel, value) pairs of one chunk, for example (pixel, speciesKey) to count distinct species in every pixel. Missing values are dropped.
+
+    Args:
+        flat_idx (np.ndarray): Flat pixel indices of records.
+        values (np.ndarray): Values to count distinct (for the same records).
+
+    Returns:
+        tuple: Flat pixel indices and values of unique pairs.
+    """
+    pairs = pd.DataFrame({'pixel': np.asarray(flat_idx, dtype=np.int64), 'value': values}).dropna().drop_duplicates()
+    return pairs['pixel'].values, pairs['value'].values
+
+
+class SparseCounts:
+    """
+    Sparse (COO) array of counts which keeps only occupied pixels as sorted flat indices with their counts,
+    so memory scales with the number of occupied pixels, not with the area of the raster dataset.
+    Dense windows are built only on demand (tile by tile, when the output raster is written).
+    """
+
+    def __init__(self, shape, dtype=np.int32):
+        self.shape = tuple(shape)
+        self.dtype = dtype
+        self.pixels = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=dtype)
+        self._buffer = []
+        self._buffered = 0
+
+    def add_counts(self, pixels, counts):
+        """
+        Adds counts for flat pixel indices. Partial counts are buffered and merged once the buffer is as large as the merged counts.
+        """
+        self._buffer.append((np.asarray(pixels, dtype=np.int64), np.asarray(counts, dtype=self.dtype)))
+        self._buffered += len(pixels)
+        if self._buffered >= max(len(self.pixels), 1000000):
+            self.compact()
+
+    def compact(self):
+        """
+        Merges buffered partial counts into sorted unique flat indices.
+        """
+        if not self._buffer:
+            return
+        pixels = np.concatenate([self.pixels] + [buffered[0] for buffered in self._buffer])
+        counts = np.concatenate([self.counts] + [buffered[1] for buffered in self._buffer])
+        self.pixels, inverse = np.unique(pixels, return_inverse=True)
+        self.counts = np.bincount(inverse, weights=counts, minlength=len(self.pixels)).astype(self.dtype)
+        self._buffer = []
+        self._buffered = 0
+
+    def read_window(self, xoff, yoff, xsize, ysize):
+        """
+        Builds the dense window of counts (for writing the output raster tile by tile).
+        """
+        self.compact()
+        x_size = self.shape[1]
+        window = np.zeros((ysize, xsize), dtype=self.dtype)
+        # flat indices of the rows of the window are continuous ranges of the sorted array
+        first = np.searchsorted(self.pixels, yoff * x_size + xoff)
+        last = np.searchsorted(self.pixels, (yoff + ysize - 1) * x_size + xoff + xsize)
+        pixels = self.pixels[first:last]
+        rows = pixels // x_size - yoff
+        cols = pixels % x_size - xoff
+        selected = (cols >= 0) & (cols < xsize)
+        window[rows[selected], cols[selected]] = self.counts[first:last][selected]
+        return window
+
+    def max(self):
+        self.compact()
+        return self.counts.max() if len(self.counts) else 0
+
+    def sum(self):
+        self.compact()
+        return self.counts.sum()
+
+    def toarray(self):
+        """
+        Returns the dense array of counts (only for small rasters).
+        """
+        return self.read_window(0, 0, self.shape[1], self.shape[0])
+
+    @property
+    def nbytes(self):
+        return self.pixels.nbytes + self.counts.nbytes
+
+
+def _empty_counts(shape, dtype, sparse):
+    """
+    Creates the empty array of counts: dense raster-shaped array or sparse array of occupied pixels.
+    """
+    return SparseCounts(shape, dtype=dtype) if sparse else np.zeros(shape, dtype=dtype)
+
+
+def _add_counts(target, pixels, counts):
+    """
+    Adds counts for unique flat pixel indices to the dense or sparse array of counts.
+    """
+    if isinstance(target, SparseCounts):
+        target.add_counts(pixels, counts)
+    else:
+        target.ravel()[pixels] += counts.astype(target.dtype, copy=False)
+
+
+def block_shape(shape, factor):
+    """
+    Defines the shape of the coarser level of counts (partial blocks at the right and bottom edges are kept, as in GDAL overviews).
+    """
+    return tuple(-(-size // factor) for size in shape)
+
+
+def block_sum(counts, factor):
+    """
+    Aggregates counts into the coarser grid by exact summation of factor x factor blocks of pixels (for example, 100 m into 1 km with factor 10).
+
+    Args:
+        counts (np.ndarray or SparseCounts): Counts at the base resolution.
+        factor (int): Aggregation factor (number of base pixels along each side of the coarser pixel).
+
+    Returns:
+        np.ndarray or SparseCounts: Counts at the coarser resolution (of the same type as input counts).
+    """
+    factor = int(factor)
+    if factor < 1:
+        raise ValueError(f"Aggregation factor must be a positive integer, got {factor}.")
+    shape = block_shape(counts.shape, factor)
+    if isinstance(counts, SparseCounts):
+        # flat indices of occupied pixels are mapped to the coarser grid and summed up
+        counts.compact()
+        rows = counts.pixels // counts.shape[1] // factor
+        cols = counts.pixels % counts.shape[1] // factor
+        coarse = SparseCounts(shape, dtype=np.int64)
+        coarse.add_counts(rows * shape[1] + cols, counts.counts)
+        coarse.compact()
+        return coarse
+    # raster-shaped array is padded with zeros to the multiple of factor, then blocks are summed up along both axes
+    padded = np.zeros((shape[0] * factor, shape[1] * factor), dtype=np.int64)
+    padded[:counts.shape[0], :counts.shape[1]] = counts
+    return padded.reshape(shape[0], factor, shape[1], factor).sum(axis=(1, 3))
+
+
+class DistinctCountAccumulator:
+    """
+    Streaming accumulator of the number of distinct values in every pixel (species richness, distinct threatened species, distinct year-months sampled).
+    Values are encoded as integer codes and pairs are kept as sorted unique keys (code * number of pixels + pixel), deduplicated across chunks,
+    so memory scales with the number of distinct (pixel, value) pairs, not with the number of records. Keys fit into 64-bit integers
+    for any raster dataset (for example, 10 m national rasters with billions of pixels), as long as codes x pixels < 2^63.
+    """
+
+    def __init__(self, shape, description):
+        """
+        Initializes the accumulator.
+
+        Args:
+            shape (tuple): Shape of the raster dataset (rows, columns).
+            description (str): Description of the output band, for example 'species richness'.
+        """
+        self.shape = tuple(shape)
+        self.description = description
+        self.values = pd.Index([])  # distinct values seen so far, codes are their positions
+        self.pixel_count = int(self.shape[0]) * int(self.shape[1])
+        self.max_codes = np.iinfo(np.int64).max // max(self.pixel_count, 1)
+        self.keys = np.empty(0, dtype=np.int64)
+        self._buffer = []
+        self._buffered = 0
+
+    def add_pairs(self, pixels, values):
+        """
+        Adds (pixel, value) pairs of one chunk (see distinct_pairs).
+        """
+        if len(pixels) == 0:
+            return
+        codes = self.values.get_indexer(values)
+        if (codes < 0).any():
+            self.values = self.values.append(pd.Index(pd.unique(values[codes < 0])))
+            if len(self.values) > self.max_codes:
+                raise OverflowError(f"{len(self.values)} distinct values of '{self.description}' in {self.pixel_count} pixels don't fit into 64-bit keys.")
+            codes = self.values.get_indexer(values)
+        self._buffer.append(np.unique(codes.astype(np.int64) * self.pixel_count + np.asarray(pixels, dtype=np.int64)))
+        self._buffered += len(self._buffer[-1])
+        if self._buffered >= max(len(self.keys), 1000000):
+            self.compact()
+
+    def compact(self):
+        """
+        Merges buffered keys into sorted unique keys.
+        """
+        if not self._buffer:
+            return
+        self.keys = np.unique(np.concatenate([self.keys] + self._buffer))
+        self._buffer = []
+        self._buffered = 0
+
+    def counts(self, factor=1):
+        """
+        Returns the number of distinct values in every pixel. For the coarser level (factor > 1) values are deduplicated
+        within blocks of pixels, since distinct counts can't be summed up.
+
+        Args:
+            factor (int): Aggregation factor (1 - resolution of the raster dataset).
+
+        Returns:
+            SparseCounts: Distinct counts.
+        """
+        self.compact()
+        pixels = self.keys % self.pixel_count
+        shape = self.shape
+        if factor > 1:
+            shape = block_shape(self.shape, factor)
+            pixels = (pixels // self.shape[1] // factor) * shape[1] + pixels % self.shape[1] // factor
+            # the number of coarse pixels is smaller, so coarse keys fit into 64-bit integers as well
+            keys = np.unique((self.keys // self.pixel_count) * (shape[0] * shape[1]) + pixels)
+            pixels = keys % (shape[0] * shape[1])
+        distinct_counts = SparseCounts(shape, dtype=np.int32)
+        distinct_counts.pixels, distinct_counts.counts = np.unique(pixels, return_counts=True)
+        distinct_counts.counts = distinct_counts.counts.astype(np.int32)
+        return distinct_counts
+
+    def bands(self, factor=1):
+        return [(self.description, self.counts(factor))]
+
+
+def count_pyramid(bands, factors):
+    """
+    Builds coarser levels of counts from bands at the base resolution (one binning pass, levels are exact sums of base counts).
+
+    Args:
+        bands (list): List of (band description, counts) at the base resolution.
+        factors (list): Aggregation factors relative to the base resolution, for example [10, 100].
+
+    Returns:
+        list: List of (factor, bands) for each level.
+    """
+    return [(int(factor), [(description, block_sum(counts, factor)) for description, counts in bands]) for factor in sorted(set(factors))]
+
+
+class CountAccumulator:
+    """
+    Streaming accumulator of occurrence counts: every chunk is added straight into the raster-shaped array of counts,
+    so memory is bounded by the size of chunk and raster dataset (not by the number of processed records).
+    """
+
+    def __init__(self, shape, dtype=np.int32, sparse=False):
+        """
+        Initializes the accumulator with the empty array of counts.
+
+        Args:
+            shape (tuple): Shape of the raster dataset (rows, columns).
+            dtype: Data type of the array of counts.
+            sparse (bool): To keep only occupied pixels (for very large or fine-resolution rasters) instead of the raster-shaped array.
+        """
+        self.shape = tuple(shape)
+        self.counts = _empty_counts(self.shape, dtype, sparse)
+
+    def add(self, flat_idx):
+        """
+        Adds one occurrence for every flat pixel index (indices might be repeated).
+        """
+        # count occurrences per pixel within the chunk only (sorting is bounded by chunk size, not by raster size)
+        self.add_partial(count_pixels(flat_idx))
+
+    def add_partial(self, partial):
+        """
+        Adds partial counts returned by count_pixels (all groups are summed up).
+        """
+        for pixels, counts in partial.values():
+            self.add_counts(pixels, counts)
+
+    def add_counts(self, pixels, counts):
+        """
+        Adds pre-aggregated counts for unique flat pixel indices.
+        """
+        _add_counts(self.counts, pixels, counts)
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    @property
+    def bands(self):
+        """
+        Returns the list of (band description, array of counts) to be written to the output raster.
+        """
+        return [('occurrence count', self.counts)]
+
+
+class GroupedCountAccumulator:
+    """
+    Streaming accumulator of occurrence counts separately for every group of records (for example, every speciesKey or classKey),
+    so all groups are counted in one read of the datacube and can be written as separate bands of one raster.
+    """
+
+    def __init__(self, shape, group_by, dtype=np.int32, describe=None, sparse=False):
+        """
+        Initializes the accumulator without any groups (groups are added once they are found in the datacube).
+
+        Args:
+            shape (tuple): Shape of the raster dataset (rows, columns).
+            group_by (str): Name of the group-by column (used in descriptions of bands).
+            dtype: Data type of the arrays of counts.
+            describe (callable): Function to convert the value of group into the description of band ('group_by=value' by default).
+            sparse (bool): To keep only occupied pixels of each group instead of raster-shaped arrays.
+        """
+        self.shape = tuple(shape)
+        self.group_by = group_by
+        self.dtype = dtype
+        self.describe = describe or (lambda group: f"{self.group_by}={group}")
+        self.sparse = sparse
+        self.groups = {}
+
+    def add(self, flat_idx, group_values):
+        """
+        Adds one occurrence for every flat pixel index to the group of the record.
+        """
+        self.add_partial(count_pixels(flat_idx, group_values))
+
+    def add_partial(self, partial):
+        """
+        Adds partial counts returned by count_pixels to the corresponding groups.
+        """
+        for group, (pixels, counts) in partial.items():
+            if group not in self.groups:
+                self.groups[group] = _empty_counts(self.shape, self.dtype, self.sparse)
+            _add_counts(self.groups[group], pixels, counts)
+
+    @property
+    def total(self):
+        return int(sum(counts.sum() for counts in self.groups.values()))
+
+    @property
+    def bands(self):
+        """
+        Returns the list of (band description, array of counts) sorted by values of groups.
+        """
+        try:
+            groups = sorted(self.groups)
+        except TypeError:  # values of different types (for example, numbers and 'missing')
+            groups = sorted(self.groups, key=str)
+        return [(self.describe(group), self.groups[group]) for group in groups]
+
+
+def temporal_periods(year_month, window=1):
+    """
+    Converts values of 'yearMonth' column ('YYYY-MM') into time periods: years or multi-year windows aligned to multiples of the window (for example, 2000-2004).
+
+    Args:
+        year_month (np.ndarray): Values of 'yearMonth' column.
+        window (int): Length of the time period in years.
+
+    Returns:
+        np.ndarray: First year of the period for every record (NaN if the year is missing).
+    """
+    years = pd.to_numeric(pd.Series(np.asarray(year_month)).astype(str).str[:4], errors='coerce').to_numpy(dtype=np.float64)
+    if window > 1:
+        years = np.floor(years / window) * window
+    return years
+
+
+def describe_period(window=1):
+    """
+    Returns the function to describe bands of temporal datacube (for example, 'year=2010' or 'period=2000-2004').
+    """
+    if window > 1:
+        return lambda start: "period=missing" if start == 'missing' else f"period={start}-{start + window - 1}"
+    return lambda year: f"year={year}"
+
+
+class GriddingTarget:
+    """
+    Input raster dataset (target grid) which occurrences are binned into, with its own accumulator of counts.
+    Several targets might be processed in one pass over the datacube.
+    """
+
+    def __init__(self, name, grid, raster_crs, accumulator, output_raster_path, raster_ds=None):
+        """
+        Initializes the target.
+
+        Args:
+            name (str): Name of the target (filename of the raster dataset).
+            grid (RasterGrid): Grid of the raster dataset.
+            raster_crs: CRS of the raster dataset.
+            accumulator: Accumulator of counts (CountAccumulator or GroupedCountAccumulator).
+            output_raster_path (str): Path to the output GeoTIFF.
+            raster_ds (gdal.Dataset): Opened raster dataset (to write the output with its nodata mask).
+        """
+        self.name = name
+        self.grid = grid
+        self.raster_crs = raster_crs
+        self.accumulator = accumulator
+        self.output_raster_path = output_raster_path
+        self.raster_ds = raster_ds
+        self.false_count = 0  # number of records outside of the extent
+        self.distinct_accumulators = {}  # accumulators of distinct values {metric: DistinctCountAccumulator}, written as additional bands
+
+    @property
+    def bands(self):
+        """
+        Returns bands of counts followed by bands of distinct counts.
+        """
+        return self.accumulator.bands + [band for accumulator in self.distinct_accumulators.values() for band in accumulator.bands()]
+
+    def levels(self, factors):
+        """
+        Returns coarser levels of all bands: counts are summed up by blocks, distinct counts are deduplicated within blocks (see count_pyramid).
+        """
+        levels = count_pyramid(self.accumulator.bands, factors)
+        return [(factor, level_bands + [band for accumulator in self.distinct_accumulators.values() for band in accumulator.bands(factor)]) for factor, level_bands in levels]
+
+    @property
+    def spec(self):
+        """
+        Returns the grid and CRS of the target (everything workers need to bin records).
+        """
+        return self.grid, self.raster_crs
+
+
+def targets_by_crs(target_specs):
+    """
+    Groups targets by CRS, so every chunk is reprojected only once for each distinct CRS.
+
+    Args:
+        target_specs (list): List of (grid, raster_crs) tuples.
+
+    Returns:
+        dict: {CRS code: list of indices of targets}.
+    """
+    groups = {}
+    for target_num, (_, raster_crs) in enumerate(target_specs):
+        groups.setdefault(_crs_code(raster_crs), []).append(target_num)
+    return groups
+
+
+def count_chunk(lat_array, lon_array, target_specs, group_values=None, xy=None, return_xy=False, distinct_values=None):
+    """
+    Reprojects and bins one chunk of occurrences into pixel counts of every target grid (this function is run by workers in parallel mode).
+    Coordinates are transformed only once for each distinct CRS of targets.
+
+    Args:
+        lat_array (np.ndarray): Latitudes of occurrences.
+        lon_array (np.ndarray): Longitudes of occurrences.
+        target_specs (list): List of (grid, raster_crs) tuples of target rasters.
+        group_values (np.ndarray): Values of the group-by column (None to count all records together).
+        xy (dict): Coordinates already transformed into CRS of targets {CRS code: (x, y)} (from the reprojection cache).
+        return_xy (bool): To return transformed coordinates as well (to write them to the reprojection cache).
+        distinct_values (dict): Values to count distinct in every pixel {metric: values}, for example {'richness': species keys}.
+
+    Returns:
+        tuple: List of partial counts (see count_pixels) and list of numbers of records outside of the extent (one item for each target),
+        number of records in the chunk, transformed coordinates {CRS code: (x, y)} (None unless return_xy is True)
+        and list of unique pairs {metric: (pixels, values)} for every target (see distinct_pairs).
+    """
+    xy = dict(xy or {})
+    partials = [None] * len(target_specs)
+    false_counts = [0] * len(target_specs)
+    distinct_partials = [{} for _ in target_specs]
+    n_records = 0
+    for crs_code, target_nums in targets_by_crs(target_specs).items():
+        if crs_code not in xy:
+            xy[crs_code] = transform_coordinates(lat_array, lon_array, target_specs[target_nums[0]][1])
+        x_cart, y_cart = xy[crs_code]
+        n_records = len(x_cart)
+        for target_num in target_nums:
+            grid = target_specs[target_num][0]
+            inside, pixel_row, pixel_col = grid.bin_points(x_cart, y_cart)
+            values = np.asarray(group_values)[inside] if group_values is not None else None
+            flat_idx = grid.flat_indices(pixel_row, pixel_col)
+            partials[target_num] = count_pixels(flat_idx, values)
+            false_counts[target_num] = int(np.count_nonzero(~inside))
+            for metric, metric_values in (distinct_values or {}).items():
+                distinct_partials[target_num][metric] = distinct_pairs(flat_idx, np.asarray(metric_values)[inside])
+    return partials, false_counts, n_records, (xy if return_xy else None), distinct_partials
+
+
+def parallel_count_chunks(chunks, target_specs, workers, max_pending=None, return_xy=False):
+    """
+    Sends chunks of occurrences to the pool of processes and yields partial (sparse) counts as soon as they are ready.
+    The number of chunks submitted at the same time is limited, so memory is still bounded by the chunk size.
+    Worker processes are started before the first chunk is read from chunks.
+
+    Args:
+        chunks (iterable): Iterable of (lat_array, lon_array, group_values, xy, distinct_values) tuples (all but coordinates might be None, see count_chunk).
+        target_specs (list): List of (grid, raster_crs) tuples of target rasters.
+        workers (int): Number of worker processes.
+        max_pending (int): Maximum number of chunks submitted at the same time (twice the number of workers by default).
+        return_xy (bool): To return transformed coordinates of every chunk as well.
+
+    Yields:
+        tuple: Partial counts in the same format as returned by count_chunk, in the order of chunks.
+    """
+    # workers are forked, so the main script is not re-executed in every worker
+    context = multiprocessing.get_context('fork')
+    max_pending = max_pending or 2 * workers
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context) as executor:
+        # all workers are forked at the first submit, which is done before the first chunk is read,
+        # so that they are not forked while threads of the reader (see MultiDatacubeReader) hold locks
+        executor.submit(int).result()
+        for lat_array, lon_array, group_values, xy, distinct_values in chunks:
+            pending.append(executor.submit(count_chunk, lat_array, lon_array, target_specs, group_values, xy, return_xy, distinct_values))
+            if len(pending) >= max_pending:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+def datacube_fingerprint(path, sample_size=1048576):
+    """
+    Calculates the fingerprint of the datacube without reading the whole file: its size and the first and last megabyte of content
+    (for Parquet cache - relative paths and sizes of all its files, for several merged datacubes - fingerprints of all of them in order).
+
+    Args:
+        path (str or list): Path to the datacube (ZIP archive, CSV file or directory with Parquet dataset) or list of paths.
+        sample_size (int): Number of bytes read from the beginning and the end of the file.
+
+    Returns:
+        str: Hexadecimal SHA-256 digest.
+    """
+    digest = hashlib.sha256()
+    if isinstance(path, (list, tuple)):
+        for datacube_path in path:
+            digest.update(datacube_fingerprint(datacube_path, sample_size).encode())
+        return digest.hexdigest()
+    if os.path.isdir(path):
+        for root, _, files in sorted(os.walk(path)):
+            for filename in sorted(files):
+                file_path = os.path.join(root, filename)
+                digest.update(f"{os.path.relpath(file_path, path)}:{os.path.getsize(file_path)};".encode())
+        return digest.hexdigest()
+
+    size = os.path.getsize(path)
+    digest.update(str(size).encode())
+    with open(path, 'rb') as file:
+        digest.update(file.read(sample_size))
+        if size > sample_size:
+            file.seek(max(size - sample_size, sample_size))
+            digest.update(file.read(sample_size))
+    return digest.hexdigest()
+
+
+class ReprojectionCache:
+    """
+    Persistent sidecar cache of occurrence coordinates transformed into the CRS of the raster dataset (X and Y as memory-mapped float64 arrays),
+    keyed by the fingerprint of the datacube and the target CRS. Gridding against other rasters in the same CRS skips reprojection completely.
+    """
+
+    def __init__(self, cache_dir, datacube_path, raster_crs):
+        """
+        Initializes the cache for the datacube and the target CRS.
+
+        Args:
+            cache_dir (str): Directory to store cached coordinates.
+            datacube_path (str or list): Path to the datacube or list of merged datacubes (records must be read in the same order in every run).
+            raster_crs: CRS of the raster dataset.
+        """
+        self.cache_dir = cache_dir
+        key = hashlib.sha256(f"{datacube_fingerprint(datacube_path)}|{_crs_code(raster_crs)}".encode()).hexdigest()[:24]
+        self.x_path = os.path.join(cache_dir, f"{key}_x.f64")
+        self.y_path = os.path.join(cache_dir, f"{key}_y.f64")
+        self.meta_path = os.path.join(cache_dir, f"{key}.json")
+        self.total_rows = None
+        if os.path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as file:
+                self.total_rows = json.load(file)['rows']
+        self._x = None
+        self._y = None
+        self._x_file = None
+        self._y_file = None
+
+    @property
+    def complete(self):
+        """
+        Checks if coordinates of all records have been cached (by the previous run).
+        """
+        return self.total_rows is not None and os.path.exists(self.x_path) and os.path.exists(self.y_path)
+
+    def read(self, offset, n_rows):
+        """
+        Reads transformed coordinates of n_rows records starting from the offset (memory-mapped, nothing else is loaded).
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: X and Y coordinates in the CRS of the raster dataset.
+        """
+        if self._x is None:
+            self._x = np.memmap(self.x_path, dtype=np.float64, mode='r', shape=(self.total_rows,))
+            self._y = np.memmap(self.y_path, dtype=np.float64, mode='r', shape=(self.total_rows,))
+        if offset + n_rows > self.total_rows:
+            raise ValueError("Reprojection cache does not match the datacube (fewer records cached). Please delete the cache and run again.")
+        return np.asarray(self._x[offset:offset + n_rows]), np.asarray(self._y[offset:offset + n_rows])
+
+    def append(self, x_cart, y_cart):
+        """
+        Appends transformed coordinates of the next chunk (while the cache is being built).
+        """
+        if self._x_file is None:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            self._x_file = open(self.x_path, 'wb')
+            self._y_file = open(self.y_path, 'wb')
+        np.asarray(x_cart, dtype=np.float64).tofile(self._x_file)
+        np.asarray(y_cart, dtype=np.float64).tofile(self._y_file)
+
+    def finish(self, total_rows):
+        """
+        Marks the cache as complete once coordinates of all records have been appended.
+        """
+        if self._x_file is None:
+            return
+        self._x_file.close()
+        self._y_file.close()
+        self._x_file = self._y_file = None
+        with open(self.meta_path, 'w') as file:
+            json.dump({'rows': int(total_rows)}, file)
+        self.total_rows = int(total_rows)
+
+
+def fork_available():
+    """
+    Checks if worker processes can be forked on the current platform (not available on Windows).
+    """
+    return 'fork' in multiprocessing.get_all_start_methods()
+
+# Example usage
+# grid = RasterGrid.from_dataset(gdal.Open(raster_path))
+# inside, pixel_row, pixel_col = grid.bin_points(x_cart, y_cart)
+# accumulator = CountAccumulator(grid.shape)
+# accumulator.add(grid.flat_indices(pixel_row, pixel_col))
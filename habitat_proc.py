@@ -0,0 +1,98 @@
+# habitat_proc.py
+# includes methods to check if land-cover classes are suitable habitats of species (IUCN Habitats Classification Scheme),
+# for the whole chunk of occurrences at once through the precomputed species x class lookup matrix
+# should be imported as a class
+
+import numpy as np
+import pandas as pd
+import re
+
+
+def parse_codes(value):
+    """
+    Splits the cell with IUCN habitat codes concatenated by '|' or ',' (for example, '1.4|14.1|3.8') into the list of codes.
+    """
+    if pd.isna(value):
+        return []
+    return [code.strip() for code in re.split(r'[|,;]', str(value)) if code.strip()]
+
+
+def habitat_matches(species_code, crosswalk_code):
+    """
+    Checks if the habitat code of species belongs to the habitat code of the crosswalk, for example '1.4' (Forest - Temperate) belongs to '1' (Forest).
+    """
+    return species_code == crosswalk_code or species_code.startswith(crosswalk_code + '.')
+
+
+class HabitatSuitability:
+    """
+    Boolean lookup matrix (species x land-cover class): True if the class is a suitable habitat of the species.
+    Occurrences are filtered by the matrix for the whole chunk at once, without joining habitats to every record.
+    """
+
+    def __init__(self, species_habitats, crosswalk):
+        """
+        Initializes the lookup matrix.
+
+        Args:
+            species_habitats (dict): IUCN habitat codes of species {speciesKey: list of codes}.
+            crosswalk (dict): IUCN habitat codes corresponding to land-cover classes {class value: list of codes}.
+        """
+        self.species_index = pd.Index(list(species_habitats.keys()))
+        self.class_index = pd.Index(list(crosswalk.keys()))
+        self.matrix = np.zeros((len(self.species_index), len(self.class_index)), dtype=bool)
+        for species_num, species_codes in enumerate(species_habitats.values()):
+            for class_num, class_codes in enumerate(crosswalk.values()):
+                self.matrix[species_num, class_num] = any(habitat_matches(species_code, class_code) for species_code in species_codes for class_code in class_codes)
+
+    @classmethod
+    def from_files(cls, iucn_csv, gbif_key_csv, crosswalk_csv):
+        """
+        Creates the lookup matrix from the output of 2_dopa_get_species.py (habitat codes of species), the output of _1_gbif_lookup.py
+        (GBIF species keys of the same species) and the crosswalk table between land-cover classes and IUCN habitat codes.
+
+        Args:
+            iucn_csv (str): Path to concatenated IUCN data ('binomial' and 'habitat_code' columns, separated by '|').
+            gbif_key_csv (str): Path to species mapped to GBIF ('canonicalName' and 'gbifSpeciesKey' columns).
+            crosswalk_csv (str): Path to the crosswalk table ('class' and 'habitat_code' columns, one row for each pair or codes separated by '|').
+
+        Returns:
+            HabitatSuitability: Lookup matrix.
+        """
+        iucn_df = pd.read_csv(iucn_csv, sep='|', dtype=str)
+        # one row for every name and species key, so that habitat codes are not repeated by the merge
+        gbif_df = pd.read_csv(gbif_key_csv).dropna(subset=['gbifSpeciesKey']).drop_duplicates(subset=['canonicalName', 'gbifSpeciesKey'])
+        # species are matched by scientific name, the datacube is keyed by GBIF speciesKey
+        species_df = iucn_df.merge(gbif_df, left_on='binomial', right_on='canonicalName', how='inner')
+        species_habitats = {}
+        for species_key, habitat_code in zip(species_df['gbifSpeciesKey'].astype('int64'), species_df['habitat_code']):
+            species_habitats.setdefault(species_key, []).extend(parse_codes(habitat_code))
+
+        crosswalk_df = pd.read_csv(crosswalk_csv, dtype={'habitat_code': str})
+        crosswalk = {}
+        for class_value, habitat_code in zip(crosswalk_df['class'], crosswalk_df['habitat_code']):
+            crosswalk.setdefault(class_value, []).extend(parse_codes(habitat_code))
+        return cls(species_habitats, crosswalk)
+
+    def suitable(self, species_keys, classes):
+        """
+        Checks if classes of pixels are suitable habitats of species for every occurrence.
+        Occurrences of species without IUCN habitat codes and occurrences in classes missing in the crosswalk are treated as unsuitable.
+
+        Args:
+            species_keys (np.ndarray): Species keys of occurrences.
+            classes (np.ndarray): Land-cover classes in pixels of the same occurrences.
+
+        Returns:
+            np.ndarray: Boolean mask, True for occurrences in suitable habitats.
+        """
+        species_nums = self.species_index.get_indexer(pd.array(species_keys))
+        class_nums = self.class_index.get_indexer(classes)
+        known = (species_nums >= 0) & (class_nums >= 0)
+        suitable = np.zeros(len(species_nums), dtype=bool)
+        suitable[known] = self.matrix[species_nums[known], class_nums[known]]
+        return suitable
+
+# Example usage
+# habitat_suitability = HabitatSuitability.from_files('output/concat_species_IUCN.csv', 'output/mapped_species_GBIF.csv', 'input/habitat_crosswalk.csv')
+# suitable = habitat_suitability.suitable(species_keys, zone_lookup.lookup(pixel_row, pixel_col))
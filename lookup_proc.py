@@ -0,0 +1,378 @@
+# lookup_proc.py
+# includes methods to send requests to remote APIs (GBIF Species API, DOPA REST services) concurrently, within the rate limit
+# and with results returned in the same order as input names, the persistent on-disk cache of their responses
+# and checkpoints of results, so that interrupted or repeated lookups resolve only new or changed names.
+# Input names are parsed into canonical names and authorship first, so that every canonical name is looked up only once
+# should be imported as classes and functions
+
+import threading
+import time
+import json
+import os
+import hashlib
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+
+# rank markers of infraspecific names (kept in canonical names in one spelling)
+RANK_MARKERS = {'subsp.': 'subsp.', 'subsp': 'subsp.', 'ssp.': 'subsp.', 'ssp': 'subsp.', 'var.': 'var.', 'var': 'var.', 'subvar.': 'subvar.', 'f.': 'f.', 'forma': 'f.'}
+
+# markers of unidentified species after the genus (the name is the genus only)
+UNIDENTIFIED_MARKERS = {'sp.', 'sp', 'spp.', 'spp', 'cf.', 'aff.'}
+
+# lower-case words of authorship which might be taken for epithets ('Aus bus de Candolle', 'Aus bus L. ex Smith')
+AUTHORSHIP_PARTICLES = {'ex', 'et', 'in', 'de', 'del', 'der', 'van', 'von', 'da', 'du', 'le', 'la', 'dos'}
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket rate limiter: requests are sent at the steady rate with short bursts up to the capacity,
+    instead of the fixed pause after every request.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Initializes the bucket (full at start).
+
+        Args:
+            rate (float): Number of requests per second (0 or None - no limit).
+            capacity (int): Maximum burst of requests (the rate rounded up by default).
+        """
+        self.rate = float(rate or 0)
+        self.capacity = float(capacity or max(1, int(self.rate + 0.999)))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Waits until the token is available and takes it.
+        """
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+def map_concurrently(function, items, workers=8):
+    """
+    Applies the function to every item in the pool of threads (requests are I/O-bound), results are returned in the same order as items.
+
+    Args:
+        function (callable): Function to apply (for example, lookup of one species name).
+        items (iterable): Items to process.
+        workers (int): Maximum number of concurrent calls (1 - one by one).
+
+    Returns:
+        list: Results in the order of items.
+    """
+    items = list(items)
+    if workers <= 1 or len(items) <= 1:
+        return [function(item) for item in items]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return list(executor.map(function, items))
+
+def parse_scientific_name(name):
+    """
+    Splits the scientific name into the canonical name (genus and up to two epithets, with rank marker of infraspecific names) and authorship,
+    for example 'Alytes cisternasii Boscá, 1879' -> ('Alytes cisternasii', 'Boscá, 1879'). Genus is capitalised and epithets are in lower case.
+
+    Args:
+        name (str): Scientific name as written by user.
+
+    Returns:
+        tuple: Canonical name and authorship (empty strings for empty names).
+    """
+    if not isinstance(name, str):
+        return '', ''
+    words = name.replace('_', ' ').split()
+    if not words:
+        return '', ''
+    # authors are capitalised words (epithets might be in upper case), unless the whole name is in upper or lower case
+    single_case = name.isupper() or name.islower()
+    canonical = [words[0].capitalize()]
+    epithets = 0
+    authorship = ''
+    for word_num, word in enumerate(words[1:], start=1):
+        if word.lower() in UNIDENTIFIED_MARKERS and epithets == 0:
+            break
+        if word.lower() in RANK_MARKERS and epithets == 1:
+            canonical.append(RANK_MARKERS[word.lower()])
+            continue
+        if epithets < 2 and word.replace('-', '').isalpha() and (single_case or not word.istitle()) and word.lower() not in AUTHORSHIP_PARTICLES:
+            canonical.append(word.lower())
+            epithets += 1
+            continue
+        authorship = ' '.join(words[word_num:])
+        break
+    if canonical[-1] in RANK_MARKERS.values():
+        canonical.pop()  # rank marker without epithet
+    return ' '.join(canonical), authorship
+
+
+def deduplicate_names(names):
+    """
+    Collapses input names into distinct canonical names (duplicates, whitespace, case variants and authorship collapse into one name to look up).
+
+    Args:
+        names (list): Scientific names as written by user.
+
+    Returns:
+        tuple: Canonical names to look up (in the order of first occurrence) and numbers of these names for every input name (-1 for empty names).
+    """
+    queries = []
+    query_nums = []
+    keys = {}
+    for name in names:
+        canonical, _ = parse_scientific_name(name)
+        if not canonical:
+            query_nums.append(-1)
+            continue
+        key = canonical.lower()
+        if key not in keys:
+            keys[key] = len(queries)
+            queries.append(canonical)
+        query_nums.append(keys[key])
+    return queries, query_nums
+
+
+def fan_out(results, query_nums, default=None):
+    """
+    Returns results of canonical names for every input name (see deduplicate_names), default for empty names.
+    """
+    return [results[query_num] if query_num >= 0 else default for query_num in query_nums]
+
+
+def report_saved_lookups(names_count, queries_count, requests_per_name=1):
+    """
+    Prints how many lookups (and remote requests) are saved by deduplication of input names.
+
+    Returns:
+        int: Number of saved lookups.
+    """
+    saved = names_count - queries_count
+    print(f"{names_count} input name(s) collapsed into {queries_count} distinct canonical name(s): {saved} lookup(s) ({saved * requests_per_name} remote request(s)) saved.")
+    return saved
+
+
+def cache_key(endpoint, params):
+    """
+    Builds the cache key from the endpoint and normalised request parameters (sorted, whitespace collapsed, lower case),
+    so that 'Lutra lutra ' and 'lutra  Lutra' are the same request.
+    """
+    normalised = {str(name): ' '.join(str(value).split()).lower() for name, value in params.items()}
+    return endpoint + '?' + json.dumps(normalised, sort_keys=True)
+
+
+class ResponseCache:
+    """
+    Persistent cache of API responses in SQLite database: entries expire after the time to live, and the least recently used entries
+    are evicted once the number of entries exceeds the limit (down to 90% of the limit, so that eviction doesn't run on every insert).
+    The cache is shared by threads sending requests.
+    """
+
+    def __init__(self, path, ttl_days=30, max_entries=100000):
+        """
+        Opens (or creates) the cache.
+
+        Args:
+            path (str): Path to SQLite database.
+            ttl_days (float): Time to live of entries in days (None - entries never expire).
+            max_entries (int): Maximum number of entries (None - no limit).
+        """
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.path = path
+        self.ttl = ttl_days * 86400 if ttl_days else None
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, value TEXT, created REAL, accessed REAL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS responses_accessed ON responses (accessed)")
+        self.connection.commit()
+        # number of entries is counted once and tracked by inserts, so that the table is not scanned on every insert
+        self.count = self.connection.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Returns the cached response (decoded JSON) or None if it is missing or expired.
+        """
+        now = time.time()
+        with self.lock:
+            row = self.connection.execute("SELECT value, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl is not None and now - row[1] > self.ttl):
+                self.misses += 1
+                return None
+            self.connection.execute("UPDATE responses SET accessed = ? WHERE key = ?", (now, key))
+            self.connection.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        """
+        Stores the response (any JSON-serialisable value) and evicts the least recently used entries once the number of entries exceeds the limit.
+        """
+        now = time.time()
+        with self.lock:
+            exists = self.connection.execute("SELECT 1 FROM responses WHERE key = ?", (key,)).fetchone() is not None
+            self.connection.execute("INSERT OR REPLACE INTO responses (key, value, created, accessed) VALUES (?, ?, ?, ?)", (key, json.dumps(value), now, now))
+            if not exists:
+                self.count += 1
+            if self.max_entries and self.count > self.max_entries:
+                keep = max(1, int(self.max_entries * 0.9))
+                deleted = self.connection.execute(
+                    "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (keep,)
+                ).rowcount
+                self.count -= deleted
+            self.connection.commit()
+
+    def purge_expired(self):
+        """
+        Deletes expired entries.
+        """
+        if self.ttl is None:
+            return
+        with self.lock:
+            self.count -= self.connection.execute("DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)).rowcount
+            self.connection.commit()
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+def name_fingerprint(name, source=''):
+    """
+    Fingerprints the input name (whitespace collapsed, lower case) together with the source of lookup (for example, API URL),
+    so that results of the same name from another source are not reused.
+    """
+    normalised = ' '.join(str(name).split()).lower()
+    return hashlib.sha1(f"{source}|{normalised}".encode('utf-8')).hexdigest()[:16]
+
+
+class LookupCheckpoint:
+    """
+    Results of lookup appended to JSON Lines file name by name as soon as they are resolved, so that nothing is lost if the lookup is interrupted.
+    Names whose fingerprints are in the checkpoint are not looked up again, and results of removed or edited names are dropped by compact.
+    Results expire after the time to live (as cached responses), so that names are looked up again once the source might have changed.
+    """
+
+    def __init__(self, path, source='', ttl_days=None):
+        """
+        Opens the checkpoint (results of previous runs are loaded if the file exists, expired results are skipped).
+
+        Args:
+            path (str): Path to JSON Lines file.
+            source (str): Source of lookup, part of fingerprints of names.
+            ttl_days (float): Time to live of results in days (None - results never expire).
+        """
+        self.path = path
+        self.source = source
+        self.ttl = ttl_days * 86400 if ttl_days else None
+        self.results = {}
+        self.created = {}
+        self.lock = threading.Lock()
+        self.file = None
+        self.newline = False  # the last line might be incomplete after the crash
+        if os.path.exists(path):
+            now = time.time()
+            with open(path, 'r', encoding='utf-8') as file:
+                for line in file:
+                    self.newline = not line.endswith('\n')
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    # results without time of lookup (written by previous versions) are expired if results expire
+                    created = entry.get('created', 0)
+                    if self.ttl is not None and now - created > self.ttl:
+                        continue
+                    self.results[entry['fingerprint']] = entry['result']
+                    self.created[entry['fingerprint']] = created
+
+    def fingerprint(self, name):
+        return name_fingerprint(name, self.source)
+
+    def pending(self, names):
+        """
+        Returns distinct names without results in the checkpoint (in the order of names).
+        """
+        pending = {}
+        for name in names:
+            fingerprint = self.fingerprint(name)
+            if fingerprint not in self.results and fingerprint not in pending:
+                pending[fingerprint] = name
+        return list(pending.values())
+
+    def add(self, name, result):
+        """
+        Appends the result of the name to the file (thread-safe, written to disk immediately).
+        """
+        fingerprint = self.fingerprint(name)
+        created = time.time()
+        with self.lock:
+            if self.file is None:
+                if os.path.dirname(self.path):
+                    os.makedirs(os.path.dirname(self.path), exist_ok=True)
+                self.file = open(self.path, 'a', encoding='utf-8')
+                if self.newline:
+                    self.file.write('\n')
+            self.file.write(json.dumps({'fingerprint': fingerprint, 'name': str(name), 'created': created, 'result': result}, default=str) + '\n')
+            self.file.flush()
+            self.results[fingerprint] = result
+            self.created[fingerprint] = created
+
+    def get(self, name, default=None):
+        return self.results.get(self.fingerprint(name), default)
+
+    def compact(self, names):
+        """
+        Rewrites the file with results of the current names only (results of removed or edited names and expired results are dropped).
+        """
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            kept = {}
+            for name in names:
+                fingerprint = self.fingerprint(name)
+                if fingerprint in self.results:
+                    kept[fingerprint] = (name, self.created[fingerprint], self.results[fingerprint])
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as file:
+                for fingerprint, (name, created, result) in kept.items():
+                    file.write(json.dumps({'fingerprint': fingerprint, 'name': str(name), 'created': created, 'result': result}, default=str) + '\n')
+            os.replace(temp_path, self.path)
+            self.results = {fingerprint: result for fingerprint, (name, created, result) in kept.items()}
+            self.created = {fingerprint: created for fingerprint, (name, created, result) in kept.items()}
+            self.newline = False
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+# Example usage
+# queries, query_nums = deduplicate_names(species_names)
+# results = fan_out(map_concurrently(lookup, queries, workers=8), query_nums, default={})
+# rate_limiter = TokenBucket(rate=10)
+# def lookup(name):
+#     rate_limiter.acquire()
+#     return requests.get(url, params={'name': name}).json()
+# results = map_concurrently(lookup, species_names, workers=8)
+# response_cache = ResponseCache('output/lookup_cache.sqlite', ttl_days=30)
+# key = cache_key('species/match', {'name': name})
+# data = response_cache.get(key)
+# checkpoint = LookupCheckpoint('output/mapped_species_GBIF_checkpoint.jsonl', source='https://api.gbif.org/v1', ttl_days=30)
+# for name in checkpoint.pending(species_names):
+#     checkpoint.add(name, lookup(name))
+# results = [checkpoint.get(name, {}) for name in species_names]
@@ -45,8 +45,12 @@ class RasterTransform:
             if srs.IsProjected():
                 self.epsg_code = srs.GetAttrValue("AUTHORITY", 1)
                 print (f"Coordinate reference system of the input raster dataset is EPSG:{self.epsg_code}")
+            elif srs.IsGeographic():
+                # geographic rasters (for example, EPSG:4326) are supported as well - their coordinates are in degrees
+                self.epsg_code = srs.GetAttrValue("AUTHORITY", 1)
+                print (f"Coordinate reference system of the input raster dataset is geographic EPSG:{self.epsg_code}")
             else:
-                raise ValueError("Input raster does not have a projected coordinate system.")
+                raise ValueError("Input raster has neither projected nor geographic coordinate system.")
         else:
             raise ValueError("No projection information found in the input raster.")
 
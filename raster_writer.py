@@ -0,0 +1,278 @@
+# raster_writer.py
+# includes methods to write arrays of occurrence counts into tiled and compressed GeoTIFF (Cloud-Optimized GeoTIFF with overviews) window by window,
+# applying nodata mask of the input raster dataset without loading its whole band into memory
+# should be imported as a class
+
+from osgeo import gdal
+import numpy as np
+import warnings
+
+# GDAL data types of output bands from the smallest one, with the range of values they can store
+COUNT_DTYPES = [
+    (gdal.GDT_Byte, np.uint8),
+    (gdal.GDT_Int16, np.int16),
+    (gdal.GDT_UInt16, np.uint16),
+    (gdal.GDT_Int32, np.int32),
+    (gdal.GDT_UInt32, np.uint32),
+]
+
+
+def select_count_dtype(max_count, nodata_value=None):
+    """
+    Selects the smallest output data type which stores the maximum count and nodata value without truncation.
+
+    Args:
+        max_count (int): Maximum count in all output bands.
+        nodata_value (float): Nodata value of the input raster dataset (None if not defined).
+
+    Returns:
+        tuple: GDAL data type and the corresponding numpy data type.
+    """
+    values = [0, int(max_count)]
+    if nodata_value is not None:
+        if not float(nodata_value).is_integer():
+            # fractional nodata value (for example, -3.4e+38 of Float32 rasters) can be stored only as float
+            return gdal.GDT_Float32, np.float32
+        values.append(int(nodata_value))
+    for gdal_dtype, np_dtype in COUNT_DTYPES:
+        info = np.iinfo(np_dtype)
+        if info.min <= min(values) and max(values) <= info.max:
+            return gdal_dtype, np_dtype
+    return gdal.GDT_Float64, np.float64
+
+
+def iter_windows(x_size, y_size, block_size):
+    """
+    Yields windows (xoff, yoff, xsize, ysize) covering the raster dataset block by block.
+    """
+    for yoff in range(0, y_size, block_size):
+        for xoff in range(0, x_size, block_size):
+            yield xoff, yoff, min(block_size, x_size - xoff), min(block_size, y_size - yoff)
+
+
+def read_window(source, xoff, yoff, xsize, ysize):
+    """
+    Reads the window of counts from the numpy array or from any object with read_window method (for example, sparse accumulator).
+    """
+    if hasattr(source, 'read_window'):
+        return source.read_window(xoff, yoff, xsize, ysize)
+    return source[yoff:yoff + ysize, xoff:xoff + xsize]
+
+
+def coarse_nodata_mask(band, nodata_value, factor, level_yoff, level_ysize, block_size=512):
+    """
+    Computes the nodata mask of coarser rows: the coarser pixel is nodata only if all base pixels within it are nodata.
+    Base rows are read in strips of at most block_size rows (the factor might be larger than block_size).
+
+    Args:
+        band (gdal.Band): Band of the input raster dataset.
+        nodata_value (float): Nodata value of the band.
+        factor (int): Aggregation factor.
+        level_yoff (int): First coarser row.
+        level_ysize (int): Number of coarser rows.
+        block_size (int): Maximum number of base rows read at once.
+
+    Returns:
+        np.ndarray: Boolean mask of coarser rows, True for nodata.
+    """
+    x_size = band.XSize
+    y_size = band.YSize
+    level_x_size = -(-x_size // factor)
+    nodata_mask = np.ones((level_ysize, level_x_size), dtype=bool)
+    last_row = min((level_yoff + level_ysize) * factor, y_size)
+    for yoff in range(level_yoff * factor, last_row, block_size):
+        ysize = min(block_size, last_row - yoff)
+        padded = np.ones((ysize, level_x_size * factor), dtype=bool)
+        padded[:, :x_size] = band.ReadAsArray(0, yoff, x_size, ysize) == nodata_value
+        # base rows are reduced along coarser columns first, then along rows of the same coarser row
+        strip = padded.reshape(ysize, level_x_size, factor).all(axis=2)
+        rows = np.arange(yoff, yoff + ysize) // factor - level_yoff
+        starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+        nodata_mask[rows[starts]] &= np.logical_and.reduceat(strip, starts, axis=0)
+    return nodata_mask
+
+
+def level_template(template_ds, factor, block_size=512):
+    """
+    Creates the in-memory template of the coarser level (aligned with the input raster dataset): pixel size is multiplied by factor,
+    and the coarser pixel is nodata only if all base pixels within it are nodata.
+
+    Args:
+        template_ds (gdal.Dataset): Input raster dataset.
+        factor (int): Aggregation factor.
+        block_size (int): Maximum number of base rows read at once (the whole band is never loaded into memory).
+
+    Returns:
+        gdal.Dataset: In-memory dataset with the grid, projection and nodata mask of the coarser level.
+    """
+    x_size = template_ds.RasterXSize
+    y_size = template_ds.RasterYSize
+    level_x_size = -(-x_size // factor)
+    level_y_size = -(-y_size // factor)
+    template_band = template_ds.GetRasterBand(1)
+    nodata_value = template_band.GetNoDataValue()
+
+    level_ds = gdal.GetDriverByName('MEM').Create('', level_x_size, level_y_size, 1, template_band.DataType)
+    level_ds.SetProjection(template_ds.GetProjection())
+    geo_transform = list(template_ds.GetGeoTransform())
+    geo_transform[1] *= factor
+    geo_transform[2] *= factor
+    geo_transform[4] *= factor
+    geo_transform[5] *= factor
+    level_ds.SetGeoTransform(geo_transform)
+    if nodata_value is None:
+        return level_ds
+
+    level_band = level_ds.GetRasterBand(1)
+    level_band.SetNoDataValue(nodata_value)
+    # valid pixels are filled with any value other than nodata
+    valid_value = 0 if nodata_value != 0 else 1
+    # coarser rows are processed in steps of about block_size base rows
+    level_rows = max(1, block_size // factor)
+    for level_yoff in range(0, level_y_size, level_rows):
+        level_ysize = min(level_rows, level_y_size - level_yoff)
+        nodata_mask = coarse_nodata_mask(template_band, nodata_value, factor, level_yoff, level_ysize, block_size)
+        level_band.WriteArray(np.where(nodata_mask, nodata_value, valid_value), 0, level_yoff)
+    return level_ds
+
+
+class CountRasterWriter:
+    """
+    Writes bands of occurrence counts into tiled and compressed GeoTIFF (Cloud-Optimized GeoTIFF with overviews by default),
+    inheriting the grid, projection and nodata mask of the input raster dataset.
+    """
+
+    def __init__(self, template_ds, compress='DEFLATE', cog=True, block_size=512, overview_resampling='AVERAGE'):
+        """
+        Initializes the writer.
+
+        Args:
+            template_ds (gdal.Dataset): Input raster dataset (grid, projection and nodata mask of its first band are inherited).
+            compress (str): Compression of the output (DEFLATE, ZSTD, LZW or NONE).
+            cog (bool): To write Cloud-Optimized GeoTIFF with overviews (otherwise, tiled GeoTIFF with internal overviews).
+            block_size (int): Size of tiles of the output and of windows to read the nodata mask.
+            overview_resampling (str): Resampling method for overviews (AVERAGE, NEAREST etc.).
+        """
+        self.template_ds = template_ds
+        self.compress = compress.upper() if compress else 'NONE'
+        self.cog = cog
+        self.block_size = int(block_size)
+        self.overview_resampling = overview_resampling
+        self.nodata_value = template_ds.GetRasterBand(1).GetNoDataValue()
+
+    def _creation_options(self):
+        return [
+            'TILED=YES',
+            f'BLOCKXSIZE={self.block_size}',
+            f'BLOCKYSIZE={self.block_size}',
+            f'COMPRESS={self.compress}',
+            'BIGTIFF=IF_SAFER',
+        ]
+
+    def write(self, output_path, bands, levels=None, dtype=None):
+        """
+        Writes bands of counts into the output raster window by window.
+
+        Args:
+            output_path (str): Path to the output GeoTIFF.
+            bands (list): List of (band description, counts) where counts is a numpy array or any object with read_window and max methods.
+            levels (list): List of (factor, bands) with coarser levels of counts (see count_pyramid) to be written as overviews
+                (exact sums instead of resampled overviews, the output is written as tiled GeoTIFF).
+            dtype (tuple): GDAL and numpy data types of the output (for example, Float32 for density), selected from the maximum count by default.
+
+        Returns:
+            int: GDAL data type of the output bands.
+        """
+        if dtype is not None:
+            gdal_dtype, np_dtype = dtype
+        else:
+            max_count = max([int(counts.max()) for _, level_bands in [(1, bands)] + list(levels or []) for _, counts in level_bands] or [0])
+            gdal_dtype, np_dtype = select_count_dtype(max_count, self.nodata_value)
+            print(f"Maximum count is {max_count}, output data type is {gdal.GetDataTypeName(gdal_dtype)}.")
+
+        x_size = self.template_ds.RasterXSize
+        y_size = self.template_ds.RasterYSize
+        template_band = self.template_ds.GetRasterBand(1)
+
+        # COG driver can only copy existing datasets, so the tiled GeoTIFF is written first
+        cog_driver = gdal.GetDriverByName('COG') if self.cog and not levels else None
+        if self.cog and levels:
+            warnings.warn("COG driver resamples overviews, so levels of counts are written as internal overviews of tiled GeoTIFF instead.")
+        elif self.cog and cog_driver is None:
+            warnings.warn("COG driver is not available in this GDAL version. Tiled GeoTIFF with internal overviews will be written instead.")
+        temp_path = output_path + '.tmp.tif' if cog_driver is not None else output_path
+
+        driver = gdal.GetDriverByName('GTiff')
+        output_raster = driver.Create(temp_path, x_size, y_size, max(len(bands), 1), gdal_dtype, options=self._creation_options())
+        if output_raster is None:
+            raise RuntimeError(f"Failed to create output raster file: {temp_path}")
+        output_raster.SetProjection(self.template_ds.GetProjection())
+        output_raster.SetGeoTransform(self.template_ds.GetGeoTransform())
+
+        for band_num, (band_description, _) in enumerate(bands, start=1):
+            output_band = output_raster.GetRasterBand(band_num)
+            output_band.SetDescription(band_description)  # for example, 'speciesKey=2435261'
+            if self.nodata_value is not None:
+                output_band.SetNoDataValue(self.nodata_value)  # set the same nodata values
+
+        self._write_bands(output_raster.GetRasterBand, template_band, bands, np_dtype)
+
+        if levels:
+            # overviews are allocated for every factor and then overwritten with exact sums of counts
+            factors = [factor for factor, _ in levels]
+            output_raster.BuildOverviews('NEAREST', factors)
+            for overview_num, (factor, level_bands) in enumerate(levels):
+                level_band = level_template(self.template_ds, factor, self.block_size).GetRasterBand(1)
+                self._write_bands(lambda band_num: output_raster.GetRasterBand(band_num).GetOverview(overview_num), level_band, level_bands, np_dtype)
+        elif cog_driver is None:
+            # internal overviews of the tiled GeoTIFF
+            output_raster.BuildOverviews(self.overview_resampling, self._overview_levels(x_size, y_size))
+        output_raster.FlushCache()
+        output_raster = None  # close dataset
+
+        if cog_driver is not None:
+            # Cloud-Optimized GeoTIFF (overviews are built by the COG driver)
+            cog_options = [
+                f'COMPRESS={self.compress}',
+                f'BLOCKSIZE={self.block_size}',
+                f'OVERVIEW_RESAMPLING={self.overview_resampling}',
+                'BIGTIFF=IF_SAFER',
+            ]
+            cog_raster = cog_driver.CreateCopy(output_path, gdal.Open(temp_path), options=cog_options)
+            if cog_raster is None:
+                raise RuntimeError(f"Failed to create Cloud-Optimized GeoTIFF: {output_path}")
+            cog_raster = None  # close dataset
+            driver.Delete(temp_path)
+
+        return gdal_dtype
+
+    def _write_bands(self, get_band, template_band, bands, np_dtype):
+        """
+        Writes bands of counts window by window, reading the nodata mask of the template band for each window (the whole band is never loaded into memory).
+        """
+        for xoff, yoff, xsize, ysize in iter_windows(template_band.XSize, template_band.YSize, self.block_size):
+            nodata_mask = None
+            if self.nodata_value is not None:
+                nodata_mask = template_band.ReadAsArray(xoff, yoff, xsize, ysize) == self.nodata_value
+            for band_num, (_, counts) in enumerate(bands, start=1):
+                window = np.array(read_window(counts, xoff, yoff, xsize, ysize), dtype=np_dtype)
+                if nodata_mask is not None:
+                    window[nodata_mask] = self.nodata_value  # to exclude occurrences beyond input raster
+                get_band(band_num).WriteArray(window, xoff, yoff)
+
+    def _overview_levels(self, x_size, y_size):
+        """
+        Defines overview levels (2, 4, 8...) until the overview fits into one tile.
+        """
+        levels = []
+        factor = 2
+        while max(x_size, y_size) / factor >= self.block_size / 2:
+            levels.append(factor)
+            factor *= 2
+        return levels
+
+# Example usage
+# writer = CountRasterWriter(gdal.Open(raster_path), compress='DEFLATE', cog=True)
+# writer.write(output_raster_path, [('occurrence count', counts_array)])
+# coarser level aligned with the input raster dataset (for example, 1 km from 100 m)
+# CountRasterWriter(level_template(gdal.Open(raster_path), 10)).write(output_1km_path, [('occurrence count', block_sum(counts_array, 10))])
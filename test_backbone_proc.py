@@ -0,0 +1,82 @@
+# test_backbone_proc.py
+# includes tests of the offline matcher of scientific names against GBIF Backbone Taxonomy
+# should be run with pytest
+
+import pytest
+
+from backbone_proc import BackboneIndex, build_backbone_index
+
+pytest.importorskip('pyarrow')
+
+TAXON_COLUMNS = [
+    'taxonID', 'datasetID', 'parentNameUsageID', 'acceptedNameUsageID', 'originalNameUsageID', 'scientificName', 'scientificNameAuthorship',
+    'canonicalName', 'genericName', 'specificEpithet', 'infraspecificEpithet', 'taxonRank', 'nameAccordingTo', 'namePublishedIn',
+    'taxonomicStatus', 'nomenclaturalStatus', 'taxonRemarks', 'kingdom', 'phylum', 'class', 'order', 'family', 'genus',
+]
+
+TAXA = [
+    {'taxonID': 359, 'scientificName': 'Mammalia', 'canonicalName': 'Mammalia', 'taxonRank': 'class', 'taxonomicStatus': 'accepted', 'class': 'Mammalia'},
+    {'taxonID': 2433, 'scientificName': 'Lutra Brisson, 1762', 'canonicalName': 'Lutra', 'taxonRank': 'genus', 'taxonomicStatus': 'accepted', 'class': 'Mammalia'},
+    {'taxonID': 5219, 'parentNameUsageID': 2433, 'scientificName': 'Lutra lutra (Linnaeus, 1758)', 'canonicalName': 'Lutra lutra',
+     'taxonRank': 'species', 'taxonomicStatus': 'accepted', 'class': 'Mammalia'},
+    {'taxonID': 9000, 'parentNameUsageID': 5219, 'scientificName': 'Lutra lutra lutra (Linnaeus, 1758)', 'canonicalName': 'Lutra lutra lutra',
+     'taxonRank': 'subspecies', 'taxonomicStatus': 'accepted', 'class': 'Mammalia'},
+    {'taxonID': 9001, 'acceptedNameUsageID': 5219, 'scientificName': 'Mustela lutra Linnaeus, 1758', 'canonicalName': 'Mustela lutra',
+     'taxonRank': 'species', 'taxonomicStatus': 'synonym', 'class': 'Mammalia'},
+    {'taxonID': 7000, 'scientificName': 'Alytes cisternasii Boscá, 1879', 'canonicalName': 'Alytes cisternasii',
+     'taxonRank': 'species', 'taxonomicStatus': 'accepted', 'class': 'Amphibia'},
+    # accepted taxon without canonical name is dropped from the index, its synonym must not take the species of the next taxon
+    {'taxonID': 8000, 'scientificName': 'Incertae sedis', 'taxonRank': 'species', 'taxonomicStatus': 'accepted'},
+    {'taxonID': 9002, 'acceptedNameUsageID': 8000, 'scientificName': 'Lutrogale orphana Smith, 1900', 'canonicalName': 'Lutrogale orphana',
+     'taxonRank': 'species', 'taxonomicStatus': 'synonym', 'class': 'Mammalia'},
+]
+
+
+@pytest.fixture(scope='module')
+def backbone(tmp_path_factory):
+    directory = tmp_path_factory.mktemp('backbone')
+    lines = ['\t'.join(TAXON_COLUMNS)] + ['\t'.join(str(taxon.get(column, '')) for column in TAXON_COLUMNS) for taxon in TAXA]
+    (directory / 'Taxon.tsv').write_text('\n'.join(lines) + '\n', encoding='utf-8')
+    build_backbone_index(str(directory / 'Taxon.tsv'), str(directory / 'index'))
+    return BackboneIndex(str(directory / 'index'))
+
+
+@pytest.mark.parametrize('name', ['Lutra lutra Linnaeus', 'Lutra lutra L.', 'Lutra lutra (Linnaeus, 1758)', '  lutra  LUTRA ', 'Lutra lutra Linnaeus, 1758'])
+def test_authored_names_match_exactly(backbone, name):
+    match = backbone.match(name)
+    assert match['matchType'] == 'EXACT'
+    assert match['usageKey'] == 5219
+    assert match['classKey'] == 359
+
+
+def test_name_with_accents_in_authorship(backbone):
+    assert backbone.match('Alytes cisternasii Boscá, 1879')['confidence'] == 100
+    assert backbone.match('Alytes cisternasii Bosca')['usageKey'] == 7000
+
+
+def test_synonym_is_resolved_to_accepted_species(backbone):
+    match = backbone.match('Mustela lutra')
+    assert match['status'] == 'SYNONYM'
+    assert match['acceptedUsageKey'] == 5219
+    assert match['speciesKey'] == 5219
+
+
+def test_synonym_of_missing_accepted_taxon_has_no_species(backbone):
+    match = backbone.match('Lutrogale orphana')
+    assert match['usageKey'] == 9002
+    assert match['acceptedUsageKey'] == 8000
+    assert match['speciesKey'] is None
+
+
+def test_subspecies_with_rank_marker(backbone):
+    match = backbone.match('Lutra lutra subsp. lutra')
+    assert match['usageKey'] == 9000
+    assert match['speciesKey'] == 5219
+
+
+def test_fuzzy_higher_rank_and_no_match(backbone):
+    assert backbone.match('Lutra lutta')['matchType'] == 'FUZZY'
+    assert backbone.match('Lutra unknownia')['matchType'] == 'HIGHERRANK'
+    assert backbone.match('Nothing here')['matchType'] == 'NONE'
+    assert backbone.match(None)['matchType'] == 'NONE'
+    assert backbone.match_many([]) == []
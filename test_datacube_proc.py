@@ -0,0 +1,107 @@
+# test_datacube_proc.py
+# includes tests of streaming of GBIF occurrence datacubes, their Parquet cache and merging of several datacubes
+# should be run with pytest
+
+import zipfile
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from datacube_proc import DatacubeReader, MultiDatacubeReader, convert_datacube_to_parquet, hash_records
+
+pytest.importorskip('pyarrow')
+
+
+def write_datacube(path, species_count, records_count):
+    # datacube with the same columns as downloads of GBIF occurrence datacube (tab-separated)
+    rng = np.random.default_rng(0)
+    species_keys = np.arange(records_count) % species_count
+    df = pd.DataFrame({
+        'yearMonth': ['2020-01'] * records_count,
+        'lat': rng.uniform(40, 42, records_count),
+        'lon': rng.uniform(0, 3, records_count),
+        'classKey': 212,
+        'speciesKey': species_keys + 1000,
+        'species': [f'Species {key}' for key in species_keys],
+        'iucnRedListCategory': np.nan,
+    })
+    df.to_csv(path, sep='\t', index=False)
+    return df
+
+
+def test_later_chunk_with_more_than_127_categories(tmp_path):
+    # the first chunk has few distinct species (int8 dictionary index), the next ones many more
+    datacube_path = tmp_path / 'datacube.csv'
+    df = write_datacube(datacube_path, species_count=10, records_count=100)
+    extra = write_datacube(tmp_path / 'extra.csv', species_count=300, records_count=600)
+    extra['iucnRedListCategory'] = 'LC'
+    pd.concat([df, extra]).to_csv(datacube_path, sep='\t', index=False)
+
+    convert_datacube_to_parquet(str(datacube_path), str(tmp_path / 'cache'), chunksize=100)
+    cached = pd.concat(DatacubeReader(str(tmp_path / 'cache'), usecols=['species', 'iucnRedListCategory']), ignore_index=True)
+    assert len(cached) == 700
+    assert cached['species'].nunique() == 300
+    assert (cached['iucnRedListCategory'] == 'LC').sum() == 600
+
+
+def test_partitions_by_species_over_pyarrow_limit(tmp_path):
+    datacube_path = tmp_path / 'datacube.csv'
+    write_datacube(datacube_path, species_count=1100, records_count=2200)
+    convert_datacube_to_parquet(str(datacube_path), str(tmp_path / 'cache'), partition_cols=['speciesKey'], chunksize=2200)
+    cached = pd.concat(DatacubeReader(str(tmp_path / 'cache'), usecols=['speciesKey']), ignore_index=True)
+    assert len(cached) == 2200
+    assert cached['speciesKey'].nunique() == 1100
+
+
+def test_records_hash_the_same_from_csv_and_parquet(tmp_path):
+    datacube_path = tmp_path / 'datacube.csv'
+    write_datacube(datacube_path, species_count=5, records_count=50)
+    convert_datacube_to_parquet(str(datacube_path), str(tmp_path / 'cache'))
+    merged = MultiDatacubeReader([str(datacube_path), str(tmp_path / 'cache')], chunksize=20)
+    assert sum(len(chunk) for chunk in merged) == 50
+    assert merged.duplicates == 50
+
+    columns = ['lat', 'lon', 'speciesKey', 'species']
+    csv_hashes = np.sort(hash_records(pd.read_csv(datacube_path, sep='\t')[columns]))
+    parquet_hashes = np.sort(hash_records(pd.concat(DatacubeReader(str(tmp_path / 'cache'), usecols=columns), ignore_index=True)))
+    assert np.array_equal(csv_hashes, parquet_hashes)
+
+
+@pytest.fixture
+def datacube_zip(tmp_path):
+    # download of GBIF occurrence datacube (SQL_TSV_ZIP): the datacube and the smaller file of metadata
+    datacube_path = tmp_path / '0001234-240101000000000.csv'
+    df = write_datacube(datacube_path, species_count=50, records_count=25000)
+    zip_path = tmp_path / '0001234-240101000000000.zip'
+    with zipfile.ZipFile(zip_path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        archive.write(datacube_path, datacube_path.name)
+        archive.writestr('metadata.csv', 'key\tvalue\ndoi\t10.15468/dl.example\n')
+    return str(zip_path), df
+
+
+def test_zip_is_streamed_in_chunks_with_byte_progress(datacube_zip):
+    zip_path, df = datacube_zip
+    reader = DatacubeReader(zip_path, chunksize=3000, usecols=['LAT', 'lon', 'speciesKey'])
+    assert reader.progress == 0.0
+    progress = []
+    chunks = []
+    for chunk in reader:
+        chunks.append(chunk)
+        progress.append(reader.progress)
+    assert [len(chunk) for chunk in chunks] == [3000] * 8 + [1000]
+    assert list(chunks[0].columns) == ['lat', 'lon', 'speciesKey']
+    assert np.allclose(pd.concat(chunks, ignore_index=True)['lat'], df['lat'])
+    # progress is counted from uncompressed bytes consumed, increases monotonically up to 1
+    assert all(0 < value <= 1 for value in progress)
+    assert progress == sorted(progress)
+    assert progress[-1] == 1.0
+    assert progress[0] < 1.0
+
+
+def test_zip_without_datacube(tmp_path):
+    zip_path = tmp_path / 'download.zip'
+    with zipfile.ZipFile(zip_path, 'w') as archive:
+        archive.writestr('metadata.json', '{}')
+    with pytest.raises(FileNotFoundError):
+        list(DatacubeReader(str(zip_path)))
@@ -0,0 +1,94 @@
+# test_density_proc.py
+# includes tests of the density surface of counts convolved through FFT tile by tile
+# should be run with pytest
+
+import numpy as np
+import pytest
+
+from density_proc import DensitySurface, density_kernel
+from gridding_proc import CountAccumulator
+
+
+class ArrayBand:
+    # band of the input raster dataset with nodata values (stand-in for gdal.Band)
+    def __init__(self, array, nodata_value):
+        self.array = array
+        self.nodata_value = nodata_value
+
+    def GetNoDataValue(self):
+        return self.nodata_value
+
+    def ReadAsArray(self, xoff, yoff, xsize, ysize):
+        return self.array[yoff:yoff + ysize, xoff:xoff + xsize]
+
+
+def direct_convolution(counts, kernel):
+    # convolution of the whole raster by shifted copies of counts (zeros outside of the raster)
+    half = kernel.shape[0] // 2
+    padded = np.pad(counts.astype(np.float64), half)
+    density = np.zeros(counts.shape)
+    for dy in range(kernel.shape[0]):
+        for dx in range(kernel.shape[1]):
+            density += kernel[dy, dx] * padded[dy:dy + counts.shape[0], dx:dx + counts.shape[1]]
+    return density
+
+
+def read_tiles(surface, shape, tile_size):
+    return np.block([
+        [surface.read_window(xoff, yoff, min(tile_size, shape[1] - xoff), min(tile_size, shape[0] - yoff)) for xoff in range(0, shape[1], tile_size)]
+        for yoff in range(0, shape[0], tile_size)
+    ])
+
+
+@pytest.fixture
+def counts():
+    rng = np.random.default_rng(4)
+    return rng.poisson(0.3, (61, 83)).astype(np.int32)
+
+
+@pytest.mark.parametrize('kernel_type, bandwidth, tile_size', [('gaussian', 1.5, 16), ('gaussian', 3, 7), ('exponential', 2, 25)])
+def test_tiles_with_halo_equal_whole_raster_convolution(counts, kernel_type, bandwidth, tile_size):
+    kernel = density_kernel(kernel_type, bandwidth)
+    density = read_tiles(DensitySurface(counts, kernel), counts.shape, tile_size)
+    assert np.allclose(density, direct_convolution(counts, kernel), atol=1e-9)
+
+
+def test_sparse_counts_give_the_same_density(counts):
+    kernel = density_kernel('gaussian', 2)
+    sparse = CountAccumulator(counts.shape, sparse=True)
+    sparse.add(np.repeat(np.arange(counts.size), counts.ravel()))
+    assert np.allclose(read_tiles(DensitySurface(sparse.counts, kernel), counts.shape, 20), read_tiles(DensitySurface(counts, kernel), counts.shape, 20))
+
+
+def test_total_count_is_preserved_apart_from_edge_loss(counts):
+    kernel = density_kernel('gaussian', 2)
+    assert kernel.sum() == pytest.approx(1)
+    # counts farther from edges than the kernel radius are preserved
+    inner = np.zeros_like(counts)
+    inner[10:-10, 10:-10] = counts[10:-10, 10:-10]
+    assert read_tiles(DensitySurface(inner, kernel), counts.shape, 16).sum() == pytest.approx(inner.sum())
+    # counts near edges lose the share of the kernel outside of the raster
+    density = read_tiles(DensitySurface(counts, kernel), counts.shape, 16)
+    edge_loss = counts.sum() - density.sum()
+    assert 0 < edge_loss < counts[:7].sum() + counts[-7:].sum() + counts[:, :7].sum() + counts[:, -7:].sum()
+    assert (density >= 0).all()
+
+
+def test_edge_correction_and_nodata_mask():
+    counts = np.full((30, 40), 2, dtype=np.int32)
+    mask = np.ones((30, 40), dtype=np.uint8)
+    mask[:, 30:] = 255
+    kernel = density_kernel('exponential', 1.5)
+    # uniform counts stay uniform with edge correction, counts in nodata pixels are dropped
+    density = read_tiles(DensitySurface(counts, kernel, mask_band=ArrayBand(mask, 255), edge_correction=True), counts.shape, 11)
+    assert np.allclose(density[:, :30], 2)
+    masked = read_tiles(DensitySurface(counts, kernel, mask_band=ArrayBand(mask, 255)), counts.shape, 11)
+    assert masked[:, 30:].max() < masked[:, 10:20].min()
+    assert np.allclose(masked, direct_convolution(np.where(mask == 255, 0, counts), kernel))
+
+
+def test_invalid_kernel():
+    with pytest.raises(ValueError):
+        density_kernel('gaussian', 0)
+    with pytest.raises(ValueError):
+        density_kernel('triangular', 1)
@@ -0,0 +1,327 @@
+# test_gridding_proc.py
+# includes tests of sparse counting, count pyramids and distinct counts of occurrences
+# should be run with pytest
+
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import gridding_proc
+from gridding_proc import CountAccumulator, DistinctCountAccumulator, GroupedCountAccumulator, SparseCounts, block_sum, count_pixels, count_pyramid, distinct_pairs
+from gridding_proc import describe_period, temporal_periods
+from gridding_proc import GriddingTarget, RasterGrid, ReprojectionCache, count_chunk, fork_available, parallel_count_chunks, targets_by_crs, transform_coordinates
+
+
+@pytest.fixture
+def flat_idx():
+    rng = np.random.default_rng(0)
+    return rng.integers(0, 37 * 53, 5000)
+
+
+def test_sparse_counts_equal_dense_counts(flat_idx):
+    dense = CountAccumulator((37, 53))
+    sparse = CountAccumulator((37, 53), sparse=True)
+    for chunk in np.array_split(flat_idx, 7):
+        dense.add(chunk)
+        sparse.add(chunk)
+    assert isinstance(sparse.counts, SparseCounts)
+    assert np.array_equal(sparse.counts.toarray(), dense.counts)
+    assert np.array_equal(sparse.counts.read_window(5, 3, 20, 11), dense.counts[3:14, 5:25])
+    assert sparse.total == dense.total == len(flat_idx)
+
+
+@pytest.mark.parametrize('factor', [1, 2, 10, 60])
+def test_block_sum_of_dense_and_sparse_counts(flat_idx, factor):
+    dense = CountAccumulator((37, 53))
+    sparse = CountAccumulator((37, 53), sparse=True)
+    dense.add(flat_idx)
+    sparse.add(flat_idx)
+    coarse = block_sum(dense.counts, factor)
+    assert coarse.shape == (-(-37 // factor), -(-53 // factor))
+    assert coarse.sum() == len(flat_idx)
+    assert coarse[0, 0] == dense.counts[:factor, :factor].sum()
+    assert np.array_equal(block_sum(sparse.counts, factor).toarray(), coarse)
+
+
+def test_count_pyramid_levels(flat_idx):
+    dense = CountAccumulator((37, 53))
+    dense.add(flat_idx)
+    levels = count_pyramid(dense.bands, [10, 2, 10])
+    assert [factor for factor, _ in levels] == [2, 10]
+    assert all(bands[0][1].sum() == len(flat_idx) for _, bands in levels)
+
+
+def test_distinct_counts_equal_nunique():
+    rng = np.random.default_rng(1)
+    shape = (20, 30)
+    pixels = rng.integers(0, 600, 4000)
+    species = rng.choice([1.0, 2.0, 3.0, 4.0, np.nan], 4000)
+    accumulator = DistinctCountAccumulator(shape, 'species richness')
+    for pixel_chunk, species_chunk in zip(np.array_split(pixels, 5), np.array_split(species, 5)):
+        accumulator.add_pairs(*distinct_pairs(pixel_chunk, species_chunk))
+    expected = pd.DataFrame({'pixel': pixels, 'species': species}).groupby('pixel')['species'].nunique()
+    expected = expected[expected > 0]
+    richness = accumulator.counts()
+    assert np.array_equal(richness.pixels, expected.index.values)
+    assert np.array_equal(richness.counts, expected.values)
+
+    # distinct values are deduplicated within blocks of the coarser level
+    df = pd.DataFrame({'block': (pixels // 30 // 4) * 8 + pixels % 30 // 4, 'species': species})
+    expected_coarse = df.groupby('block')['species'].nunique()
+    coarse = accumulator.counts(factor=4)
+    assert coarse.shape == (5, 8)
+    assert np.array_equal(coarse.pixels, expected_coarse[expected_coarse > 0].index.values)
+    assert np.array_equal(coarse.counts, expected_coarse[expected_coarse > 0].values)
+
+
+def test_distinct_counts_in_rasters_over_2_31_pixels():
+    # 10 m national rasters have billions of pixels
+    shape = (100000, 50000)
+    pixels = np.array([10, 3000000000, 4000000000, 4000000000])
+    accumulator = DistinctCountAccumulator(shape, 'species richness')
+    accumulator.add_pairs(pixels, np.array([7, 8, 8, 9]))
+    accumulator.add_pairs(pixels[:1], np.array([8]))
+    richness = accumulator.counts()
+    assert richness.pixels.tolist() == [10, 3000000000, 4000000000]
+    assert richness.counts.tolist() == [2, 1, 2]
+    coarse = accumulator.counts(factor=1000)
+    assert coarse.pixels.tolist() == [0, 3000000000 // 50000 // 1000 * 50 + 0, 4000000000 // 50000 // 1000 * 50 + 0]
+
+
+def test_distinct_counts_overflow_is_reported():
+    accumulator = DistinctCountAccumulator((2 ** 31, 2 ** 31), 'species richness')
+    with pytest.raises(OverflowError):
+        accumulator.add_pairs(np.arange(3), np.array([1, 2, 3]))
+
+
+@pytest.fixture
+def target_specs():
+    # geographic grid of 0.1 degree and ETRS89-LAEA grid of 10 km over the same area (partly)
+    x, y = transform_coordinates(np.array([40.0, 42.0]), np.array([0.0, 3.0]), 'EPSG:3035')
+    laea_grid = RasterGrid((np.floor(x.min()), 10000, 0, np.ceil(y.max()), 0, -10000), 20, 15)
+    return [(RasterGrid((0, 0.1, 0, 42, 0, -0.1), 30, 20), 'EPSG:4326'), (laea_grid, '3035')]
+
+
+@pytest.fixture
+def chunks():
+    rng = np.random.default_rng(3)
+    chunks = []
+    for _ in range(5):
+        lat = rng.uniform(39.5, 42.5, 1000)
+        lon = rng.uniform(-0.5, 3.5, 1000)
+        species = rng.integers(1, 20, 1000)
+        chunks.append((lat, lon, species % 3, None, {'richness': species}))
+    return chunks
+
+
+def assert_same_counts(result, expected):
+    (partials, false_counts, n_records, _, distinct_partials), (expected_partials, expected_false_counts, expected_n_records, _, expected_distinct) = result, expected
+    assert false_counts == expected_false_counts and n_records == expected_n_records
+    for partial, expected_partial in zip(partials, expected_partials):
+        assert partial.keys() == expected_partial.keys()
+        for group in partial:
+            assert all(np.array_equal(array, expected_array) for array, expected_array in zip(partial[group], expected_partial[group]))
+    for distinct, expected_distinct_target in zip(distinct_partials, expected_distinct):
+        assert all(np.array_equal(array, expected_array) for array, expected_array in zip(distinct['richness'], expected_distinct_target['richness']))
+
+
+@pytest.mark.skipif(not fork_available(), reason="parallel gridding requires forking of processes")
+def test_parallel_counts_are_identical_to_serial_counts(target_specs, chunks):
+    serial = [count_chunk(lat, lon, target_specs, groups, xy, False, distinct) for lat, lon, groups, xy, distinct in chunks]
+    parallel = list(parallel_count_chunks(chunks, target_specs, workers=2, max_pending=2))
+    assert len(parallel) == len(serial)
+    for result, expected in zip(parallel, serial):
+        assert_same_counts(result, expected)
+
+
+@pytest.mark.skipif(not fork_available(), reason="parallel gridding requires forking of processes")
+def test_parallel_workers_are_started_before_chunks_are_read(target_specs, chunks):
+    # chunks are read by threads of MultiDatacubeReader, workers must not be forked while they run
+    workers_before_reading = []
+
+    def read_chunks():
+        workers_before_reading.append(len(multiprocessing.active_children()))
+        yield from chunks
+
+    assert len(list(parallel_count_chunks(read_chunks(), target_specs, workers=3))) == len(chunks)
+    assert workers_before_reading == [3]
+
+
+@pytest.fixture
+def datacube_path(tmp_path):
+    datacube_path = tmp_path / 'datacube.csv'
+    datacube_path.write_text('lat\tlon\n' + ''.join(f'{40 + n / 100}\t{n / 100}\n' for n in range(100)))
+    return str(datacube_path)
+
+
+def build_cache(cache_dir, datacube_path, raster_crs, x, y, chunk_size=30):
+    reprojection_cache = ReprojectionCache(cache_dir, datacube_path, raster_crs)
+    for offset in range(0, len(x), chunk_size):
+        reprojection_cache.append(x[offset:offset + chunk_size], y[offset:offset + chunk_size])
+    reprojection_cache.finish(len(x))
+    return reprojection_cache
+
+
+def test_reprojection_cache_round_trip_and_reads_at_offset(tmp_path, datacube_path):
+    cache_dir = str(tmp_path / 'cache')
+    x, y = transform_coordinates(40 + np.arange(100) / 100, np.arange(100) / 100, 'EPSG:3035')
+    assert not ReprojectionCache(cache_dir, datacube_path, 'EPSG:3035').complete
+    build_cache(cache_dir, datacube_path, 'EPSG:3035', x, y)
+
+    # next run reads coordinates memory-mapped, chunk by chunk
+    reprojection_cache = ReprojectionCache(cache_dir, datacube_path, '3035')
+    assert reprojection_cache.complete and reprojection_cache.total_rows == 100
+    x_cached, y_cached = reprojection_cache.read(0, 100)
+    assert np.array_equal(x_cached, x) and np.array_equal(y_cached, y)
+    x_chunk, y_chunk = reprojection_cache.read(45, 25)
+    assert np.array_equal(x_chunk, x[45:70]) and np.array_equal(y_chunk, y[45:70])
+    with pytest.raises(ValueError):
+        reprojection_cache.read(90, 20)
+
+
+def test_reprojection_cache_is_keyed_by_datacube_and_crs(tmp_path, datacube_path):
+    cache_dir = str(tmp_path / 'cache')
+    build_cache(cache_dir, datacube_path, 'EPSG:3035', np.arange(100.0), np.arange(100.0))
+    assert ReprojectionCache(cache_dir, datacube_path, 'EPSG:3035').complete
+    # coordinates in another CRS are not reused
+    assert not ReprojectionCache(cache_dir, datacube_path, 'EPSG:25831').complete
+    # the datacube has changed (another download written to the same path)
+    with open(datacube_path, 'a') as file:
+        file.write('41.5\t1.5\n')
+    assert not ReprojectionCache(cache_dir, datacube_path, 'EPSG:3035').complete
+    # merged datacubes have their own cache (the grid of the raster is not part of the key, rasters in the same CRS share coordinates)
+    assert ReprojectionCache(cache_dir, [datacube_path, datacube_path], 'EPSG:3035').x_path != ReprojectionCache(cache_dir, datacube_path, 'EPSG:3035').x_path
+
+
+def test_targets_are_grouped_by_crs():
+    grid = RasterGrid((0, 1, 0, 10, 0, -1), 10, 10)
+    target_specs = [(grid, 'EPSG:4326'), (grid, '3035'), (grid, 4326), (grid, 'epsg:3035')]
+    assert targets_by_crs(target_specs) == {'4326': [0, 2], '3035': [1, 3]}
+
+
+def test_chunk_is_binned_into_every_target(target_specs, chunks, monkeypatch):
+    # a coarser geographic grid is added, so two targets share one CRS
+    target_specs = target_specs + [(RasterGrid((0, 0.5, 0, 42, 0, -0.5), 6, 4), '4326')]
+    lat, lon, _, _, _ = chunks[0]
+    transformed = []
+
+    def recording_transform(lat_array, lon_array, raster_crs):
+        transformed.append(raster_crs)
+        return transform_coordinates(lat_array, lon_array, raster_crs)
+
+    monkeypatch.setattr(gridding_proc, 'transform_coordinates', recording_transform)
+    partials, false_counts, n_records, xy, _ = count_chunk(lat, lon, target_specs, return_xy=True)
+    # coordinates are transformed once for every distinct CRS
+    assert sorted(map(str, transformed)) == ['3035', 'EPSG:4326']
+    assert sorted(xy) == ['3035', '4326']
+    assert n_records == len(lat)
+
+    targets = [GriddingTarget(f'target {num}', grid, raster_crs, CountAccumulator(grid.shape), None) for num, (grid, raster_crs) in enumerate(target_specs)]
+    for target, partial, false_count in zip(targets, partials, false_counts):
+        target.accumulator.add_partial(partial)
+        target.false_count += false_count
+        # the same as binning of the chunk into this target alone
+        grid, raster_crs = target.spec
+        x, y = transform_coordinates(lat, lon, raster_crs)
+        inside, pixel_row, pixel_col = grid.bin_points(x, y)
+        expected = np.bincount(grid.flat_indices(pixel_row, pixel_col), minlength=grid.x_size * grid.y_size).reshape(grid.shape)
+        assert np.array_equal(target.accumulator.counts, expected)
+        assert target.accumulator.total + target.false_count == len(lat)
+    # the coarser grid covers the same area as the finer one
+    assert targets[2].accumulator.total == targets[0].accumulator.total
+    assert targets[1].accumulator.total != targets[0].accumulator.total
+
+
+def test_count_pixels_by_groups():
+    flat_idx = np.array([3, 3, 5, 3, 0, 5])
+    partial = count_pixels(flat_idx, np.array([212.0, 212.0, 212.0, 359.0, np.nan, np.nan]))
+    # keys read as floats are converted back to integers, missing values are the group of their own
+    assert sorted(partial, key=str) == [212, 359, 'missing']
+    assert all(isinstance(group, int) for group in partial if group != 'missing')
+    assert partial[212][0].tolist() == [3, 5] and partial[212][1].tolist() == [2, 1]
+    assert partial[359][0].tolist() == [3] and partial[359][1].tolist() == [1]
+    assert partial['missing'][0].tolist() == [0, 5] and partial['missing'][1].tolist() == [1, 1]
+    assert list(count_pixels(flat_idx)) == [None]
+
+
+@pytest.mark.parametrize('sparse', [False, True])
+def test_grouped_counts_are_layers_of_every_group(flat_idx, sparse):
+    rng = np.random.default_rng(5)
+    group_values = rng.choice(np.array(['Aves', 'Mammalia', 'Amphibia'], dtype=object), len(flat_idx))
+    grouped = GroupedCountAccumulator((37, 53), 'class', sparse=sparse)
+    for chunk_idx, chunk_groups in zip(np.array_split(flat_idx, 4), np.array_split(group_values, 4)):
+        grouped.add(chunk_idx, chunk_groups)
+    assert grouped.total == len(flat_idx)
+    bands = grouped.bands
+    assert [description for description, _ in bands] == ['class=Amphibia', 'class=Aves', 'class=Mammalia']
+    for (description, counts), group in zip(bands, ['Amphibia', 'Aves', 'Mammalia']):
+        counts = counts.toarray() if sparse else counts
+        expected = np.bincount(flat_idx[group_values == group], minlength=37 * 53).reshape(37, 53)
+        assert np.array_equal(counts, expected)
+
+
+def test_grouped_bands_with_numbers_and_missing_group():
+    grouped = GroupedCountAccumulator((2, 2), 'speciesKey')
+    grouped.add(np.array([0, 1, 2, 3]), np.array([5219.0, np.nan, 1000.0, 5219.0]))
+    assert [description for description, _ in grouped.bands] == ['speciesKey=1000', 'speciesKey=5219', 'speciesKey=missing']
+
+
+@pytest.fixture
+def year_month():
+    return np.array(['2010-01', '2014-12', '2015-06', '1999-03', '2000-07', np.nan, '', 'unknown', '2019'], dtype=object)
+
+
+@pytest.mark.parametrize('window, expected', [
+    (1, [2010, 2014, 2015, 1999, 2000, np.nan, np.nan, np.nan, 2019]),
+    (5, [2010, 2010, 2015, 1995, 2000, np.nan, np.nan, np.nan, 2015]),
+    (10, [2010, 2010, 2010, 1990, 2000, np.nan, np.nan, np.nan, 2010]),
+])
+def test_temporal_periods(year_month, window, expected):
+    # periods are aligned to multiples of the window, missing or invalid yearMonth is NaN
+    assert np.array_equal(temporal_periods(year_month, window), np.array(expected), equal_nan=True)
+
+
+def test_describe_period():
+    assert describe_period()(2010) == 'year=2010'
+    assert describe_period(10)(2010) == 'period=2010-2019'
+    assert describe_period(5)(1995) == 'period=1995-1999'
+    assert describe_period(5)('missing') == 'period=missing'
+
+
+def test_temporal_bands_of_decades(year_month):
+    temporal = GroupedCountAccumulator((3, 3), 'yearMonth', describe=describe_period(10))
+    temporal.add(np.arange(len(year_month)), temporal_periods(year_month, 10))
+    assert [description for description, _ in temporal.bands] == ['period=1990-1999', 'period=2000-2009', 'period=2010-2019', 'period=missing']
+    assert [int(counts.sum()) for _, counts in temporal.bands] == [1, 1, 4, 3]
+
+
+def baseline_bin_point(geo, x_size, y_size, x_cart, y_cart):
+    # per-row formula of the first version of 5_2_gridding.py (point_within_raster_extent and calculate_pixel_indices)
+    minx, miny, maxx, maxy = geo[0], geo[3] + geo[5] * y_size, geo[0] + geo[1] * x_size, geo[3]
+    if not ((minx <= x_cart <= maxx) and (miny <= y_cart <= maxy)):
+        return None
+    return int((y_cart - geo[3]) / geo[5]), int((x_cart - geo[0]) / geo[1])
+
+
+@pytest.mark.parametrize('geo, x_size, y_size', [
+    ((0, 0.1, 0, 42, 0, -0.1), 30, 20),
+    ((3500000, 100, 0, 2100000, 0, -100), 7, 5),
+])
+def test_bin_points_on_edges_and_outside_the_extent(geo, x_size, y_size):
+    grid = RasterGrid(geo, x_size, y_size)
+    minx, miny, maxx, maxy = grid.extent
+    # pixel edges (borders of the extent included), centres of pixels, points just outside and missing coordinates
+    xs = [geo[0] + geo[1] * col for col in range(x_size + 1)] + [geo[0] + geo[1] * (col + 0.5) for col in range(x_size)] + [minx - 1e-9, maxx + 1e-9, np.nan]
+    ys = [geo[3] + geo[5] * row for row in range(y_size + 1)] + [geo[3] + geo[5] * (row + 0.5) for row in range(y_size)] + [miny - 1e-9, maxy + 1e-9, np.nan]
+    x_cart, y_cart = (array.ravel() for array in np.meshgrid(xs, ys))
+    inside, pixel_row, pixel_col = grid.bin_points(x_cart, y_cart)
+
+    expected = [baseline_bin_point(geo, x_size, y_size, x, y) for x, y in zip(x_cart, y_cart)]
+    assert inside.tolist() == [pixel is not None for pixel in expected]
+    # the same pixels as the baseline, except that points on the right or bottom border belong to the last column or row
+    expected = np.array([pixel for pixel in expected if pixel is not None])
+    assert np.array_equal(pixel_row, np.minimum(expected[:, 0], y_size - 1))
+    assert np.array_equal(pixel_col, np.minimum(expected[:, 1], x_size - 1))
+    assert ((pixel_row == y_size - 1) & (pixel_col == x_size - 1)).any()
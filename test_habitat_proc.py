@@ -0,0 +1,71 @@
+# test_habitat_proc.py
+# includes tests of the lookup matrix of suitable habitats of species (IUCN Habitats Classification Scheme)
+# should be run with pytest
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from habitat_proc import HabitatSuitability, habitat_matches, parse_codes
+
+
+@pytest.mark.parametrize('value, expected', [
+    ('1.4|14.1|3.8', ['1.4', '14.1', '3.8']),
+    ('1.4, 14.1', ['1.4', '14.1']),
+    ('1.4;14.1', ['1.4', '14.1']),
+    (' 1.4 | |5 ', ['1.4', '5']),
+    (5, ['5']),
+    ('', []),
+    (np.nan, []),
+    (None, []),
+])
+def test_parse_codes(value, expected):
+    assert parse_codes(value) == expected
+
+
+@pytest.mark.parametrize('species_code, crosswalk_code, expected', [
+    ('1.4', '1', True),
+    ('1.4', '1.4', True),
+    ('1.4.2', '1.4', True),
+    ('14', '1', False),
+    ('14.1', '1', False),
+    ('1', '1.4', False),
+    ('1.4', '14', False),
+])
+def test_habitat_matches_by_prefix_of_levels(species_code, crosswalk_code, expected):
+    assert habitat_matches(species_code, crosswalk_code) == expected
+
+
+@pytest.fixture
+def habitat_suitability():
+    # species 1 in temperate forests, species 2 in wetlands, classes of forest (10) and cropland (40)
+    return HabitatSuitability({1: ['1.4'], 2: ['5.1', '14.1']}, {10: ['1'], 40: ['14']})
+
+
+def test_suitable_for_every_occurrence(habitat_suitability):
+    species_keys = np.array([1, 1, 2, 2])
+    classes = np.array([10, 40, 10, 40])
+    assert habitat_suitability.suitable(species_keys, classes).tolist() == [True, False, False, True]
+    # species keys are read as floats in chunks with missing keys
+    assert habitat_suitability.suitable(np.array([1.0, 2.0]), np.array([10, 40])).tolist() == [True, True]
+
+
+def test_unknown_species_and_classes_are_unsuitable(habitat_suitability):
+    species_keys = np.array([3, 1, np.nan, 2])
+    classes = np.array([10, 99, 10, 0])
+    assert habitat_suitability.suitable(species_keys, classes).tolist() == [False, False, False, False]
+    assert habitat_suitability.suitable(np.array([], dtype=np.int64), np.array([], dtype=np.int64)).tolist() == []
+
+
+def test_from_files(tmp_path):
+    iucn_csv = tmp_path / 'concat_species_IUCN.csv'
+    pd.DataFrame({'id_no': [1, 2], 'binomial': ['Lutra lutra', 'Canis lupus'], 'habitat_code': ['5.1|1.4', '1.4']}).to_csv(iucn_csv, sep='|', index=False)
+    gbif_key_csv = tmp_path / 'mapped_species_GBIF.csv'
+    pd.DataFrame({'canonicalName': ['Lutra lutra', 'Lutra lutra', 'Canis lupus', 'Unmatched'], 'gbifSpeciesKey': [5219, 5219, 5219173, np.nan]}).to_csv(gbif_key_csv, index=False)
+    crosswalk_csv = tmp_path / 'habitat_crosswalk.csv'
+    pd.DataFrame({'class': [10, 80], 'habitat_code': ['1', '5|15']}).to_csv(crosswalk_csv, index=False)
+
+    habitat_suitability = HabitatSuitability.from_files(str(iucn_csv), str(gbif_key_csv), str(crosswalk_csv))
+    assert sorted(habitat_suitability.species_index) == [5219, 5219173]
+    suitable = habitat_suitability.suitable(np.array([5219, 5219, 5219173, 5219173]), np.array([10, 80, 10, 80]))
+    assert suitable.tolist() == [True, True, True, False]
@@ -0,0 +1,253 @@
+# test_lookup_proc.py
+# includes tests of concurrent lookups within the rate limit, the cache of responses, checkpoints of results and parsing of species names
+# should be run with pytest
+
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+import pytest
+
+from lookup_proc import LookupCheckpoint, ResponseCache, TokenBucket, cache_key, deduplicate_names, fan_out, map_concurrently, parse_scientific_name
+
+
+def test_token_bucket_keeps_the_rate_after_burst():
+    rate_limiter = TokenBucket(rate=50, capacity=5)
+    start = time.monotonic()
+    for _ in range(30):
+        rate_limiter.acquire()
+    # 5 tokens at start, the other 25 at 50 per second
+    assert time.monotonic() - start >= 25 / 50 * 0.9
+
+
+def test_token_bucket_without_limit_does_not_wait():
+    rate_limiter = TokenBucket(rate=0)
+    start = time.monotonic()
+    for _ in range(1000):
+        rate_limiter.acquire()
+    assert time.monotonic() - start < 0.5
+
+
+def test_map_concurrently_keeps_order_of_items():
+    active = []
+    max_active = []
+    lock = threading.Lock()
+
+    def slow_upper(name):
+        with lock:
+            active.append(name)
+            max_active.append(len(active))
+        # later items finish first
+        time.sleep(0.02 * (5 - len(name) % 5))
+        with lock:
+            active.remove(name)
+        return name.upper()
+
+    names = [f"species {'x' * n}" for n in range(20)]
+    assert map_concurrently(slow_upper, names, workers=4) == [name.upper() for name in names]
+    assert 1 < max(max_active) <= 4
+    assert map_concurrently(slow_upper, names[:3], workers=1) == [name.upper() for name in names[:3]]
+
+
+def test_cache_key_is_normalised():
+    assert cache_key('species/match', {'name': 'Lutra lutra ', 'strict': False}) == cache_key('species/match', {'strict': 'false', 'name': 'lutra  Lutra'})
+    assert cache_key('species/match', {'name': 'Lutra lutra'}) != cache_key('species/search', {'name': 'Lutra lutra'})
+
+
+def test_cache_entries_expire(tmp_path):
+    response_cache = ResponseCache(str(tmp_path / 'cache.sqlite'), ttl_days=1)
+    response_cache.set('a', {'usageKey': 5219})
+    assert response_cache.get('a') == {'usageKey': 5219}
+    response_cache.connection.execute("UPDATE responses SET created = created - 2 * 86400")
+    assert response_cache.get('a') is None
+    response_cache.purge_expired()
+    assert response_cache.count == 0
+    assert (response_cache.hits, response_cache.misses) == (1, 1)
+
+
+def test_cache_evicts_least_recently_used_only_over_the_limit(tmp_path):
+    response_cache = ResponseCache(str(tmp_path / 'cache.sqlite'), max_entries=10)
+    deletes = []
+    response_cache.connection.set_trace_callback(lambda statement: deletes.append(statement) if statement.startswith('DELETE') else None)
+    for key_num in range(10):
+        response_cache.set(f'key {key_num}', key_num)
+        time.sleep(0.001)
+    response_cache.set('key 0', 0)  # replaced, not a new entry
+    assert deletes == []
+    response_cache.get('key 1')  # recently used
+    response_cache.set('key 10', 10)
+    assert len(deletes) == 1
+    assert response_cache.count == 9
+    assert response_cache.get('key 1') == 1
+    assert response_cache.get('key 2') is None
+    # the count is read from the database when the cache is reopened
+    response_cache.close()
+    assert ResponseCache(str(tmp_path / 'cache.sqlite'), max_entries=10).count == 9
+
+
+def test_checkpoint_resumes_after_crash_with_partial_last_line(tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.jsonl')
+    checkpoint = LookupCheckpoint(checkpoint_path, source='api')
+    checkpoint.add('Lutra lutra', {'usageKey': 5219})
+    checkpoint.close()
+    with open(checkpoint_path, 'a', encoding='utf-8') as file:
+        file.write('{"fingerprint": "trunc')  # interrupted while writing
+
+    checkpoint = LookupCheckpoint(checkpoint_path, source='api')
+    assert checkpoint.pending(['Lutra lutra', ' lutra LUTRA', 'Canis lupus', 'Canis lupus']) == ['Canis lupus']
+    checkpoint.add('Canis lupus', {'usageKey': 5219173})
+    checkpoint.close()
+    checkpoint = LookupCheckpoint(checkpoint_path, source='api')
+    assert checkpoint.get('Canis lupus') == {'usageKey': 5219173}
+    assert checkpoint.get('Lutra lutra') == {'usageKey': 5219}
+    # results of another source are not reused
+    assert LookupCheckpoint(checkpoint_path, source='backbone').pending(['Lutra lutra']) == ['Lutra lutra']
+
+
+def test_checkpoint_compact_drops_removed_names(tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.jsonl')
+    checkpoint = LookupCheckpoint(checkpoint_path)
+    for name in ['Lutra lutra', 'Canis lupus', 'Lutra lutra']:
+        checkpoint.add(name, {'name': name})
+    checkpoint.compact(['Canis lupus'])
+    checkpoint.close()
+    with open(checkpoint_path, encoding='utf-8') as file:
+        assert len(file.readlines()) == 1
+    assert LookupCheckpoint(checkpoint_path).pending(['Lutra lutra', 'Canis lupus']) == ['Lutra lutra']
+
+
+def test_checkpoint_results_expire(tmp_path):
+    checkpoint_path = str(tmp_path / 'checkpoint.jsonl')
+    checkpoint = LookupCheckpoint(checkpoint_path, ttl_days=30)
+    checkpoint.add('Lutra lutra', {'usageKey': 5219})
+    checkpoint.add('Canis lupus', {'usageKey': 5219173})
+    checkpoint.created[checkpoint.fingerprint('Lutra lutra')] -= 31 * 86400
+    checkpoint.compact(['Lutra lutra', 'Canis lupus'])  # time of lookup is kept
+    checkpoint.close()
+
+    checkpoint = LookupCheckpoint(checkpoint_path, ttl_days=30)
+    assert checkpoint.pending(['Lutra lutra', 'Canis lupus']) == ['Lutra lutra']
+    assert checkpoint.get('Lutra lutra') is None
+    # without time to live results never expire
+    assert LookupCheckpoint(checkpoint_path).pending(['Lutra lutra', 'Canis lupus']) == []
+
+
+@pytest.mark.parametrize('name, expected', [
+    ('Alytes cisternasii Boscá, 1879', ('Alytes cisternasii', 'Boscá, 1879')),
+    ('Lutra lutra (Linnaeus, 1758)', ('Lutra lutra', '(Linnaeus, 1758)')),
+    ('  lutra   LUTRA ', ('Lutra lutra', '')),
+    ('Lutra_lutra', ('Lutra lutra', '')),
+    ('Lutra lutra ssp lutra L.', ('Lutra lutra subsp. lutra', 'L.')),
+    ('Aus bus de Candolle', ('Aus bus', 'de Candolle')),
+    ('Lutra sp.', ('Lutra', '')),
+    ('', ('', '')),
+    (None, ('', '')),
+])
+def test_parse_scientific_name(name, expected):
+    assert parse_scientific_name(name) == expected
+
+
+def test_deduplicate_names_and_fan_out():
+    names = ['Lutra lutra', 'Canis lupus L.', ' lutra lutra', None, 'Lutra lutra (Linnaeus, 1758)']
+    queries, query_nums = deduplicate_names(names)
+    assert queries == ['Lutra lutra', 'Canis lupus']
+    assert query_nums == [0, 1, 0, -1, 0]
+    assert fan_out(['otter', 'wolf'], query_nums, default='') == ['otter', 'wolf', 'otter', '', 'otter']
+
+
+class StubBackbone:
+    # offline matcher which matches every canonical name to itself
+    def match_many(self, names):
+        return [{'usageKey': len(name), 'speciesKey': len(name), 'canonicalName': name, 'scientificName': name} for name in names]
+
+
+def test_lookup_output_has_one_row_for_every_canonical_name(tmp_path, monkeypatch):
+    gbif_lookup = pytest.importorskip('_1_gbif_lookup')
+    monkeypatch.setattr(gbif_lookup, 'backbone', StubBackbone())
+    input_path = tmp_path / 'species_list.csv'
+    pd.DataFrame({'name': ['Lutra lutra', 'Lutra lutra L.', 'Vulpes vulpes', 'lutra lutra']}).to_csv(input_path, index=False)
+    output_path = str(tmp_path / 'mapped_species_GBIF.csv')
+    gbif_lookup.lookup_species_from_csv(str(input_path), output_path)
+
+    # merged with IUCN data by canonicalName, so names must not be repeated
+    results_df = pd.read_csv(output_path)
+    assert results_df['canonicalName'].tolist() == ['Lutra lutra', 'Vulpes vulpes']
+    input_names_df = pd.read_csv(gbif_lookup.input_names_csv_path(output_path))
+    assert input_names_df['inputName'].tolist() == ['Lutra lutra', 'Lutra lutra L.', 'Vulpes vulpes', 'lutra lutra']
+    assert input_names_df['gbifKey'].tolist() == [11, 11, 13, 11]
+    assert input_names_df['lookupName'].tolist() == ['Lutra lutra', 'Lutra lutra', 'Vulpes vulpes', 'Lutra lutra']
+
+
+class StubGbifHandler(BaseHTTPRequestHandler):
+    # local stub of GBIF Species API: species/match and species/search, one 'Too Many Requests' response for names starting with 'Retry'
+    requests = []
+    throttled = set()
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {name: values[0] for name, values in parse_qs(url.query).items()}
+        name = params.get('name', params.get('q', ''))
+        StubGbifHandler.requests.append((time.monotonic(), url.path, name))
+        if name.startswith('Retry') and (url.path, name) not in StubGbifHandler.throttled:
+            StubGbifHandler.throttled.add((url.path, name))
+            self.send_response(429)
+            self.send_header('Retry-After', '0.2')
+            self.end_headers()
+            return
+        time.sleep(0.001 * (sum(map(ord, name)) % 20))  # responses finish out of order
+        key = sum(map(ord, name))
+        if url.path.endswith('/species/match'):
+            data = {'usageKey': key, 'scientificName': name, 'canonicalName': name, 'rank': 'SPECIES', 'matchType': 'EXACT', 'confidence': 99}
+        else:
+            data = {'results': [{'key': key, 'speciesKey': key + 1}]}
+        body = json.dumps(data).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_gbif(monkeypatch):
+    gbif_lookup = pytest.importorskip('_1_gbif_lookup')
+    StubGbifHandler.requests = []
+    StubGbifHandler.throttled = set()
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubGbifHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    # module settings are restored after the test
+    for name in ['rate_limiter', 'GBIF_API_URL', 'response_cache', 'offline', 'backbone']:
+        monkeypatch.setattr(gbif_lookup, name, getattr(gbif_lookup, name))
+    gbif_lookup.configure_lookup(api_url=f"http://127.0.0.1:{server.server_address[1]}")
+    yield gbif_lookup
+    server.shutdown()
+    server.server_close()
+
+
+def test_lookup_against_stub_server_keeps_order_and_retries(stub_gbif):
+    names = [f'Species number{n}' for n in range(12)] + ['Retry lutra']
+    results = stub_gbif.lookup_species(names, workers=4, rate=100)
+    assert [result['scientificName'] for result in results] == names
+    assert [result['gbifSpeciesKey'] for result in results] == [sum(map(ord, name)) + 1 for name in names]
+    # 'Too Many Requests' is retried after Retry-After
+    retried = [(timestamp, path) for timestamp, path, name in StubGbifHandler.requests if name == 'Retry lutra' and path.endswith('/species/match')]
+    assert len(retried) == 2
+    assert retried[1][0] - retried[0][0] >= 0.2
+
+
+def test_lookup_against_stub_server_within_rate_limit(stub_gbif):
+    names = [f'Species number{n}' for n in range(20)]
+    stub_gbif.lookup_species(names, workers=8, rate=20)
+    timestamps = sorted(timestamp for timestamp, _, _ in StubGbifHandler.requests)
+    assert len(timestamps) == 40
+    # burst of 20 requests, the other 20 at 20 requests per second
+    assert timestamps[-1] - timestamps[0] >= 20 / 20 * 0.9
+    # requests after the burst are sent at the steady rate
+    assert timestamps[-1] - timestamps[20] >= 19 / 20 * 0.9
@@ -0,0 +1,59 @@
+# test_raster_writer.py
+# includes tests of nodata masks of coarser levels of the count pyramid
+# should be run with pytest (requires GDAL)
+
+import numpy as np
+import pytest
+
+gdal = pytest.importorskip('osgeo.gdal')
+
+from raster_writer import coarse_nodata_mask, level_template
+
+
+class RecordingBand:
+    # band which records the largest window read from it
+    def __init__(self, array):
+        self.array = array
+        self.YSize, self.XSize = array.shape
+        self.max_rows = 0
+
+    def ReadAsArray(self, xoff, yoff, xsize, ysize):
+        self.max_rows = max(self.max_rows, ysize)
+        return self.array[yoff:yoff + ysize, xoff:xoff + xsize]
+
+
+def expected_mask(array, nodata_value, factor):
+    level_shape = (-(-array.shape[0] // factor), -(-array.shape[1] // factor))
+    padded = np.ones((level_shape[0] * factor, level_shape[1] * factor), dtype=bool)
+    padded[:array.shape[0], :array.shape[1]] = array == nodata_value
+    return padded.reshape(level_shape[0], factor, level_shape[1], factor).all(axis=(1, 3))
+
+
+@pytest.mark.parametrize('factor, block_size', [(3, 4), (7, 2), (10, 512), (100, 16)])
+def test_coarse_nodata_mask_reads_at_most_block_size_rows(factor, block_size):
+    rng = np.random.default_rng(0)
+    array = np.where(rng.random((203, 157)) < 0.97, -1, 1)
+    band = RecordingBand(array)
+    level_y_size = -(-array.shape[0] // factor)
+    level_rows = max(1, block_size // factor)
+    mask = np.vstack([
+        coarse_nodata_mask(band, -1, factor, level_yoff, min(level_rows, level_y_size - level_yoff), block_size)
+        for level_yoff in range(0, level_y_size, level_rows)
+    ])
+    assert np.array_equal(mask, expected_mask(array, -1, factor))
+    assert band.max_rows <= block_size
+
+
+def test_level_template_grid_and_mask():
+    array = np.full((45, 32), 255, dtype=np.uint8)
+    array[3, 30] = 1
+    template_ds = gdal.GetDriverByName('MEM').Create('', 32, 45, 1, gdal.GDT_Byte)
+    template_ds.SetGeoTransform([0, 10, 0, 450, 0, -10])
+    template_ds.GetRasterBand(1).SetNoDataValue(255)
+    template_ds.GetRasterBand(1).WriteArray(array)
+
+    level_ds = level_template(template_ds, 10, block_size=16)
+    assert (level_ds.RasterXSize, level_ds.RasterYSize) == (4, 5)
+    assert level_ds.GetGeoTransform()[1] == 100
+    level_mask = level_ds.GetRasterBand(1).ReadAsArray() == 255
+    assert np.array_equal(level_mask, expected_mask(array, 255, 10))
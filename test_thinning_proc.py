@@ -0,0 +1,79 @@
+# test_thinning_proc.py
+# includes tests of streaming spatial thinning of occurrences
+# should be run with pytest
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from thinning_proc import RecordWriter, SpatialThinner
+
+
+def chunks(df, n):
+    return [df.iloc[start:start + -(-len(df) // n)] for start in range(0, len(df), -(-len(df) // n))]
+
+
+@pytest.fixture
+def records():
+    rng = np.random.default_rng(2)
+    return pd.DataFrame({
+        'speciesKey': rng.integers(1, 6, 3000),
+        'pixel': rng.integers(0, 200, 3000),
+        'year': rng.choice(['2019', '2020'], 3000),
+    })
+
+
+@pytest.mark.parametrize('with_periods', [False, True])
+def test_thinning_in_chunks_equals_drop_duplicates(records, with_periods):
+    key_columns = ['speciesKey', 'pixel', 'year'] if with_periods else ['speciesKey', 'pixel']
+    thinner = SpatialThinner()
+    kept = []
+    for chunk in chunks(records, 7):
+        keep = thinner.thin(chunk['speciesKey'].values, chunk['pixel'].values, chunk['year'].values if with_periods else None)
+        kept.append(chunk[keep])
+    expected = records.drop_duplicates(key_columns)
+    assert pd.concat(kept).equals(expected)
+    assert thinner.total == len(expected)
+
+
+def test_species_keys_as_int_and_float_are_the_same_key():
+    # chunks with missing species keys are read as float64, other chunks as int64
+    thinner = SpatialThinner()
+    assert thinner.thin(np.array([5, 6]), np.array([10, 10])).tolist() == [True, True]
+    assert thinner.thin(np.array([5.0, np.nan, 7.0]), np.array([10, 10, 10])).tolist() == [False, False, True]
+    assert thinner.thin(np.array([7]), np.array([10])).tolist() == [False]
+    assert thinner.total == 3
+
+
+def test_record_writer_appends_chunks(tmp_path, records):
+    output_path = str(tmp_path / 'thinned.csv')
+    record_writer = RecordWriter(output_path)
+    for chunk in chunks(records, 3):
+        record_writer.write(chunk)
+    record_writer.close()
+    assert pd.read_csv(output_path, dtype={'year': str}).equals(records)
+
+
+def test_record_writer_keeps_parquet_schema_of_first_chunk(tmp_path):
+    pytest.importorskip('pyarrow')
+    output_path = str(tmp_path / 'thinned.parquet')
+    record_writer = RecordWriter(output_path)
+    # categories read from the Parquet cache, few in the first chunk and more than 127 in the next one,
+    # IUCN category empty in the first chunk
+    record_writer.write(pd.DataFrame({
+        'species': pd.Categorical(['Species 1', 'Species 2']),
+        'speciesKey': [1, 2],
+        'iucnRedListCategory': [np.nan, np.nan],
+    }))
+    species = [f'Species {key}' for key in range(300)]
+    record_writer.write(pd.DataFrame({
+        'species': pd.Categorical(species),
+        'speciesKey': range(300),
+        'iucnRedListCategory': ['VU'] * 300,
+    }))
+    record_writer.close()
+    written = pd.read_parquet(output_path)
+    assert len(written) == 302
+    assert written['species'].astype(str).tolist() == ['Species 1', 'Species 2'] + species
+    assert written['iucnRedListCategory'].isna().sum() == 2
+    assert (written['iucnRedListCategory'] == 'VU').sum() == 300
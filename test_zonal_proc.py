@@ -0,0 +1,152 @@
+# test_zonal_proc.py
+# includes tests of zonal statistics by classes of raster datasets and by overlapping polygons
+# should be run with pytest (tests of rasterizing of polygons require GDAL)
+
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+from zonal_proc import RasterZoneLookup, ZonalAccumulator, rasterize_zones
+
+try:
+    from osgeo import gdal
+except ImportError:
+    gdal = None
+
+requires_gdal = pytest.mark.skipif(gdal is None, reason="rasterizing of polygons requires GDAL")
+
+
+class ArrayBand:
+    # band of the raster dataset with zones which records windows read from it (stand-in for gdal.Band)
+    def __init__(self, array, nodata_value=None):
+        self.array = array
+        self.YSize, self.XSize = array.shape
+        self.nodata_value = nodata_value
+        self.windows = []
+
+    def GetNoDataValue(self):
+        return self.nodata_value
+
+    def ReadAsArray(self, xoff=0, yoff=0, xsize=None, ysize=None):
+        xsize = self.XSize if xsize is None else xsize
+        ysize = self.YSize if ysize is None else ysize
+        self.windows.append((xoff, yoff, xsize, ysize))
+        return self.array[yoff:yoff + ysize, xoff:xoff + xsize]
+
+
+class ArrayDataset:
+    # raster dataset with one band (stand-in for gdal.Dataset)
+    def __init__(self, band):
+        self.band = band
+
+    def GetRasterBand(self, band_num):
+        return self.band
+
+
+@pytest.fixture
+def classes():
+    rng = np.random.default_rng(6)
+    return rng.choice(np.array([10, 20, 30, 255], dtype=np.uint8), (70, 90))
+
+
+@pytest.fixture
+def occurrences():
+    rng = np.random.default_rng(7)
+    return rng.integers(0, 70, 3000), rng.integers(0, 90, 3000), rng.choice([1.0, 2.0, 3.0, np.nan], 3000)
+
+
+def test_windowed_lookup_equals_lookup_in_memory(classes, occurrences):
+    pixel_rows, pixel_cols, _ = occurrences
+    in_memory = RasterZoneLookup(ArrayDataset(ArrayBand(classes, 255)))
+    band = ArrayBand(classes, 255)
+    windowed = RasterZoneLookup(ArrayDataset(band), in_memory=False, block_size=32)
+    assert band.windows == []
+    zones = windowed.lookup(pixel_rows, pixel_cols)
+    assert np.array_equal(zones, in_memory.lookup(pixel_rows, pixel_cols))
+    assert np.array_equal(zones, classes[pixel_rows, pixel_cols])
+    # every block (clipped by the raster) is read once per chunk
+    assert sorted(band.windows) == sorted((xoff, yoff, min(32, 90 - xoff), min(32, 70 - yoff)) for yoff in range(0, 70, 32) for xoff in range(0, 90, 32))
+    assert windowed.lookup(np.array([], dtype=np.int64), np.array([], dtype=np.int64)).size == 0
+
+
+def test_valid_zones(classes):
+    assert RasterZoneLookup(ArrayDataset(ArrayBand(classes, 255))).valid(np.array([10, 255, 30])).tolist() == [True, False, True]
+    assert RasterZoneLookup(ArrayDataset(ArrayBand(classes))).valid(np.array([10, 255])).tolist() == [True, True]
+
+
+def test_statistics_by_classes_in_chunks(classes, occurrences, tmp_path):
+    pixel_rows, pixel_cols, species = occurrences
+    zone_lookup = RasterZoneLookup(ArrayDataset(ArrayBand(classes, 255)), in_memory=False, block_size=16)
+    zonal_accumulator = ZonalAccumulator('class')
+    for chunk in np.array_split(np.arange(len(species)), 4):
+        zones = zone_lookup.lookup(pixel_rows[chunk], pixel_cols[chunk])
+        valid = zone_lookup.valid(zones)
+        zonal_accumulator.add(zones[valid], species[chunk][valid])
+
+    df = pd.DataFrame({'class': classes[pixel_rows, pixel_cols], 'species': species})
+    df = df[df['class'] != 255]
+    table = zonal_accumulator.table({10: 'forest', 20: 'cropland', 30: 'urban'})
+    assert table['class'].tolist() == [10, 20, 30]
+    assert table['name'].tolist() == ['forest', 'cropland', 'urban']
+    assert table['occurrence_count'].tolist() == df.groupby('class').size().tolist()
+    assert table['species_count'].tolist() == df.groupby('class')['species'].nunique().tolist()
+    assert zonal_accumulator.total == len(df)
+
+    output_path = str(tmp_path / 'zonal_stats.csv')
+    zonal_accumulator.write(output_path)
+    assert pd.read_csv(output_path)['occurrence_count'].tolist() == table['occurrence_count'].tolist()
+
+
+def square(xmin, ymin, xmax, ymax, name):
+    return {
+        'type': 'Feature',
+        'properties': {'SITECODE': name},
+        'geometry': {'type': 'Polygon', 'coordinates': [[[xmin, ymin], [xmax, ymin], [xmax, ymax], [xmin, ymax], [xmin, ymin]]]},
+    }
+
+
+@pytest.fixture
+def template_ds():
+    # 10 x 10 pixels of 1 x 1 unit, without CRS (polygons are in the same units)
+    template_ds = gdal.GetDriverByName('MEM').Create('', 10, 10, 1, gdal.GDT_Byte)
+    template_ds.SetGeoTransform([0, 1, 0, 10, 0, -1])
+    return template_ds
+
+
+@requires_gdal
+def test_overlapping_zones_are_counted_in_each_zone(tmp_path, template_ds):
+    # SPA and SCI overlap in columns 4-5, the third zone only touches the SPA
+    zones_path = tmp_path / 'zones.geojson'
+    features = [square(0, 0, 6, 10, 'SPA'), square(4, 0, 8, 10, 'SCI'), square(8, 0, 10, 10, 'OTHER')]
+    zones_path.write_text(json.dumps({'type': 'FeatureCollection', 'features': features}))
+    zones_ds, zone_names = rasterize_zones(str(zones_path), template_ds, name_field='SITECODE')
+    assert zone_names == {1: 'SPA', 2: 'SCI', 3: 'OTHER'}
+    assert zones_ds.RasterCount == 2
+
+    # one occurrence in every column of the first row
+    pixel_rows = np.zeros(10, dtype=np.int64)
+    pixel_cols = np.arange(10)
+    species = np.arange(10) % 3
+    zonal_accumulator = ZonalAccumulator('zone_id')
+    for band_num in range(1, zones_ds.RasterCount + 1):
+        zone_lookup = RasterZoneLookup(zones_ds, band_num)
+        zones = zone_lookup.lookup(pixel_rows, pixel_cols)
+        valid = zone_lookup.valid(zones)
+        zonal_accumulator.add(zones[valid], species[valid])
+    table = zonal_accumulator.table(zone_names).set_index('name')
+    assert table.loc['SPA', 'occurrence_count'] == 6
+    assert table.loc['SCI', 'occurrence_count'] == 4
+    assert table.loc['OTHER', 'occurrence_count'] == 2
+    assert table.loc['SPA', 'species_count'] == 3
+
+
+@requires_gdal
+def test_zones_without_overlaps_use_one_band(tmp_path, template_ds):
+    zones_path = tmp_path / 'zones.geojson'
+    features = [square(0, 0, 5, 10, 'A'), square(5, 0, 10, 10, 'B')]
+    zones_path.write_text(json.dumps({'type': 'FeatureCollection', 'features': features}))
+    zones_ds, _ = rasterize_zones(str(zones_path), template_ds, name_field='SITECODE')
+    assert zones_ds.RasterCount == 1
+    zones = zones_ds.GetRasterBand(1).ReadAsArray()
+    assert (zones[:, :5] == 1).all() and (zones[:, 5:] == 2).all()
@@ -0,0 +1,93 @@
+# thinning_proc.py
+# includes methods to thin occurrences spatially in a streaming way: only the first record of every species in every pixel (and, optionally, period) is kept,
+# deduplicated across chunks by hashed composite keys, and thinned records are appended to CSV or Parquet chunk by chunk
+# should be imported as classes
+
+import pandas as pd
+import os
+from datacube_proc import HashedKeySet, _parquet_schema
+
+
+class SpatialThinner:
+    """
+    Keeps one record for each (speciesKey, pixel[, period]). Composite keys are hashed into 64-bit integers and kept as sorted arrays,
+    so memory is bounded by the number of thinned records (8 bytes each), not by the number of records in the datacube.
+    """
+
+    def __init__(self):
+        self.seen = HashedKeySet()
+
+    def thin(self, species, pixels, periods=None):
+        """
+        Selects records to keep from one chunk.
+
+        Args:
+            species (np.ndarray): Species keys of records.
+            pixels (np.ndarray): Flat pixel indices of the same records.
+            periods (np.ndarray): Periods of the same records (for example, years), None to keep one record per species and pixel over all periods.
+
+        Returns:
+            np.ndarray: Boolean mask, True for records to keep (records without species key are never kept).
+        """
+        key_columns = {'species': species, 'pixel': pixels}
+        if periods is not None:
+            key_columns['period'] = periods
+        key_df = pd.DataFrame(key_columns)
+        keep = key_df['species'].notna().to_numpy(copy=True)
+        key_df = key_df[keep]
+        # species keys are read as float64 in chunks with missing keys and as int64 otherwise, and 5.0 is hashed differently than 5
+        key_df = key_df.astype({'species': 'int64', 'pixel': 'int64'})
+        # the first record of every key which has not been kept in previous chunks
+        keep[keep] = self.seen.add_new(pd.util.hash_pandas_object(key_df, index=False).values)
+        return keep
+
+    @property
+    def total(self):
+        return len(self.seen)
+
+
+class RecordWriter:
+    """
+    Appends records to CSV or Parquet file (by the extension of output path) chunk by chunk, so that records are never kept in memory.
+    """
+
+    def __init__(self, output_path):
+        self.output_path = output_path
+        self.parquet = output_path.lower().endswith('.parquet')
+        self._writer = None
+        self._header = True
+        if os.path.exists(output_path):
+            os.remove(output_path)  # to avoid appending to the output of previous run
+
+    def write(self, df):
+        if self.parquet:
+            import pyarrow as pa  # pip install pyarrow
+            import pyarrow.parquet as pq
+            if self._writer is None:
+                # the schema of the first chunk is kept for all chunks: categories get 32-bit dictionary indices
+                # and columns which are empty in the first chunk (read as float64 by pandas) are written as strings
+                schema = _parquet_schema(pa.Table.from_pandas(df, preserve_index=False))
+                schema = pa.schema(
+                    [field.with_type(pa.string()) if len(df) and df[field.name].isna().all() else field for field in schema], metadata=schema.metadata
+                )
+                self._writer = pq.ParquetWriter(self.output_path, schema)
+            string_columns = [field.name for field in self._writer.schema if pa.types.is_string(field.type)]
+            df = df.astype({column: 'string' for column in string_columns if not pd.api.types.is_string_dtype(df[column])})
+            table = pa.Table.from_pandas(df, schema=self._writer.schema, preserve_index=False)
+            self._writer.write_table(table)
+        else:
+            df.to_csv(self.output_path, mode='a', header=self._header, index=False)
+            self._header = False
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+# Example usage
+# thinner = SpatialThinner()
+# record_writer = RecordWriter('output/thinned_occurrences.csv')
+# for chunk in chunks:
+#     keep = thinner.thin(chunk['speciesKey'].values, flat_idx, chunk['yearMonth'].str[:4].values)
+#     record_writer.write(chunk[keep])
+# record_writer.close()
@@ -0,0 +1,220 @@
+# zonal_proc.py
+# includes methods to aggregate occurrences by zones (for example, classes of the land-cover raster dataset or polygons of protected areas) in a streaming way,
+# chunk by chunk: the number of occurrences and distinct species in each zone
+# should be imported as classes and functions
+
+import numpy as np
+import pandas as pd
+
+
+class RasterZoneLookup:
+    """
+    Looks up values of the raster band (zones, for example land-cover classes) in pixels of occurrences for the whole chunk at once.
+    The band is read into memory once, or window by window (only blocks with occurrences are read) for very large rasters.
+    """
+
+    def __init__(self, raster_ds, band_num=1, in_memory=True, block_size=512):
+        """
+        Initializes the lookup.
+
+        Args:
+            raster_ds (gdal.Dataset): Raster dataset with zones.
+            band_num (int): Number of the band with zones.
+            in_memory (bool): To read the whole band into memory (otherwise, blocks are read on demand for every chunk).
+            block_size (int): Size of blocks read from the band if it is not kept in memory.
+        """
+        self.band = raster_ds.GetRasterBand(band_num)
+        self.nodata_value = self.band.GetNoDataValue()
+        self.block_size = int(block_size)
+        self.values = self.band.ReadAsArray() if in_memory else None
+
+    def lookup(self, pixel_row, pixel_col):
+        """
+        Returns zones in pixels of occurrences.
+
+        Args:
+            pixel_row (np.ndarray): Row indices of pixels.
+            pixel_col (np.ndarray): Column indices of pixels.
+
+        Returns:
+            np.ndarray: Zones of occurrences.
+        """
+        if self.values is not None:
+            return self.values[pixel_row, pixel_col]
+        if len(pixel_row) == 0:
+            return np.empty(0)
+        # occurrences are sorted by blocks, so every block is read only once per chunk
+        n_blocks_x = -(-self.band.XSize // self.block_size)
+        block_ids = (pixel_row // self.block_size) * n_blocks_x + pixel_col // self.block_size
+        order = np.argsort(block_ids, kind='stable')
+        unique_blocks, starts = np.unique(block_ids[order], return_index=True)
+        zones = None
+        for block_id, selected in zip(unique_blocks, np.split(order, starts[1:])):
+            yoff = int(block_id // n_blocks_x) * self.block_size
+            xoff = int(block_id % n_blocks_x) * self.block_size
+            window = self.band.ReadAsArray(xoff, yoff, min(self.block_size, self.band.XSize - xoff), min(self.block_size, self.band.YSize - yoff))
+            if zones is None:
+                zones = np.empty(len(pixel_row), dtype=window.dtype)
+            zones[selected] = window[pixel_row[selected] - yoff, pixel_col[selected] - xoff]
+        return zones
+
+    def valid(self, zones):
+        """
+        Returns the mask of zones which are not nodata.
+        """
+        if self.nodata_value is None:
+            return np.ones(len(zones), dtype=bool)
+        return zones != self.nodata_value
+
+
+def _overlaps_any(layer, geometry):
+    """
+    Checks if the geometry overlaps (shares some area, not only the boundary) any feature of the layer.
+    """
+    layer.SetSpatialFilter(geometry)
+    try:
+        for feature in layer:
+            other = feature.GetGeometryRef()
+            if other.Intersects(geometry):
+                intersection = other.Intersection(geometry)
+                if intersection is not None and intersection.GetArea() > 0:
+                    return True
+        return False
+    finally:
+        layer.SetSpatialFilter(None)
+
+
+def rasterize_zones(zones_path, template_ds, name_field=None, layer_name=None, all_touched=False):
+    """
+    Rasterizes polygons of the vector layer (GeoPackage, Shapefile etc.) onto the grid of the input raster dataset, so that zones of occurrences
+    are looked up by pixel indices for the whole chunk at once instead of point-in-polygon tests for every record.
+    Every feature is burnt with its own zone id (1, 2, 3...), 0 means no zone. Overlapping polygons (for example, SPA and SCI sites of Natura 2000)
+    are split into groups without overlaps, and every group is burnt into its own band, so occurrences are counted in every zone they fall into.
+
+    Args:
+        zones_path (str): Path to the vector dataset with zones.
+        template_ds (gdal.Dataset): Input raster dataset (grid and projection of zones).
+        name_field (str): Attribute with names or codes of zones (for example, SITECODE of Natura 2000 sites), feature ids by default.
+        layer_name (str): Name of the layer (the first layer by default).
+        all_touched (bool): To burn all pixels touched by polygons (otherwise, only pixels with centres within polygons).
+
+    Returns:
+        tuple: In-memory raster dataset with zone ids (one band for each group of non-overlapping zones) and dictionary of zone names {zone id: name}.
+    """
+    from osgeo import gdal, ogr  # only rasterizing of vector zones requires GDAL
+    vector_ds = ogr.Open(zones_path)
+    if vector_ds is None:
+        raise FileNotFoundError(f"Failed to open vector dataset with zones: {zones_path}")
+    layer = vector_ds.GetLayerByName(layer_name) if layer_name else vector_ds.GetLayer(0)
+    if layer is None:
+        raise ValueError(f"Layer '{layer_name}' is not found in {zones_path}.")
+
+    # copies of the layer with sequential zone ids (feature ids of Shapefiles start from 0, so they can't be burnt as they are),
+    # every feature is added to the first copy where it doesn't overlap other features
+    memory_ds = ogr.GetDriverByName('Memory').CreateDataSource('zones')
+    memory_layers = []
+    zone_names = {}
+    for zone_id, feature in enumerate(layer, start=1):
+        geometry = feature.GetGeometryRef()
+        if geometry is None:
+            continue
+        geometry = geometry.Clone()
+        for memory_layer in memory_layers:
+            if not _overlaps_any(memory_layer, geometry):
+                break
+        else:
+            memory_layer = memory_ds.CreateLayer(f'zones_{len(memory_layers) + 1}', srs=layer.GetSpatialRef(), geom_type=ogr.wkbMultiPolygon)
+            memory_layer.CreateField(ogr.FieldDefn('zone_id', ogr.OFTInteger))
+            memory_layers.append(memory_layer)
+        memory_feature = ogr.Feature(memory_layer.GetLayerDefn())
+        memory_feature.SetGeometry(geometry)
+        memory_feature.SetField('zone_id', zone_id)
+        memory_layer.CreateFeature(memory_feature)
+        zone_names[zone_id] = feature.GetField(name_field) if name_field else feature.GetFID()
+
+    zones_ds = gdal.GetDriverByName('MEM').Create('', template_ds.RasterXSize, template_ds.RasterYSize, max(len(memory_layers), 1), gdal.GDT_Int32)
+    zones_ds.SetProjection(template_ds.GetProjection())
+    zones_ds.SetGeoTransform(template_ds.GetGeoTransform())
+    # polygons are reprojected into the CRS of the raster dataset while rasterizing
+    options = ['ATTRIBUTE=zone_id'] + (['ALL_TOUCHED=TRUE'] if all_touched else [])
+    for band_num in range(1, zones_ds.RasterCount + 1):
+        zones_ds.GetRasterBand(band_num).SetNoDataValue(0)
+        if band_num <= len(memory_layers) and gdal.RasterizeLayer(zones_ds, [band_num], memory_layers[band_num - 1], options=options) != 0:
+            raise RuntimeError(f"Failed to rasterize zones from {zones_path}")
+    return zones_ds, zone_names
+
+
+class ZonalAccumulator:
+    """
+    Streaming accumulator of occurrences by zones: counts are summed up chunk by chunk and distinct species are kept as unique (zone, species) pairs,
+    so memory is bounded by the number of zones and species, not by the number of records.
+    """
+
+    def __init__(self, zone_name='class'):
+        """
+        Initializes the accumulator.
+
+        Args:
+            zone_name (str): Name of the column with zones in the output table.
+        """
+        self.zone_name = zone_name
+        self.counts = pd.Series(dtype='int64')
+        self.species_pairs = pd.DataFrame(columns=['zone', 'species'])
+
+    def add(self, zones, species=None):
+        """
+        Adds occurrences of the chunk.
+
+        Args:
+            zones (np.ndarray): Zones of occurrences.
+            species (np.ndarray): Species keys of occurrences (records without species key are counted, but not as distinct species).
+        """
+        self.counts = self.counts.add(pd.Series(zones).value_counts(), fill_value=0).astype('int64')
+        if species is not None:
+            pairs = pd.DataFrame({'zone': zones, 'species': species}).dropna().drop_duplicates()
+            self.species_pairs = pd.concat([self.species_pairs, pairs], ignore_index=True).drop_duplicates() if len(self.species_pairs) else pairs
+
+    @property
+    def total(self):
+        return int(self.counts.sum())
+
+    def table(self, zone_names=None):
+        """
+        Returns the table with the number of occurrences and distinct species in each zone.
+
+        Args:
+            zone_names (dict): Names of zones to add to the table {zone: name} (for example, names of land-cover classes).
+
+        Returns:
+            pd.DataFrame: Table with zone, occurrence_count and species_count columns.
+        """
+        table = pd.DataFrame({self.zone_name: self.counts.index, 'occurrence_count': self.counts.values})
+        species_counts = self.species_pairs.groupby('zone').size()
+        table['species_count'] = table[self.zone_name].map(species_counts).fillna(0).astype('int64')
+        if zone_names is not None:
+            table.insert(1, 'name', table[self.zone_name].map(zone_names))
+        return table.sort_values(self.zone_name, ignore_index=True)
+
+    def write(self, output_path, zone_names=None):
+        """
+        Writes the table of zonal statistics to CSV or Parquet (by the extension of output path).
+        """
+        table = self.table(zone_names)
+        if output_path.lower().endswith('.parquet'):
+            table.to_parquet(output_path, index=False)  # pip install pyarrow
+        else:
+            table.to_csv(output_path, index=False)
+        return table
+
+# Example usage
+# zone_lookup = RasterZoneLookup(gdal.Open('ict_2022.tif'))
+# zonal_accumulator = ZonalAccumulator('class')
+# zones = zone_lookup.lookup(pixel_row, pixel_col)
+# valid = zone_lookup.valid(zones)
+# zonal_accumulator.add(zones[valid], species_keys[valid])
+# zonal_accumulator.write('output/zonal_stats.csv')
+# polygons of protected areas are rasterized onto the grid of the input raster dataset and looked up in the same way
+# zones_ds, zone_names = rasterize_zones('natura2000.gpkg', gdal.Open('ict_2022.tif'), name_field='SITECODE')
+# zone_lookups = [RasterZoneLookup(zones_ds, band_num) for band_num in range(1, zones_ds.RasterCount + 1)] # one band for each group of non-overlapping zones
+# ...
+# zonal_accumulator.write('output/zonal_stats_natura2000.csv', zone_names)